@@ -0,0 +1,317 @@
+#!/usr/bin/python
+#
+# Neteria
+# Copyright (C) 2014, William Edwards <shadowapex@gmail.com>,
+#
+# This file is part of Neteria.
+#
+# Neteria is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neteria is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neteria.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contributor(s):
+#
+# William Edwards <shadowapex@gmail.com>
+# Derek Clark <derekjohn.clark@gmail.com>
+#
+"""The aio module provides asyncio versions of the Neteria listener, server
+and client.
+
+Instead of spawning a listener thread and a scheduler thread, the asyncio
+listener receives datagrams through an asyncio datagram endpoint and schedules
+retransmits with the event loop's call_later. This allows any number of
+servers and clients to share a single event loop with the rest of your
+application.
+
+Examples:
+  >>> import asyncio
+  >>> from neteria.aio import AsyncNeteriaServer
+  >>> from neteria.tools import _Middleware
+  >>>
+  >>> async def main():
+  ...     myserver = AsyncNeteriaServer(_Middleware())
+  ...     await myserver.listen()
+  ...     await asyncio.Event().wait()
+  >>>
+  >>> asyncio.get_event_loop().run_until_complete(main())
+
+"""
+
+import asyncio
+import logging
+import socket
+
+from .client import NeteriaClient
+from .core import ListenerUDP, ScheduledCall, monotonic
+from .executor import EventExecutor
+from .server import NeteriaServer
+
+# Create a logger for optional handling of debug messages.
+logger = logging.getLogger(__name__)
+
+
+class AsyncListenerUDP(ListenerUDP, asyncio.DatagramProtocol):
+    """A ListenerUDP that sends and receives UDP datagrams using an asyncio
+    event loop instead of threads.
+
+    Args:
+      app (object): A class instance with a "handle_message" method
+        that will process received messages.
+      loop (asyncio.AbstractEventLoop): The event loop to run on. Defaults to
+        the current event loop.
+
+    All other arguments are the same as ListenerUDP. The event loop delivers
+    datagrams one at a time, so "batch_size" has no effect.
+
+    The event loop is not thread safe, so calls scheduled and datagrams sent
+    from any other thread are handed to the loop with call_soon_threadsafe.
+
+    """
+
+    def __init__(self, app, loop=None, stats=False, listen_address='',
+                 listen_port=40080, listen_type="unicast", bufsize=10240,
+                 batch_size=0, reuse_port=False, mtu=1400,
+                 max_message_size=1048576):
+
+        # The loop needs to be set before the listener is initialized, since
+        # enabling stats will schedule a call on it.
+        self.loop = loop or asyncio.get_event_loop()
+        self.transport = None
+
+        ListenerUDP.__init__(self, app, threading=False, stats=stats,
+                             listen_address=listen_address,
+                             listen_port=listen_port, listen_type=listen_type,
+                             bufsize=bufsize, reuse_port=reuse_port, mtu=mtu,
+                             max_message_size=max_message_size)
+        self.sock.setblocking(False)
+
+    async def listen(self):
+        """Starts listening for datagrams on the event loop. This is a
+        coroutine and must be awaited.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: self, sock=self.sock)
+        self.listening = True
+
+    def stop(self):
+        """Stops listening for datagrams and closes the socket.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        self.listening = False
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+        logger.info("Shutting down the listener...")
+
+    def datagram_received(self, data, address):
+        if self.stats_enabled:
+            self.stats['bytes_recieved'] += len(data)
+        self.receive_datagram(data, address)
+
+    def error_received(self, error):
+        logger.info("Socket error: " + str(error))
+
+    def in_loop(self):
+        """Returns whether we are running in the event loop's thread."""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def call_later(self, time_seconds, callback, arguments):
+        """Schedules a function to be run x number of seconds from now on the
+        event loop.
+
+        Args:
+          time_seconds (float): The number of seconds from now we should call
+            the provided function.
+          callback (function): The method to execute when our time has been
+            reached. E.g. self.retransmit
+          arguments (dict): A dictionary of arguments to send to the callback.
+
+        Returns:
+          An asyncio.TimerHandle, or a ScheduledCall if called from another
+          thread, that can be used to cancel the call.
+
+        """
+
+        if self.in_loop():
+            return self.loop.call_later(time_seconds, callback, arguments)
+
+        scheduled_call = ScheduledCall(monotonic() + time_seconds, callback,
+                                       arguments)
+        self.loop.call_soon_threadsafe(self.loop.call_later, time_seconds,
+                                       self.run_scheduled, scheduled_call)
+        return scheduled_call
+
+    def run_scheduled(self, scheduled_call):
+        """Executes a call that was scheduled from another thread, unless it
+        has been cancelled since."""
+        if not scheduled_call.cancelled:
+            scheduled_call.callback(scheduled_call.args)
+
+    def send_datagram(self, message, address, message_type="unicast"):
+        """Sends a UDP datagram packet to the requested address through the
+        asyncio transport. See ListenerUDP.send_datagram.
+
+        Args:
+          message (str): The raw serialized packet data to send.
+          address (tuple): The address and port of the destination to send the
+            packet. E.g. (address, port)
+          message_type -- The type of packet to send. Can be "unicast",
+            "multicast", or "broadcast". Defaults to "unicast".
+
+        Returns:
+          None
+
+        """
+
+        if not self.in_loop():
+            self.loop.call_soon_threadsafe(self.send_datagram, message,
+                                           address, message_type)
+            return
+
+        # Messages that are too large for a single datagram are sent in
+        # fragments.
+        if self.mtu and len(message) > self.mtu and message_type == "unicast":
+            self.send_datagrams(self.fragments.split(message, address))
+            return
+
+        if self.bufsize != 0 and len(message) > self.bufsize:
+            raise Exception("Datagram is too large. Messages should be " +
+                            "under " + str(self.bufsize) + " bytes in size.")
+
+        if message_type == "broadcast":
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        elif message_type == "multicast":
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+
+        if not self.transport:
+            logger.error("Failed to send, the listener is not listening.")
+            return
+
+        logger.debug("Sending packet")
+        self.transport.sendto(message, address)
+        if self.stats_enabled:
+            self.stats['bytes_sent'] += len(message)
+
+    def send_datagrams(self, datagrams):
+        """Sends a batch of unicast UDP datagrams through the asyncio
+        transport. See ListenerUDP.send_datagrams.
+
+        Args:
+          datagrams (list): A list of (message, address) tuples to send.
+
+        Returns:
+          None
+
+        """
+
+        if not self.in_loop():
+            self.loop.call_soon_threadsafe(self.send_datagrams, datagrams)
+            return
+
+        if not self.transport:
+            logger.error("Failed to send, the listener is not listening.")
+            return
+
+        sendto = self.transport.sendto
+        sent = 0
+        for message, address in self.fragment(datagrams):
+            if self.bufsize and len(message) > self.bufsize:
+                logger.error("Datagram to %s is too large. Messages should be "
+                             "under %d bytes in size." % (str(address),
+                                                         self.bufsize))
+                continue
+            sendto(message, address)
+            sent += len(message)
+
+        if self.stats_enabled:
+            self.stats['bytes_sent'] += sent
+
+
+class AsyncNeteriaServer(NeteriaServer):
+    """A Neteria server that runs on an asyncio event loop. It takes the same
+    arguments as NeteriaServer, but "listen" is a coroutine that must be
+    awaited.
+
+    Unless another executor is given, LEGAL events are executed inline on the
+    event loop, so the middleware can use the server without any locking.
+
+    """
+
+    listener_class = AsyncListenerUDP
+
+    def __init__(self, middleware, executor=None, **kwargs):
+        NeteriaServer.__init__(self, middleware,
+                               executor=executor or EventExecutor(
+                                   mode="inline"),
+                               **kwargs)
+
+    async def listen(self):
+        """Starts the server listener on the event loop to listen for client
+        messages.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        logger.info("Listening on port " + str(self.listener.listen_port))
+        await self.listener.listen()
+
+
+class AsyncNeteriaClient(NeteriaClient):
+    """A Neteria client that runs on an asyncio event loop. It takes the same
+    arguments as NeteriaClient, but "listen" is a coroutine that must be
+    awaited.
+
+    """
+
+    listener_class = AsyncListenerUDP
+
+    async def listen(self):
+        """Starts the client listener on the event loop to listen for server
+        responses.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        logger.info("Listening on port " + str(self.listener.listen_port))
+        await self.listener.listen()
+
+    def listen_group(self):
+        """Starts the multicast group listener on the event loop."""
+        self.listener.loop.create_task(self.group_listener.listen())
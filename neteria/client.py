@@ -28,16 +28,30 @@ receiving messages to a Neteria server.
 You can run an example by running the following from the command line:
 `python -m neteria.client`"""
 
+import itertools
 import logging
 import random
+import threading
 import uuid
 
+from collections import deque
+
 from . import core
+from .codec import get_codec
+from .core import bundle_packets
+from .core import monotonic
 from .core import serialize_data
+from .core import RTTEstimator
 from .core import unserialize_data
+from .replication import Mirror
+from .stream import Streams
+from .window import ACK_BITS
+from .window import ReceiveWindow
 
 from datetime import datetime
+from neteria.encryption import AESGCM
 from neteria.encryption import Encryption
+from neteria.encryption import Session
 from pprint import pformat
 
 try:
@@ -71,6 +85,11 @@ class NeteriaClient(object):
       event_confirmations (dict): A list of events that were confirmed as
         "LEGAL" by the server.
       cuuid (str): The universally unique identifier of the client.
+      cid (int): The connection id the server assigned to us when we
+        registered. It is sent instead of the cuuid in every message.
+      replica (replication.Mirror): Our mirror of the states the server
+        replicates with "add_state". The states are in "replica.state" by
+        name.
 
     Args:
       version (str): A version number of your client that will be sent to the
@@ -86,15 +105,55 @@ class NeteriaClient(object):
         Compression is done on all messages with zlib compression. Defaults
         to "False".
       encryption (boolean): Whether or not encryption should be enabled.
-        Encryption is done on all messages with RSA encryption. Defaults to
-        "False".
+        The server sends us a session key encrypted with our RSA key when we
+        register, which is then used to encrypt all messages with AES-GCM.
+        If the session key is not supported, all messages are encrypted with
+        RSA instead. Defaults to "False".
       timeout (float): The amount of time to wait in seconds for a confirmation
-        before retrying to send the message. Defaults to 2.0 seconds.
+        before retrying to send the message, until the round trip time to the
+        server has been measured. The timeout is then adapted to the round
+        trip time, and doubled with every retry. Defaults to 2.0 seconds.
       max_retries (int): The maximum number of retry attempts the server should
         try before considering the message has failed. Defaults to 4.
       stats (boolean): Whether or not to keep track of network statistics
         such as total bytes sent/recieved. Defaults to False.
-
+      batch_size (int): The number of datagrams the listener should drain from
+        the socket at once under load. Defaults to 0, which receives one
+        datagram at a time. See core.ListenerUDP.
+      codec (str): The name of the codec the client would like to use to
+        encode messages, e.g. "json" or the compact "binary" codec. The codec
+        is negotiated with the server during registration, and json is used
+        if the server does not support it. Defaults to "json".
+      debug_ids (boolean): Whether or not to identify messages with uuid
+        strings instead of the connection id and sequence numbers. This makes
+        packets easier to follow while debugging, but larger. Defaults to
+        False.
+      ack_delay (float): The amount of time in seconds to wait before
+        acknowledging messages from the server, so several messages can be
+        acknowledged at once or with our next event. This should be well
+        below the server's timeout. Defaults to 0.05 seconds.
+      multicast (boolean): Whether or not to ask the server to deliver
+        broadcast NOTIFY messages through its multicast group, if it has one.
+        Multicast messages are not encrypted, so this is ignored when
+        encryption is enabled. Defaults to False.
+      batch_delay (float): If set, events are collected for this many
+        seconds and sent to the server together in a single packet, as if
+        they were sent with event_many. Defaults to None, which sends every
+        event right away.
+      min_timeout (float): The smallest adapted timeout in seconds. Defaults
+        to 0.1 seconds.
+      max_timeout (float): The largest timeout in seconds, including the
+        backoff of retries. Defaults to 30.0 seconds.
+      mtu (int): The largest datagram to send in bytes. Larger messages are
+        sent in fragments. Defaults to 1400. See core.ListenerUDP.
+      window_size (int): The maximum number of events that can be waiting
+        for a judgement from the server at once. Defaults to None, which
+        doesn't limit them.
+      window_policy (string): What to do with new events while the window is
+        full. "queue" keeps them and sends them as soon as there is room.
+        "block" waits until there is room, so it must not be used from the
+        thread that handles the server's messages. "reject" doesn't send
+        them. Defaults to "queue".
 
     Examples:
       >>> import neteria.client
@@ -106,25 +165,89 @@ class NeteriaClient(object):
 
     """
 
+    # The listener class used to send and receive messages.
+    listener_class = core.ListenerUDP
+
     def __init__(self, version="1.0.3", client_address='', client_port=None,
                  server_port=40080, compression=False, encryption=False,
-                 timeout=2.0, max_retries=4, stats=False):
+                 timeout=2.0, max_retries=4, stats=False, batch_size=0,
+                 codec="json", debug_ids=False, ack_delay=0.05,
+                 multicast=False, batch_delay=None, min_timeout=0.1,
+                 max_timeout=30.0, window_size=None, window_policy="queue",
+                 mtu=1400):
+        if window_policy not in ("queue", "block", "reject"):
+            raise ValueError("Unknown window policy: " + str(window_policy))
+
         self.version = version
         self.client_port = client_port
         self.server = None
         self.server_key = None      # Used to hold the public key of the server
+        self.session = None         # Used to hold the session key
         self.server_ip = None
         self.server_port = server_port
         self.autoregistering = False  # Whether or not to auto-register.
         self.discovered_servers = {}  # List of discovered servers.
         self.event_uuids = {}
+        self.retransmit_calls = {}  # Scheduled retransmits keyed by euuid.
         self.event_rollbacks = {}
         self.event_notifies = {}    # Notify events buffer received from server
         self.event_confirmations = {}   # Legal high priority events buffer
 
+        # Events are identified by a sequence number that increases with every
+        # event. It is never reset, so events sent after registering again
+        # can't be mistaken for earlier ones.
+        self.sequence = itertools.count(1)
+        self.last_sequence = 0
+        self.debug_ids = debug_ids
+
+        # Unreliable messages are numbered separately in each direction. For
+        # sequenced ones we keep the newest number received so older ones
+        # can be dropped.
+        self.unreliable_sequence = itertools.count(1)
+        self.latest_notify = 0
+
+        # The number of events sent that are still waiting for a judgement,
+        # and the events waiting for room in the window to be sent.
+        self.window_size = window_size
+        self.window_policy = window_policy
+        self.in_flight = 0
+        self.event_queue = deque()
+        self.window_condition = threading.Condition()
+
+        # Events waiting to be sent together in the next batch.
+        self.batch_delay = batch_delay
+        self.event_batch = []
+        self.batch_call = None
+        self.batch_lock = threading.Lock()
+
+        # Instead of confirming every message from the server, we acknowledge
+        # them in batches. For NOTIFY messages we keep the highest sequence
+        # number up to which we've received everything, plus a bitmap of the
+        # messages we've received after it.
+        self.acks = False   # Whether or not the server supports ACK messages.
+        self.ack_delay = ack_delay
+        self.ack_pending = False
+        self.ack_call = None
+        self.notify_window = ReceiveWindow()
+
+        # The multicast group the server sends broadcast NOTIFY messages to,
+        # if we've joined one. Missing group messages are requested again
+        # from the server with a NACK.
+        self.multicast = multicast
+        self.group = None
+        self.group_listener = None
+        self.group_window = None
+        self.nack_call = None
+        self.nack_retries = 0
+
         # Enable packet compression
         self.compression = compression
 
+        # The codec we want to use, and the codec the server agreed to use
+        # once we are registered. None means we are using json.
+        self.codec_name = codec
+        self.codec = None
+
         # Generate a keypair if encryption is enabled
         if encryption:
             self.encryption = Encryption()
@@ -143,17 +266,38 @@ class NeteriaClient(object):
         # one.
         self.cuuid = uuid.uuid1()
 
+        # How we identify ourselves in messages. Once the server has assigned
+        # us a connection id, it is sent instead of our cuuid.
+        self.cid = None
+        self.id_key = "cuuid"
+        self.id_value = str(self.cuuid)
+
         # Create a listener object that we can use to send and receive
         # messages.
-        self.listener = core.ListenerUDP(self, listen_address=client_address,
-                                         listen_port=self.client_port,
-                                         stats=stats)
+        self.listener = self.listener_class(self, listen_address=client_address,
+                                            listen_port=self.client_port,
+                                            stats=stats, batch_size=batch_size,
+                                            mtu=mtu)
 
         # Set a timeout and maximum number of retries for responses from the
         # server.
         self.timeout = timeout
         self.max_retries = max_retries
 
+        # Estimate the round trip time to the server from how long it takes
+        # to judge our events, to adapt the timeout to it. The times events
+        # were sent are kept until they're judged or retransmitted.
+        self.rtt = RTTEstimator(timeout, min_timeout, max_timeout)
+        self.sent_times = {}
+
+        # Large blobs sent to and received from the server in chunks.
+        self.streams = Streams(self.send_message, self.listener.call_later,
+                               max_retries, ack_delay, odd=False)
+
+        # The server's replicated states. Every STATE message we apply is
+        # acknowledged, so the server sends the next delta from it.
+        self.replica = Mirror()
+
 
     def listen(self):
         """Starts the client listener to listen for server responses.
@@ -204,31 +348,82 @@ class NeteriaClient(object):
 
                 if self.event_uuids[data["euuid"]]["retry"] > self.max_retries:
                     logger.debug("<%s> Max retries exceeded. Timed out waiting "
-                                  "for server for event: %s" % (data["cuuid"],
+                                  "for server for event: %s" % (str(self.cuuid),
                                                                 data["euuid"]))
                     logger.debug("<%s> <euuid:%s> Deleting event from currently "
-                                  "processing event uuids" % (data["cuuid"],
+                                  "processing event uuids" % (str(self.cuuid),
                                                               str(data["euuid"])))
                     del self.event_uuids[data["euuid"]]
+                    self.retransmit_calls.pop(data["euuid"], None)
+                    self.sent_times.pop(data["euuid"], None)
+                    self.release()
                 else:
-                    # Retransmit that shit
+                    # Retransmit that shit, with the id we were given if we've
+                    # registered again since it was first sent.
+                    data.pop("cid", None)
+                    data.pop("cuuid", None)
+                    data[self.id_key] = self.id_value
+                    if self.ack_pending:
+                        self.add_acks(data)
+                    self.sent_times.pop(data["euuid"], None)
                     self.listener.send_datagram(
                         serialize_data(data, self.compression,
-                                       self.encryption, self.server_key),
+                                       self.encryption, self.server_key,
+                                       self.codec, self.session),
                         self.server)
 
-                    # Then we set another schedule to check again
+                    # Then we set another schedule to check again, backing off
+                    # with every retry.
+                    timeout = self.rtt.timeout(data["retry"])
                     logger.debug("<%s> <euuid:%s> Scheduling to retry in %s "
-                                  "seconds" % (data["cuuid"],
+                                  "seconds" % (str(self.cuuid),
                                                str(data["euuid"]),
-                                               str(self.timeout)))
-                    self.listener.call_later(
-                        self.timeout, self.retransmit, data)
+                                               str(timeout)))
+                    self.retransmit_calls[data["euuid"]] = \
+                        self.listener.call_later(
+                            timeout, self.retransmit, data)
             else:
+                self.retransmit_calls.pop(data["euuid"], None)
                 logger.debug("<%s> <euuid:%s> No need to "
                               "retransmit." % (str(self.cuuid),
                                                str(data["euuid"])))
 
+        if data["method"] == "EVENTS":
+            # Only resend the events of the batch that haven't been judged.
+            events = [event for event in data["events"]
+                      if event[0] in self.event_uuids]
+            if not events:
+                logger.debug("<%s> No need to retransmit batch." %
+                             str(self.cuuid))
+                return
+
+            data["retry"] += 1
+            if data["retry"] > self.max_retries:
+                logger.debug("<%s> Max retries exceeded. Timed out waiting "
+                             "for server for batch of %d "
+                             "events" % (str(self.cuuid), len(events)))
+                for event in events:
+                    del self.event_uuids[event[0]]
+                    self.sent_times.pop(event[0], None)
+                self.release(len(events))
+                return
+
+            for event in events:
+                self.sent_times.pop(event[0], None)
+            data["events"] = events
+            data.pop("cid", None)
+            data.pop("cuuid", None)
+            data[self.id_key] = self.id_value
+            if self.ack_pending:
+                self.add_acks(data)
+            self.listener.send_datagram(
+                serialize_data(data, self.compression,
+                               self.encryption, self.server_key,
+                               self.codec, self.session),
+                self.server)
+            self.listener.call_later(self.rtt.timeout(data["retry"]),
+                                     self.retransmit, data)
+
 
     def handle_message(self, msg, host):
         """Processes messages that have been delivered from the transport
@@ -258,13 +453,27 @@ class NeteriaClient(object):
         # Unserialize the data packet
         # If encryption is enabled, and we've receive the server's public key
         # already, try to decrypt
-        if self.encryption and self.server_key:
+        if self.session and msg[:1] != Session.magic:
+            # With a session key, the server may only send registration and
+            # autodiscover responses unencrypted. A server that no longer
+            # knows us can't encrypt its BYE EVENT either.
+            msg_data = unserialize_data(msg, self.compression)
+            if msg_data and msg_data.get("method") not in (
+                    "OK REGISTER", "BYE REGISTER", "BYE EVENT", "OHAI Client"):
+                logger.warning("<%s> Unencrypted packet received from "
+                               "server" % str(self.cuuid))
+                return response
+        elif self.session:
+            msg_data = unserialize_data(msg, self.compression,
+                                        session=self.session)
+        elif self.encryption and self.server_key:
             msg_data = unserialize_data(msg, self.compression, self.encryption)
         else:
             msg_data = unserialize_data(msg, self.compression)
 
         # Log the packet
-        logger.debug("Packet received: " + pformat(msg_data))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Packet received: " + pformat(msg_data))
 
         # If the message data is blank, return none
         if not msg_data:
@@ -280,41 +489,171 @@ class NeteriaClient(object):
                     self.register(host)
                     self.autoregistering = False
 
+            elif (msg_data["method"] == "NOTIFY" and self.acks and
+                  isinstance(msg_data["euuid"], int)):
+                # Only keep the first copy of each notify, and acknowledge it
+                # along with any others we receive shortly. Notify messages
+                # with uuid strings as ids, from a server with "debug_ids",
+                # are confirmed one by one below.
+                if host != self.server:
+                    return response
+                received = self.notify_window.receive(msg_data["euuid"])
+                if received is None:
+                    logger.debug("<%s> Notify too far ahead dropped: "
+                                 "%s" % (self.cuuid, msg_data["euuid"]))
+                    return response
+                if received:
+                    self.event_notifies[msg_data["euuid"]] = msg_data["event_data"]
+                    logger.debug("<%s> Notify received" % self.cuuid)
+                self.schedule_ack()
+
+            elif msg_data["method"] == "GROUP NOTIFY" and host == self.server:
+                self.group_notify(msg_data)
+
+            elif (msg_data["method"] in ("STREAM", "STREAM ACK",
+                                         "STREAM CANCEL") and
+                  host == self.server):
+                self.streams.handle(self.server, msg_data)
+
+            elif msg_data["method"] == "STATE" and host == self.server:
+                if not self.replica.apply(msg_data):
+                    logger.debug("<%s> Stale state dropped" % self.cuuid)
+                self.schedule_ack()
+
+            elif (msg_data["method"] == "UNRELIABLE NOTIFY" and
+                  host == self.server):
+                # Drop sequenced messages that are older than the newest one
+                # we've received.
+                seq = msg_data["euuid"]
+                if msg_data.get("sequenced"):
+                    if seq <= self.latest_notify:
+                        logger.debug("<%s> Stale sequenced notify "
+                                     "dropped" % self.cuuid)
+                        return response
+                    self.latest_notify = seq
+                self.event_notifies[("unreliable", seq)] = msg_data["event_data"]
+
             elif msg_data["method"] == "NOTIFY":
                 self.event_notifies[msg_data["euuid"]] = msg_data["event_data"]
                 logger.debug("<%s> Notify received" % self.cuuid)
-                logger.debug("<%s> Notify event buffer: %s" % (self.cuuid,
-                    pformat(self.event_notifies)))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("<%s> Notify event buffer: %s" % (self.cuuid,
+                        pformat(self.event_notifies)))
 
                 # Send an OK NOTIFY to the server confirming we got the message
                 response = serialize_data(
-                    {"cuuid": str(self.cuuid),
+                    {self.id_key: self.id_value,
                      "method": "OK NOTIFY",
                      "euuid": msg_data["euuid"]},
-                    self.compression, self.encryption, self.server_key)
+                    self.compression, self.encryption, self.server_key,
+                    self.codec, self.session)
 
             elif msg_data["method"] == "OK REGISTER":
                 logger.debug("<%s> Ok register received" % self.cuuid)
                 self.registered = True
                 self.server = host
 
+                # Cancel the pending REGISTER retransmit.
+                scheduled_call = self.retransmit_calls.pop("REGISTER", None)
+                if scheduled_call:
+                    scheduled_call.cancel()
+
+                # Identify ourselves with the connection id the server gave
+                # us, if it supports them. Servers that give us a connection
+                # id also accept ACK messages.
+                cid = msg_data.get("cid")
+                if cid != self.cid:
+                    # A new connection numbers its notify messages from 1.
+                    self.notify_window = ReceiveWindow()
+                    self.latest_notify = 0
+                # The server sends a registering client the whole state.
+                self.replica.reset()
+                self.cid = cid
+                if self.cid is not None and not self.debug_ids:
+                    self.id_key = "cid"
+                    self.id_value = self.cid
+                    self.acks = True
+                else:
+                    self.id_key = "cuuid"
+                    self.id_value = str(self.cuuid)
+                    self.acks = False
+
+                # Use the codec that the server agreed to.
+                if "codec" in msg_data and msg_data["codec"] != "json":
+                    self.codec = get_codec(msg_data["codec"])
+                else:
+                    self.codec = None
+
                 # If the server sent us their public key, store it
                 if "encryption" in msg_data and self.encryption:
                     self.server_key = PublicKey(
                         msg_data["encryption"][0], msg_data["encryption"][1])
 
+                # If the server sent us a session key, use it to encrypt and
+                # decrypt all messages from now on.
+                if "session_key" in msg_data and self.encryption:
+                    self.session = Session(
+                        self.encryption.decrypt_key(msg_data["session_key"]),
+                        Session.CLIENT)
+
+                # Join the server's multicast group if it let us.
+                if "multicast" in msg_data:
+                    self.join_group(tuple(msg_data["multicast"]),
+                                    msg_data.get("group_seq", 0))
+
+            elif msg_data["method"] == "BYE EVENT":
+                # The server has evicted us, e.g. because we were idle for too
+                # long. Register again so future events are accepted.
+                if self.registered and host == self.server:
+                    logger.warning("<%s> Server no longer has us registered. "
+                                   "Registering again." % str(self.cuuid))
+                    self.registered = False
+                    self.streams.close(self.server)
+                    self.register(host)
+
+            elif msg_data["method"] == "VERDICT":
+                logger.debug("<%s> Batched legality message "
+                             "received" % str(self.cuuid))
+                judged = msg_data["legal"] + msg_data["illegal"]
+                for euuid in msg_data["legal"]:
+                    self.legal_check({"method": "LEGAL", "euuid": euuid,
+                                      "priority": msg_data["priority"]})
+                for euuid in msg_data["illegal"]:
+                    self.legal_check({"method": "ILLEGAL", "euuid": euuid,
+                                      "priority": msg_data["priority"]})
+
+                # Acknowledge the judgements, or confirm each of them with an
+                # OK EVENT, all sent in one bundle.
+                if self.acks:
+                    self.schedule_ack()
+                    return response
+
+                response = bundle_packets([
+                    serialize_data({self.id_key: self.id_value,
+                                    "method": "OK EVENT",
+                                    "euuid": euuid},
+                                   self.compression, self.encryption,
+                                   self.server_key, self.codec, self.session)
+                    for euuid in judged])
+
             elif (msg_data["method"] == "LEGAL" or
                   msg_data["method"] == "ILLEGAL"):
                 logger.debug("<%s> Legality message received" % str(self.cuuid))
                 self.legal_check(msg_data)
 
-                # Send an OK EVENT response to the server confirming we
-                # received the message
+                # Acknowledge the judgement along with any others we receive
+                # shortly, or send an OK EVENT response to the server
+                # confirming we received the message.
+                if self.acks:
+                    self.schedule_ack()
+                    return response
+
                 response = serialize_data(
-                    {"cuuid": str(self.cuuid),
+                    {self.id_key: self.id_value,
                      "method": "OK EVENT",
                      "euuid": msg_data["euuid"]},
-                    self.compression, self.encryption, self.server_key)
+                    self.compression, self.encryption, self.server_key,
+                    self.codec, self.session)
 
         logger.debug("Packet processing completed")
 
@@ -391,6 +730,16 @@ class NeteriaClient(object):
         # request
         if self.encryption:
             message["encryption"] = [self.encryption.n, self.encryption.e]
+            if AESGCM:
+                message["session"] = True
+
+        # Ask to receive broadcasts through the server's multicast group.
+        if self.multicast and not self.encryption:
+            message["multicast"] = True
+
+        # Ask the server to use our preferred codec.
+        if self.codec_name != "json":
+            message["codecs"] = [self.codec_name, "json"]
 
         # Send a REGISTER to the server
         self.listener.send_datagram(
@@ -403,18 +752,19 @@ class NeteriaClient(object):
 
         # Schedule a task to run in x seconds to check to see if we've timed
         # out in receiving a response from the server
-        self.listener.call_later(
+        self.retransmit_calls["REGISTER"] = self.listener.call_later(
             self.timeout, self.retransmit, {"method": "REGISTER",
                                             "address": address})
 
 
-    def event(self, event_data, priority="normal", event_method="EVENT"):
+    def event(self, event_data, priority="normal", event_method="EVENT",
+              reliability="reliable"):
         """This function will send event packets to the server. This is the
         main method you would use to send data from your application to the
         server.
 
-        Whenever an event is sent to the server, a universally unique event id
-        (euuid) is created for each event and stored in the "event_uuids"
+        Whenever an event is sent to the server, it is given the next sequence
+        number as its event id (euuid) and stored in the "event_uuids"
         dictionary. This dictionary contains a list of all events that are
         currently waiting for a response from the server. The event will only
         be removed from this dictionary if the server responds with LEGAL or
@@ -433,9 +783,20 @@ class NeteriaClient(object):
             wait for a response. Defaults to "normal".
           event_method (string): The type of event to send to the server. Valid
             methods are "EVENT", "AUTH". Defaults to "EVENT".
+          reliability (string): "reliable" events are retransmitted until the
+            server judges them. "unreliable" events are sent once, and the
+            server executes them if they are legal without replying, which
+            suits data that is sent often, such as positions. "sequenced"
+            events are unreliable events that the server drops if it has
+            already received a newer one, so only the latest value is used.
+            Defaults to "reliable".
 
         Returns:
-          A universally unique identifier (uuid) of the event.
+          The event id (euuid) of the event. This is a sequence number, or a
+          uuid string if "debug_ids" is enabled. Unreliable events are always
+          numbered with their own sequence. False if the event wasn't sent
+          because we aren't registered, or because the window is full and the
+          window policy is "reject".
 
         Examples:
           >>> event_data
@@ -445,48 +806,409 @@ class NeteriaClient(object):
 
         logger.debug("event: " + str(event_data))
 
-        # Generate an event UUID for this event
-        euuid = uuid.uuid1()
+        if reliability != "reliable":
+            return self.event_unreliable(event_data, reliability)
+
+        # Give this event the next sequence number as its id
+        if self.debug_ids:
+            euuid = str(uuid.uuid1())
+        else:
+            euuid = next(self.sequence)
+            self.last_sequence = euuid
         logger.debug("<%s> <euuid:%s> Sending event data to server: "
-               "%s" % (str(self.cuuid), str(euuid), str(self.server)))
+               "%s" % (str(self.cuuid), euuid, str(self.server)))
         if not self.listener.listening:
             logger.warning("Neteria client is not listening.")
 
         # If we're not even registered, don't even bother.
         if not self.registered:
             logger.warning("<%s> <euuid:%s> Client is currently not registered. "
-                            "Event not sent." % (str(self.cuuid), str(euuid)))
+                            "Event not sent." % (str(self.cuuid), euuid))
             return False
 
         # Send the event data to the server
         packet = {"method": event_method,
-                  "cuuid": str(self.cuuid),
-                  "euuid": str(euuid),
+                  self.id_key: self.id_value,
+                  "euuid": euuid,
                   "event_data": event_data,
                   "timestamp": str(datetime.now()),
                   "retry": 0,
                   "priority": priority}
 
+        # Set the sent event to our event buffer to see if we need to roll back
+        # or anything. This has to happen before sending, since the server's
+        # judgement can arrive before send_datagram returns.
+        self.event_uuids[euuid] = packet
+
+        # Only send the event if there is room in our window of events waiting
+        # for a judgement. Otherwise it is queued until there is.
+        if event_method == "EVENT" and not self.reserve(packet):
+            if self.window_policy == "reject":
+                logger.warning("<%s> <euuid:%s> Window is full. Event not "
+                               "sent." % (str(self.cuuid), euuid))
+                del self.event_uuids[euuid]
+                return False
+            return euuid
+
+        # Send the event with the next batch if we're batching events.
+        if self.batch_delay and event_method == "EVENT":
+            with self.batch_lock:
+                self.event_batch.append(packet)
+                if not self.batch_call:
+                    self.batch_call = self.listener.call_later(
+                        self.batch_delay, self.send_batch, None)
+            return euuid
+
+        self.send_event(packet)
+
+        return euuid
+
+
+    def send_event(self, packet):
+        """Sends an event from our event buffer to the server, and schedules
+        it to be retransmitted if it isn't judged in time.
+
+        Args:
+          packet (dict): The event packet to send.
+
+        Returns:
+          None
+
+        """
+
+        euuid = packet["euuid"]
+
+        # Acknowledge any messages we've received from the server with this
+        # event instead of sending a separate ACK.
+        if self.ack_pending:
+            self.add_acks(packet)
+
+        # Now we need to reschedule a timeout/retransmit check
+        logger.debug("<%s> Scheduling retry in %s seconds" % (str(self.cuuid),
+                                                               str(self.rtt.rto)))
+        self.retransmit_calls[euuid] = self.listener.call_later(
+            self.rtt.rto, self.retransmit, packet)
+        self.sent_times[euuid] = monotonic()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("<%s> Sending EVENT Packet: %s" % (str(self.cuuid),
+                                                             pformat(packet)))
         self.listener.send_datagram(
             serialize_data(packet, self.compression,
-                           self.encryption, self.server_key),
+                           self.encryption, self.server_key, self.codec,
+                           self.session),
             self.server)
 
-        logger.debug("<%s> Sending EVENT Packet: %s" % (str(self.cuuid),
-                                                         pformat(packet)))
 
-        # Set the sent event to our event buffer to see if we need to roll back
-        # or anything
-        self.event_uuids[str(euuid)] = packet
+    def reserve(self, packet):
+        """Takes a place in the window of events waiting for a judgement for
+        an event that is about to be sent. If the window is full, the event
+        is queued, rejected or we wait for room depending on the window
+        policy.
 
-        # Now we need to reschedule a timeout/retransmit check
-        logger.debug("<%s> Scheduling retry in %s seconds" % (str(self.cuuid),
-                                                               str(self.timeout)))
-        self.listener.call_later(self.timeout, self.retransmit, packet)
+        Args:
+          packet (dict): The event packet that is about to be sent.
+
+        Returns:
+          True if the event can be sent now, or False if it was queued or
+          should be rejected.
+
+        """
+
+        if not self.window_size:
+            return True
+
+        with self.window_condition:
+            if self.window_policy == "block":
+                while self.in_flight >= self.window_size:
+                    self.window_condition.wait()
+            elif self.in_flight >= self.window_size or self.event_queue:
+                if self.window_policy == "queue":
+                    self.event_queue.append(packet)
+                return False
+
+            self.in_flight += 1
+            return True
+
+
+    def release(self, count=1):
+        """Frees places in the window of events waiting for a judgement, and
+        sends queued events that now fit in the window.
+
+        Args:
+          count (int): The number of events that were judged or given up on.
+            Defaults to 1.
+
+        Returns:
+          None
+
+        """
+
+        if not self.window_size:
+            return
+
+        released = []
+        with self.window_condition:
+            self.in_flight = max(self.in_flight - count, 0)
+            while self.event_queue and self.in_flight < self.window_size:
+                released.append(self.event_queue.popleft())
+                self.in_flight += 1
+            self.window_condition.notify_all()
+
+        for packet in released:
+            self.send_event(packet)
+
+
+    def send_stream(self, source, name=None, chunk_size=1024, window_size=64,
+                    callback=None):
+        """Sends a large blob to the server in chunks. See
+        NeteriaServer.send_stream.
+
+        Args:
+          source (file or memoryview): A file-like object to read the blob
+            from, or an object supporting the buffer protocol such as bytes
+            or a memoryview.
+          name (string): The name of the stream, which the server uses to
+            pick its sink. Defaults to None.
+          chunk_size (int): The number of bytes to send in each message.
+            Defaults to 1024.
+          window_size (int): The number of chunks that can be in flight.
+            Defaults to 64.
+          callback (function): Called with the stream id and True once the
+            server has received the whole blob, or False if the stream
+            failed. Defaults to None.
+
+        Returns:
+          The id of the stream, or False if we aren't registered.
+
+        """
+
+        if not self.registered:
+            logger.warning("<%s> Client is currently not registered. Stream "
+                           "not sent." % str(self.cuuid))
+            return False
+
+        # Json can't encode bytes, so the chunks are sent as base64 text.
+        text = getattr(self.codec, "name", "json") == "json"
+        return self.streams.open(self.server, source, self.rtt, name,
+                                 chunk_size, window_size, text, callback)
+
+
+    def receive_stream(self, sink, name=None, callback=None):
+        """Sets where the blobs that the server sends with "send_stream" are
+        written to.
+
+        Args:
+          sink (file): A writable file-like object, or a function that is
+            called with the server's address and the name of each new stream
+            and returns one.
+          name (string): The name of the streams to write to the sink. If
+            None, the sink receives every stream that no other sink was set
+            for. Defaults to None.
+          callback (function): Called with the server's address, the name of
+            the stream and its size in bytes once a stream has been received.
+            Defaults to None.
+
+        Returns:
+          None
+
+        Examples:
+          >>> myclient.receive_stream(open("level.dat", "wb"), name="level")
+
+        """
+
+        self.streams.listen(sink, name, callback)
+
+
+    def send_message(self, address, message):
+        """Serializes a message for the server and sends it."""
+        message[self.id_key] = self.id_value
+        self.listener.send_datagram(
+            serialize_data(message, self.compression, self.encryption,
+                           self.server_key, self.codec, self.session),
+            address)
+
+
+    def event_unreliable(self, event_data, reliability):
+        """Sends an event to the server without waiting for a judgement or
+        ever retransmitting it. See event.
+
+        Args:
+          event_data (any): The event data to send to the server.
+          reliability (string): Either "unreliable" or "sequenced".
+
+        Returns:
+          The unreliable sequence number of the event.
+
+        """
+
+        if reliability not in ("unreliable", "sequenced"):
+            raise ValueError("Unknown reliability: " + str(reliability))
+
+        if not self.registered:
+            logger.warning("<%s> Client is currently not registered. "
+                           "Event not sent." % str(self.cuuid))
+            return False
+
+        euuid = next(self.unreliable_sequence)
+        packet = {"method": "UNRELIABLE EVENT",
+                  self.id_key: self.id_value,
+                  "euuid": euuid,
+                  "event_data": event_data}
+        if reliability == "sequenced":
+            packet["sequenced"] = True
+
+        # Unreliable events can still carry our acknowledgements.
+        if self.ack_pending:
+            self.add_acks(packet)
+
+        self.listener.send_datagram(
+            serialize_data(packet, self.compression,
+                           self.encryption, self.server_key, self.codec,
+                           self.session),
+            self.server)
 
         return euuid
 
 
+    def event_many(self, events, priority="normal"):
+        """Sends several events to the server in a single packet. The server
+        judges each event separately, and replies with the judgements of all
+        of them in a single message. See event.
+
+        Args:
+          events (list): The event data of each event to send to the server.
+          priority (string): The priority of all of the events. See event.
+            Defaults to "normal".
+
+        Returns:
+          A list of the event ids (euuid) of the events, in the same order.
+          Events that were rejected because the window is full are left out.
+
+        Examples:
+          >>> myclient.event_many(["KEYDOWN:up", "KEYDOWN:left"])
+          [12, 13]
+
+        """
+
+        # If we're not even registered, don't even bother.
+        if not self.registered:
+            logger.warning("<%s> Client is currently not registered. Events "
+                           "not sent." % str(self.cuuid))
+            return False
+
+        packets = []
+        euuids = []
+        timestamp = str(datetime.now())
+        for event_data in events:
+            if self.debug_ids:
+                euuid = str(uuid.uuid1())
+            else:
+                euuid = next(self.sequence)
+                self.last_sequence = euuid
+
+            # Each event is kept in our event buffer on its own, just like
+            # events sent with "event".
+            packet = {"method": "EVENT",
+                      self.id_key: self.id_value,
+                      "euuid": euuid,
+                      "event_data": event_data,
+                      "timestamp": timestamp,
+                      "retry": 0,
+                      "priority": priority}
+            self.event_uuids[euuid] = packet
+
+            # Send what we have so far before waiting for room in the window,
+            # since those events take up room until they are judged.
+            if (packets and self.window_policy == "block" and
+                    self.window_size and self.in_flight >= self.window_size):
+                self.send_events(packets)
+                packets = []
+
+            if self.reserve(packet):
+                packets.append(packet)
+            elif self.window_policy == "reject":
+                del self.event_uuids[euuid]
+                continue
+            euuids.append(euuid)
+
+        if packets:
+            self.send_events(packets)
+
+        return euuids
+
+
+    def send_batch(self, data=None):
+        """Sends the events that were collected while batching events.
+
+        Args:
+          data: Unused. Needed to be scheduled with call_later.
+
+        Returns:
+          None
+
+        """
+
+        with self.batch_lock:
+            batch = self.event_batch
+            self.event_batch = []
+            self.batch_call = None
+
+        # Events are sent in separate packets for each priority.
+        priorities = {}
+        for packet in batch:
+            priorities.setdefault(packet["priority"], []).append(packet)
+        for packets in priorities.values():
+            self.send_events(packets)
+
+
+    def send_events(self, packets):
+        """Sends a number of events to the server in an EVENTS packet, and
+        schedules a single retransmit of the events that aren't judged in
+        time. Batches that don't fit in a datagram are split in half.
+
+        Args:
+          packets (list): The event packets stored in our event buffer.
+
+        Returns:
+          None
+
+        """
+
+        batch = {"method": "EVENTS",
+                 self.id_key: self.id_value,
+                 "events": [[packet["euuid"], packet["event_data"]]
+                            for packet in packets],
+                 "timestamp": str(datetime.now()),
+                 "retry": 0,
+                 "priority": packets[0]["priority"]}
+
+        # Acknowledge any messages we've received from the server with the
+        # batch instead of sending a separate ACK.
+        ack_pending = self.ack_pending
+        if ack_pending:
+            self.add_acks(batch)
+
+        message = serialize_data(batch, self.compression,
+                                 self.encryption, self.server_key, self.codec,
+                                 self.session)
+        limit = self.listener.mtu or self.listener.bufsize
+        if len(packets) > 1 and limit and len(message) > limit:
+            self.ack_pending = ack_pending
+            half = len(packets) // 2
+            self.send_events(packets[:half])
+            self.send_events(packets[half:])
+            return
+
+        logger.debug("<%s> Sending batch of %d events to "
+                     "server" % (str(self.cuuid), len(packets)))
+        now = monotonic()
+        for packet in packets:
+            self.sent_times[packet["euuid"]] = now
+        self.listener.call_later(self.rtt.rto, self.retransmit, batch)
+        self.listener.send_datagram(message, self.server)
+
+
     def legal_check(self, message):
         """This method handles event legality check messages from the server.
 
@@ -502,6 +1224,26 @@ class NeteriaClient(object):
 
         """
 
+        # If we've already handled this judgement, the server just didn't get
+        # our acknowledgement.
+        if message["euuid"] not in self.event_uuids:
+            logger.debug("<%s> <euuid:%s> Duplicate judgement "
+                         "received." % (str(self.cuuid), message["euuid"]))
+            return
+
+        packet = self.event_uuids[message["euuid"]]
+
+        # We have our judgement, so cancel any pending retransmit of the event.
+        scheduled_call = self.retransmit_calls.pop(message["euuid"], None)
+        if scheduled_call:
+            scheduled_call.cancel()
+
+        # Measure the round trip time to the server, unless the event was
+        # retransmitted.
+        sent = self.sent_times.pop(message["euuid"], None)
+        if sent is not None:
+            self.rtt.sample(monotonic() - sent)
+
         # If the event was legal, remove it from our event buffer
         if message["method"] == "LEGAL":
             logger.debug("<%s> <euuid:%s> Event LEGAL" % (str(self.cuuid),
@@ -542,6 +1284,220 @@ class NeteriaClient(object):
                 message["euuid"]] = self.event_uuids[message["euuid"]]
             del self.event_uuids[message["euuid"]]
 
+        # The event no longer takes up room in our window once it's judged.
+        if packet["method"] == "EVENT":
+            self.release()
+
+
+    def add_acks(self, packet):
+        """Adds our acknowledgements of the server's judgements and NOTIFY
+        messages to a packet.
+
+        Judgements are acknowledged up to the oldest event that we are still
+        waiting on, plus a bitmap of the newer events that have been judged.
+
+        Args:
+          packet (dict): The packet to add the acknowledgements to.
+
+        Returns:
+          None
+
+        """
+
+        self.ack_pending = False
+        scheduled_call = self.ack_call
+        if scheduled_call:
+            self.ack_call = None
+            scheduled_call.cancel()
+
+        waiting = [seq for seq in self.event_uuids if type(seq) is int]
+        if waiting:
+            cumulative = min(waiting) - 1
+        else:
+            cumulative = self.last_sequence
+        bits = 0
+        for seq in range(cumulative + 1,
+                         min(self.last_sequence, cumulative + ACK_BITS) + 1):
+            if seq not in self.event_uuids:
+                bits |= 1 << (seq - cumulative - 1)
+
+        packet["ack_events"] = [cumulative, bits]
+        packet["ack_notifies"] = [self.notify_window.cumulative,
+                                  self.notify_window.bits]
+        if self.replica.replicating:
+            packet["ack_state"] = self.replica.seq
+
+
+    def schedule_ack(self):
+        """Schedules an ACK to be sent shortly, unless one is already
+        scheduled. If we send an event in the meantime, the acknowledgements
+        are sent along with it instead."""
+        self.ack_pending = True
+        if not self.ack_call:
+            self.ack_call = self.listener.call_later(self.ack_delay,
+                                                     self.send_acks, None)
+
+
+    def send_acks(self, data=None):
+        """Sends an ACK to the server acknowledging every judgement and NOTIFY
+        message we've received that hasn't been acknowledged yet.
+
+        Args:
+          data: Unused. Needed to be scheduled with call_later.
+
+        Returns:
+          None
+
+        """
+
+        self.ack_call = None
+        if not self.ack_pending or not self.server:
+            return
+
+        packet = {"method": "ACK", self.id_key: self.id_value}
+        self.add_acks(packet)
+        self.listener.send_datagram(
+            serialize_data(packet, self.compression,
+                           self.encryption, self.server_key, self.codec,
+                           self.session),
+            self.server)
+
+
+    def stats(self):
+        """Returns the statistics of the client.
+
+        Args:
+          None
+
+        Returns:
+          A dictionary with the listener's network statistics if they are
+          enabled, the round trip time estimate of the server as "srtt",
+          "rttvar" and "rto", the number of events waiting for a judgement
+          as "in_flight" and for room in the window as "queued", the number
+          of messages sent and received in fragments as "fragments", the
+          number of streams being sent and received as "streams", and the
+          number of the latest state snapshot we've applied as "state".
+
+        """
+
+        stats = {}
+        if self.listener.stats_enabled:
+            stats.update(self.listener.stats)
+        stats.update(self.rtt.stats())
+        stats["in_flight"] = len(self.event_uuids) - len(self.event_queue)
+        stats["queued"] = len(self.event_queue)
+        stats["fragments"] = dict(self.listener.fragments.stats)
+        stats["streams"] = self.streams.stats()
+        stats["state"] = self.replica.seq
+
+        return stats
+
+
+    def join_group(self, group, seq):
+        """Starts listening for NOTIFY messages sent to the server's multicast
+        group.
+
+        Args:
+          group (tuple): The (address, port) of the multicast group.
+          seq (int): The sequence number of the last message the server sent
+            to the group before we joined.
+
+        Returns:
+          None
+
+        """
+
+        if group == self.group:
+            return
+
+        logger.info("<%s> Joining multicast group %s" % (str(self.cuuid),
+                                                        str(group)))
+        self.group = group
+        self.group_window = ReceiveWindow(seq)
+        self.group_listener = self.listener_class(
+            self, listen_address=group[0], listen_port=group[1],
+            listen_type="multicast")
+        self.listen_group()
+
+
+    def listen_group(self):
+        """Starts the multicast group listener."""
+        self.group_listener.listen()
+
+
+    def group_notify(self, msg_data):
+        """Handles a NOTIFY message sent to the multicast group, or resent to
+        us after we asked for it with a NACK.
+
+        Args:
+          msg_data (dict): The unserialized GROUP NOTIFY message.
+
+        Returns:
+          None
+
+        """
+
+        if not self.group_window:
+            return
+
+        seq = msg_data["euuid"]
+        cumulative = self.group_window.cumulative
+        received = self.group_window.receive(seq)
+        if received is None:
+            logger.debug("<%s> Group notify too far ahead dropped: "
+                         "%s" % (self.cuuid, seq))
+            return
+        if received:
+            # Group messages are numbered separately from our own notifies.
+            self.event_notifies[("group", seq)] = msg_data["event_data"]
+            logger.debug("<%s> Group notify received" % self.cuuid)
+        if self.group_window.cumulative > cumulative:
+            self.nack_retries = 0
+
+        # If we've missed any messages, ask for them again shortly, unless
+        # they arrive out of order in the meantime.
+        if self.group_window.bits and not self.nack_call:
+            self.nack_call = self.listener.call_later(self.ack_delay,
+                                                      self.send_nack, None)
+
+
+    def send_nack(self, data=None):
+        """Asks the server to resend the multicast group messages we've
+        missed, and checks again later until they arrive.
+
+        Args:
+          data: Unused. Needed to be scheduled with call_later.
+
+        Returns:
+          None
+
+        """
+
+        self.nack_call = None
+        missing = self.group_window.missing() if self.group_window else []
+        if not missing or not self.registered:
+            self.nack_retries = 0
+            return
+
+        # Stop waiting for messages the server wasn't able to resend.
+        if self.nack_retries >= self.max_retries:
+            logger.warning("<%s> Giving up on missing group messages: "
+                           "%s" % (str(self.cuuid), str(missing)))
+            self.group_window.skip()
+            self.nack_retries = 0
+            return
+
+        self.nack_retries += 1
+        packet = {"method": "NACK", self.id_key: self.id_value,
+                  "missing": missing}
+        self.listener.send_datagram(
+            serialize_data(packet, self.compression,
+                           self.encryption, self.server_key, self.codec,
+                           self.session),
+            self.server)
+        self.nack_call = self.listener.call_later(
+            self.rtt.timeout(self.nack_retries), self.send_nack, None)
+
 
 # For testing you can run:
 # sudo sendip -p ipv4 -is 127.0.0.1 -p udp -us 5070 -ud 10858 -d
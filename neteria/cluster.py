@@ -0,0 +1,400 @@
+#!/usr/bin/python
+#
+# Neteria
+# Copyright (C) 2014, William Edwards <shadowapex@gmail.com>,
+#
+# This file is part of Neteria.
+#
+# Neteria is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neteria is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neteria.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contributor(s):
+#
+# William Edwards <shadowapex@gmail.com>
+# Derek Clark <derekjohn.clark@gmail.com>
+#
+"""The cluster module allows a Neteria server to scale across several CPU
+cores by running multiple server processes on the same port.
+
+Each worker process runs its own NeteriaServer bound with SO_REUSEPORT. The
+kernel hashes the address of each incoming datagram to pick a worker, so every
+packet from a given client (host, port) is always delivered to the same
+worker. This keeps the registry, duplicate event checks and retransmits for a
+client local to a single worker.
+
+The parent process keeps a control pipe to every worker, which is used to
+deliver NOTIFY messages to clients registered with any worker and to collect
+statistics from all workers.
+
+Examples:
+  >>> from neteria.cluster import NeteriaCluster
+  >>> from neteria.tools import _Middleware
+  >>>
+  >>> cluster = NeteriaCluster(_Middleware, workers=4)
+  >>> cluster.start()
+  >>> cluster.notify(cuuid, {"hello": "world"})
+  >>> cluster.stats()
+
+"""
+
+import logging
+import multiprocessing
+import socket
+import threading
+
+from multiprocessing.connection import wait
+
+from .server import NeteriaServer
+
+# Create a logger for optional handling of debug messages.
+logger = logging.getLogger(__name__)
+
+
+class NeteriaCluster(object):
+    """Starts and controls a number of NeteriaServer worker processes that
+    share the same port.
+
+    Args:
+      middleware_factory (function): A callable that returns a new middleware
+        instance. It is called once inside of each worker process, so it must
+        be picklable, e.g. a middleware class or a module level function.
+      workers (int): The number of worker processes to start. Defaults to the
+        number of CPUs.
+      stats_timeout (float): The amount of time in seconds to wait for
+        workers to reply with their statistics. Defaults to 2.0 seconds.
+      **server_options: Any other keyword arguments will be passed to the
+        NeteriaServer of each worker. Note that the "registration_limit"
+        applies to each worker separately.
+
+    """
+
+    def __init__(self, middleware_factory, workers=None, stats_timeout=2.0,
+                 **server_options):
+
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise Exception("Cluster mode requires SO_REUSEPORT, which is not "
+                            "supported on this platform.")
+
+        self.middleware_factory = middleware_factory
+        self.workers = workers or multiprocessing.cpu_count()
+        self.stats_timeout = stats_timeout
+        self.server_options = server_options
+        self.processes = []
+        self.connections = []
+        self.send_locks = []
+        self.lost = set()   # Connections to workers that have exited.
+        self.relay_thread = None
+        self.running = False
+
+        # Statistics replies from the workers keyed by worker index.
+        self.worker_stats = {}
+        self.stats_condition = threading.Condition()
+
+    def start(self):
+        """Starts all of the worker processes and a thread that relays control
+        messages between them.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        self.running = True
+        for index in range(self.workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(index, child_conn, self.middleware_factory,
+                      self.server_options))
+            process.daemon = True
+            process.start()
+
+            self.processes.append(process)
+            self.connections.append(parent_conn)
+            self.send_locks.append(threading.Lock())
+
+        logger.info("Started %d cluster workers" % self.workers)
+
+        self.relay_thread = threading.Thread(target=self.relay_loop)
+        self.relay_thread.daemon = True
+        self.relay_thread.start()
+
+    def stop(self):
+        """Stops all of the worker processes.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        self.running = False
+        for index in range(len(self.connections)):
+            self.send(index, ("stop",))
+        for process in self.processes:
+            process.join()
+
+        logger.info("Cluster workers stopped")
+
+    def send(self, index, command):
+        """Sends a control command to a worker.
+
+        Args:
+          index (int): The index of the worker to send the command to.
+          command (tuple): The command to send.
+
+        Returns:
+          None
+
+        """
+
+        if self.connections[index] in self.lost:
+            return
+
+        try:
+            with self.send_locks[index]:
+                self.connections[index].send(command)
+        except (EOFError, IOError, OSError):
+            logger.warning("Cluster worker %d is not running" % index)
+
+    def relay_loop(self):
+        """Receives control messages from the workers. NOTIFY requests from a
+        worker are relayed to all other workers, and statistics replies are
+        stored so "stats" can aggregate them.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        while self.running:
+            live = [conn for conn in self.connections if conn not in self.lost]
+            for conn in wait(live, timeout=0.5):
+                index = self.connections.index(conn)
+                try:
+                    command = conn.recv()
+                except (EOFError, IOError, OSError):
+                    logger.warning("Lost connection to cluster worker %d" % index)
+                    self.lost.add(conn)
+                    continue
+
+                if command[0] in ("notify", "notify_all"):
+                    for other in range(len(self.connections)):
+                        if other != index:
+                            self.send(other, command)
+
+                elif command[0] == "stats":
+                    with self.stats_condition:
+                        self.worker_stats[index] = command[1]
+                        self.stats_condition.notify_all()
+
+    def notify(self, cuuid, event_data):
+        """Sends a NOTIFY event to a client registered with any worker. Only
+        the worker that has the client registered will send the message.
+
+        Args:
+          cuuid (string): The client uuid to send the event data to.
+          event_data (any): The event data that we will be sending to the
+            client.
+
+        Returns:
+          None
+
+        """
+
+        for index in range(len(self.connections)):
+            self.send(index, ("notify", cuuid, event_data))
+
+    def notify_all(self, event_data):
+        """Sends a NOTIFY event to every client registered with any worker.
+
+        Args:
+          event_data (any): The event data that we will be sending to the
+            clients.
+
+        Returns:
+          None
+
+        """
+
+        for index in range(len(self.connections)):
+            self.send(index, ("notify_all", event_data))
+
+    def stats(self):
+        """Collects statistics from all of the workers.
+
+        Args:
+          None
+
+        Returns:
+          A dictionary with the totals of all numeric statistics over all
+          workers, plus a "workers" list with the statistics of each worker.
+
+        Examples:
+          >>> cluster.stats()
+          {'registered': 120, 'events': 4, 'bytes_sent': 102400, ...,
+           'workers': [{'registered': 61, ...}, {'registered': 59, ...}]}
+
+        """
+
+        with self.stats_condition:
+            self.worker_stats = {}
+            for index in range(len(self.connections)):
+                self.send(index, ("stats",))
+            self.stats_condition.wait_for(
+                lambda: len(self.worker_stats) >=
+                len(self.connections) - len(self.lost),
+                self.stats_timeout)
+            worker_stats = [self.worker_stats[index]
+                            for index in sorted(self.worker_stats)]
+
+        totals = {"workers": worker_stats}
+        for stats in worker_stats:
+            for key, value in stats.items():
+                if isinstance(value, (int, float)):
+                    totals[key] = totals.get(key, 0) + value
+
+        return totals
+
+
+class ClusterWorker(object):
+    """The worker side of the control channel. Each worker's NeteriaServer has
+    an instance of this class set as its "cluster" attribute, so the
+    middleware can notify clients registered with other workers.
+
+    Args:
+      index (int): The index of this worker.
+      conn (multiprocessing.Connection): The control pipe to the parent.
+      server (NeteriaServer): The server running in this worker.
+
+    """
+
+    def __init__(self, index, conn, server):
+        self.index = index
+        self.conn = conn
+        self.server = server
+        self.send_lock = threading.Lock()
+
+    def send(self, command):
+        with self.send_lock:
+            self.conn.send(command)
+
+    def notify(self, cuuid, event_data):
+        """Sends a NOTIFY event to a client, no matter which worker it is
+        registered with.
+
+        Args:
+          cuuid (string): The client uuid to send the event data to.
+          event_data (any): The event data that we will be sending to the
+            client.
+
+        Returns:
+          None
+
+        """
+
+        if cuuid in self.server.registry:
+            self.server.notify(cuuid, event_data)
+        else:
+            self.send(("notify", cuuid, event_data))
+
+    def notify_all(self, event_data):
+        """Sends a NOTIFY event to every client registered with any worker.
+
+        Args:
+          event_data (any): The event data that we will be sending to the
+            clients.
+
+        Returns:
+          None
+
+        """
+
+        self.server.notify_all(event_data)
+        self.send(("notify_all", event_data))
+
+    def stats(self):
+        """Returns the statistics of this worker.
+
+        Args:
+          None
+
+        Returns:
+          A dictionary of statistics.
+
+        """
+
+        return self.server.stats()
+
+    def run(self):
+        """Processes control commands from the parent until told to stop.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        while True:
+            try:
+                command = self.conn.recv()
+            except (EOFError, IOError, OSError):
+                break
+
+            if command[0] == "notify":
+                if command[1] in self.server.registry:
+                    self.server.notify(command[1], command[2])
+
+            elif command[0] == "notify_all":
+                self.server.notify_all(command[1])
+
+            elif command[0] == "stats":
+                self.send(("stats", self.stats()))
+
+            elif command[0] == "stop":
+                break
+
+        self.server.listener.listening = False
+        logger.info("Cluster worker %d shutting down" % self.index)
+
+
+def run_worker(index, conn, middleware_factory, server_options):
+    """The entry point of each worker process. Starts a NeteriaServer bound
+    with SO_REUSEPORT and processes control commands from the parent.
+
+    Args:
+      index (int): The index of this worker.
+      conn (multiprocessing.Connection): The control pipe to the parent.
+      middleware_factory (function): A callable that returns the middleware.
+      server_options (dict): Keyword arguments for the NeteriaServer.
+
+    Returns:
+      None
+
+    """
+
+    server = NeteriaServer(middleware_factory(), reuse_port=True,
+                           **server_options)
+    server.cluster = ClusterWorker(index, conn, server)
+    server.listen()
+    server.cluster.run()
@@ -0,0 +1,620 @@
+#!/usr/bin/python
+#
+# Neteria
+# Copyright (C) 2014, William Edwards <shadowapex@gmail.com>,
+#
+# This file is part of Neteria.
+#
+# Neteria is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neteria is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neteria.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contributor(s):
+#
+# William Edwards <shadowapex@gmail.com>
+# Derek Clark <derekjohn.clark@gmail.com>
+#
+"""The codec module contains the codecs used to convert Neteria messages to
+and from the bytes sent over the network.
+
+By default messages are encoded with json. Clients can also ask to use the
+compact "binary" codec when they register with the server. Binary messages
+start with a fixed header containing the message method, flags and the
+connection and event ids, followed by the rest of the message packed in a
+compact tagged binary format.
+
+Every codec has a "name" used to negotiate it during registration, and
+codecs other than json have a "magic" first byte so received messages can
+be decoded without knowing in advance which codec the sender used.
+
+Codecs can also encode a single value ahead of time with "encode_value", so
+the same value can be included in many messages without encoding it again.
+
+Arrays in messages, i.e. array.array, memoryviews and NumPy arrays if NumPy
+is installed, are packed by the binary codec as their raw buffer with a
+dtype and shape header. They are decoded as NumPy arrays, or memoryviews if
+NumPy isn't installed, that are views over the received message, so no
+Python object is created per element. The json codec sends arrays as lists.
+
+Examples:
+  >>> from neteria.codec import get_codec
+  >>> codec = get_codec("binary")
+  >>> data = codec.encode({"method": "EVENT", "event_data": "KEYDOWN:up"})
+  >>> codec.decode(data)
+  {'method': 'EVENT', 'event_data': 'KEYDOWN:up'}
+
+"""
+
+import array
+import codecs
+import json
+import struct
+import sys
+import uuid
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def to_json(value):
+    """Converts arrays to lists for json, which can't encode raw buffers.
+    Used as the "default" function of json.dumps."""
+    if numpy is not None and isinstance(value, (numpy.ndarray, memoryview)):
+        return numpy.asarray(value).tolist()
+    if isinstance(value, (array.array, memoryview)):
+        return value.tolist()
+    raise TypeError("Object of type %s is not JSON serializable" %
+                    type(value).__name__)
+
+
+class JSONCodec(object):
+    """Encodes and decodes messages using json."""
+
+    name = "json"
+    magic = None
+
+    def encode(self, data, encoded=None):
+        """Encodes a message using json.
+
+        Args:
+          data (dict): The message to encode.
+          encoded (dict): Additional keys of the message whose values were
+            already encoded with "encode_value". Defaults to None.
+
+        Returns:
+          The json encoded message as a string.
+
+        """
+        message = json.dumps(data, default=to_json)
+        if encoded:
+            fields = ", ".join(json.dumps(key) + ": " + value
+                               for key, value in encoded.items())
+            message = message[:-1] + (", " if data else "") + fields + "}"
+        return message
+
+    def encode_value(self, value):
+        """Encodes a single value so it can be passed to "encode" as part of
+        the "encoded" dictionary."""
+        return json.dumps(value, default=to_json)
+
+    def decode(self, data):
+        """Decodes a json encoded message.
+
+        Args:
+          data (bytes): The json encoded message. This may also be a
+            memoryview.
+
+        Returns:
+          The decoded message.
+
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = codecs.decode(data, "utf-8")
+        return json.loads(data)
+
+
+# Type tags used by the binary codec to pack values.
+TAG_NONE = 0x00
+TAG_FALSE = 0x01
+TAG_TRUE = 0x02
+TAG_INT = 0x03
+TAG_FLOAT = 0x04
+TAG_STR = 0x05
+TAG_BYTES = 0x06
+TAG_LIST = 0x07
+TAG_DICT = 0x08
+TAG_UUID = 0x09
+TAG_ARRAY = 0x0a
+
+# The type tags as the single bytes they are packed as.
+PACKED_TAGS = [struct.pack("B", tag) for tag in range(TAG_ARRAY + 1)]
+
+FLOAT = struct.Struct("!d")
+
+# The byte order of the machine, as used in dtype strings.
+NATIVE_ORDER = "<" if sys.byteorder == "little" else ">"
+
+# The dtype kind of each struct format character used by array.array and
+# memoryview.
+FORMAT_KINDS = {"b": "i", "B": "u", "h": "i", "H": "u", "i": "i", "I": "u",
+                "l": "i", "L": "u", "q": "i", "Q": "u", "n": "i", "N": "u",
+                "e": "f", "f": "f", "d": "f", "?": "b", "c": "S"}
+
+# The struct format character of each dtype, used to decode arrays as
+# memoryviews when NumPy isn't installed.
+DTYPE_FORMATS = {"i1": "b", "u1": "B", "i2": "h", "u2": "H", "i4": "i",
+                 "u4": "I", "i8": "q", "u8": "Q", "f2": "e", "f4": "f",
+                 "f8": "d", "b1": "?", "S1": "c"}
+
+# Message methods and keys that are sent as a single number by the binary
+# codec instead of a string. New entries must only ever be appended.
+METHODS = ["OHAI", "OHAI Client", "REGISTER", "OK REGISTER", "BYE REGISTER",
+           "AUTH", "EVENT", "LEGAL", "ILLEGAL", "BYE EVENT", "OK EVENT",
+           "NOTIFY", "OK NOTIFY", "ACK", "GROUP NOTIFY", "NACK", "EVENTS",
+           "VERDICT", "UNRELIABLE EVENT", "UNRELIABLE NOTIFY", "STREAM",
+           "STREAM ACK", "STREAM CANCEL", "STATE"]
+KEYS = ["event_data", "timestamp", "retry", "version", "server_name",
+        "encryption", "data", "codec", "codecs", "cid", "ack_events",
+        "ack_notifies", "multicast", "group_seq", "missing", "events",
+        "legal", "illegal", "sequenced", "stream", "name", "end", "ack",
+        "seq", "base", "set", "removed", "quantize", "ack_state"]
+
+# Flags in the binary message header.
+FLAG_CUUID = 0x01
+FLAG_EUUID = 0x02
+FLAG_PRIORITY_NORMAL = 0x04
+FLAG_PRIORITY_HIGH = 0x08
+FLAG_PAYLOAD = 0x10
+FLAG_CID = 0x20
+
+
+def pack_varint(value):
+    """Packs an unsigned integer into as few bytes as possible."""
+    parts = bytearray()
+    while value > 0x7f:
+        parts.append((value & 0x7f) | 0x80)
+        value >>= 7
+    parts.append(value)
+    return bytes(parts)
+
+
+def unpack_varint(data, offset):
+    """Unpacks an unsigned integer packed with pack_varint.
+
+    Returns:
+      A tuple of the integer and the offset of the next byte.
+
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def pack_array(value, parts):
+    """Packs an array.array, memoryview or NumPy array as its dtype, shape
+    and raw buffer. The buffer is appended to the parts as is, so it is only
+    copied once when the message is joined.
+
+    Args:
+      value (any): The array to pack.
+      parts (list): The list of byte strings to append to.
+
+    Returns:
+      None
+
+    """
+
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        if value.dtype.hasobject or value.dtype.fields:
+            raise TypeError("Unable to pack array of dtype " + str(value.dtype))
+        dtype = value.dtype.str
+        shape = value.shape
+        view = memoryview(numpy.ascontiguousarray(value))
+    else:
+        view = memoryview(value)
+        code = view.format.lstrip("@=")
+        order = NATIVE_ORDER
+        if code[:1] in ("<", ">", "!"):
+            order = ">" if code[0] == "!" else code[0]
+            code = code[1:]
+        if code not in FORMAT_KINDS:
+            raise TypeError("Unable to pack memoryview of format " +
+                            view.format)
+        if view.itemsize == 1:
+            order = "|"
+        dtype = order + FORMAT_KINDS[code] + str(view.itemsize)
+        shape = view.shape
+        if not view.c_contiguous:
+            view = memoryview(view.tobytes())
+
+    header = bytearray(PACKED_TAGS[TAG_ARRAY])
+    header += pack_varint(len(dtype)) + dtype.encode("ascii")
+    header += pack_varint(len(shape))
+    for size in shape:
+        header += pack_varint(size)
+    header += pack_varint(view.nbytes)
+    parts.append(bytes(header))
+    if view.nbytes:
+        parts.append(view.cast("B") if view.ndim != 1 or view.format != "B"
+                     else view)
+
+
+def unpack_array(data, offset, dtype, shape, size):
+    """Returns a view over an array packed with pack_array. This is a NumPy
+    array if NumPy is installed, otherwise a memoryview. Arrays in a byte
+    order other than our own are copied when NumPy isn't installed."""
+
+    if numpy is not None:
+        dtype = numpy.dtype(dtype)
+        return numpy.frombuffer(data, dtype, size // dtype.itemsize,
+                                offset).reshape(shape)
+
+    order, kind = dtype[:1], dtype[1:]
+    if kind not in DTYPE_FORMATS:
+        raise ValueError("Unknown array dtype in packed data: " + dtype)
+    code = DTYPE_FORMATS[kind]
+    view = memoryview(data)[offset:offset + size]
+    if order not in (NATIVE_ORDER, "|"):
+        swapped = array.array(code, view.tobytes())
+        swapped.byteswap()
+        view = memoryview(swapped).cast("B")
+    if not size:
+        # Memoryviews can't have a shape with a length of zero.
+        return view.cast(code)
+    return view.cast(code, shape)
+
+
+def pack_value(value, parts):
+    """Packs a value into the binary format, appending the packed bytes to the
+    given list.
+
+    Supported types are None, booleans, integers, floats, strings, bytes,
+    lists, tuples and dictionaries, and their subclasses. Tuples are
+    unpacked as lists, and subclasses as their base type. Arrays,
+    i.e. array.array, memoryviews and NumPy arrays, are packed with
+    pack_array. Memoryviews of plain bytes are packed as bytes.
+
+    Args:
+      value (any): The value to pack.
+      parts (list): The list of byte strings to append to.
+
+    Returns:
+      None
+
+    """
+
+    # Subclasses of the supported types, such as OrderedDict or IntEnum, are
+    # packed like their base type, as the json codec does. Booleans are
+    # checked first, since they are integers too.
+    if value is None:
+        parts.append(PACKED_TAGS[TAG_NONE])
+    elif value is True or value is False:
+        parts.append(PACKED_TAGS[TAG_TRUE] if value else
+                     PACKED_TAGS[TAG_FALSE])
+    elif isinstance(value, int):
+        # Zigzag encode the integer so small negative numbers stay small.
+        value = (value << 1) if value >= 0 else ((-value << 1) - 1)
+        parts.append(PACKED_TAGS[TAG_INT] + pack_varint(value))
+    elif isinstance(value, float):
+        parts.append(PACKED_TAGS[TAG_FLOAT] + FLOAT.pack(value))
+    elif isinstance(value, str):
+        encoded = value.encode("utf-8")
+        parts.append(PACKED_TAGS[TAG_STR] + pack_varint(len(encoded)))
+        parts.append(encoded)
+    elif isinstance(value, (bytes, bytearray)):
+        parts.append(PACKED_TAGS[TAG_BYTES] + pack_varint(len(value)))
+        parts.append(bytes(value))
+    elif (isinstance(value, memoryview) and value.ndim == 1 and
+          value.format == "B" and value.c_contiguous):
+        parts.append(PACKED_TAGS[TAG_BYTES] + pack_varint(value.nbytes))
+        parts.append(value)
+    elif (isinstance(value, (memoryview, array.array)) or
+          (numpy is not None and isinstance(value, numpy.ndarray))):
+        pack_array(value, parts)
+    elif isinstance(value, (list, tuple)):
+        parts.append(PACKED_TAGS[TAG_LIST] + pack_varint(len(value)))
+        for item in value:
+            pack_value(item, parts)
+    elif isinstance(value, dict):
+        parts.append(PACKED_TAGS[TAG_DICT] + pack_varint(len(value)))
+        for key, item in value.items():
+            pack_value(key, parts)
+            pack_value(item, parts)
+    elif isinstance(value, uuid.UUID):
+        parts.append(PACKED_TAGS[TAG_UUID] + value.bytes)
+    elif numpy is not None and isinstance(value, numpy.generic):
+        # NumPy scalars, such as numpy.int64, as their Python value.
+        pack_value(value.item(), parts)
+    else:
+        raise TypeError("Unable to pack value of type " + str(type(value)))
+
+
+def unpack_value(data, offset):
+    """Unpacks a value packed with pack_value. Arrays unpacked from bytes
+    are views over them. Arrays unpacked from a memoryview are copied, since
+    it is usually a receive buffer that is reused.
+
+    Args:
+      data (bytes): The packed data. This may also be a memoryview.
+      offset (int): The offset of the value in the data.
+
+    Returns:
+      A tuple of the value and the offset of the next value.
+
+    """
+
+    tag = data[offset]
+    offset += 1
+    if tag == TAG_STR:
+        length, offset = unpack_varint(data, offset)
+        return (codecs.decode(data[offset:offset + length], "utf-8"),
+                offset + length)
+    elif tag == TAG_INT:
+        value, offset = unpack_varint(data, offset)
+        return (value >> 1) if not value & 1 else -((value + 1) >> 1), offset
+    elif tag == TAG_NONE:
+        return None, offset
+    elif tag == TAG_FALSE:
+        return False, offset
+    elif tag == TAG_TRUE:
+        return True, offset
+    elif tag == TAG_FLOAT:
+        return FLOAT.unpack_from(data, offset)[0], offset + 8
+    elif tag == TAG_BYTES:
+        length, offset = unpack_varint(data, offset)
+        return bytes(data[offset:offset + length]), offset + length
+    elif tag == TAG_LIST:
+        length, offset = unpack_varint(data, offset)
+        value = []
+        for i in range(length):
+            item, offset = unpack_value(data, offset)
+            value.append(item)
+        return value, offset
+    elif tag == TAG_DICT:
+        length, offset = unpack_varint(data, offset)
+        value = {}
+        for i in range(length):
+            key, offset = unpack_value(data, offset)
+            value[key], offset = unpack_value(data, offset)
+        return value, offset
+    elif tag == TAG_UUID:
+        return str(uuid.UUID(bytes=bytes(data[offset:offset + 16]))), offset + 16
+    elif tag == TAG_ARRAY:
+        length, offset = unpack_varint(data, offset)
+        dtype = bytes(data[offset:offset + length]).decode("ascii")
+        offset += length
+        ndim, offset = unpack_varint(data, offset)
+        shape = []
+        for i in range(ndim):
+            size, offset = unpack_varint(data, offset)
+            shape.append(size)
+        size, offset = unpack_varint(data, offset)
+        if offset + size > len(data):
+            raise ValueError("Packed array is larger than the packed data")
+        if type(data) is memoryview:
+            return (unpack_array(data[offset:offset + size].tobytes(), 0,
+                                 dtype, shape, size), offset + size)
+        return unpack_array(data, offset, dtype, shape, size), offset + size
+    else:
+        raise ValueError("Unknown type tag in packed data: " + str(tag))
+
+
+def pack_id(value, parts):
+    """Packs a connection or event id. Ids that are uuid strings are packed
+    into their 16 raw bytes instead of 36 characters."""
+    if isinstance(value, str) and len(value) == 36:
+        try:
+            packed = uuid.UUID(value)
+        except ValueError:
+            packed = value
+        if str(packed) == value:
+            value = packed
+    pack_value(value, parts)
+
+
+class BinaryCodec(object):
+    """Encodes and decodes messages using a compact binary format.
+
+    Every message starts with a fixed header of a magic byte, the method
+    number and a flags byte. The flags indicate which of the client id,
+    connection id, event id and priority are present. The ids follow the header, and any other
+    keys in the message are packed after them as a dictionary, with common
+    keys replaced by numbers.
+
+    """
+
+    name = "binary"
+    magic = b"\xb1"
+
+    HEADER = struct.Struct("!cBB")
+
+    def __init__(self):
+        self.method_codes = dict((method, code + 1)
+                                 for code, method in enumerate(METHODS))
+        self.key_codes = dict((key, code + 1) for code, key in enumerate(KEYS))
+
+    def encode(self, data, encoded=None):
+        """Encodes a message using the binary format.
+
+        Args:
+          data (dict): The message to encode.
+          encoded (dict): Additional keys of the message whose values were
+            already packed with "encode_value". Defaults to None.
+
+        Returns:
+          The encoded message as bytes.
+
+        """
+
+        parts = [None]
+        flags = 0
+        payload = {}
+        method = 0
+        for key, value in data.items():
+            if key == "method" and value in self.method_codes:
+                method = self.method_codes[value]
+            elif key == "cuuid":
+                flags |= FLAG_CUUID
+            elif key == "cid" and type(value) is int and value >= 0:
+                flags |= FLAG_CID
+            elif key == "euuid":
+                flags |= FLAG_EUUID
+            elif key == "priority" and value == "normal":
+                flags |= FLAG_PRIORITY_NORMAL
+            elif key == "priority" and value == "high":
+                flags |= FLAG_PRIORITY_HIGH
+            else:
+                payload[self.key_codes.get(key, key)] = value
+
+        if flags & FLAG_CUUID:
+            pack_id(data["cuuid"], parts)
+        if flags & FLAG_CID:
+            parts.append(pack_varint(data["cid"]))
+        if flags & FLAG_EUUID:
+            pack_id(data["euuid"], parts)
+
+        if encoded:
+            flags |= FLAG_PAYLOAD
+            parts.append(PACKED_TAGS[TAG_DICT] +
+                         pack_varint(len(payload) + len(encoded)))
+            for key, value in payload.items():
+                pack_value(key, parts)
+                pack_value(value, parts)
+            for key, value in encoded.items():
+                pack_value(self.key_codes.get(key, key), parts)
+                parts.append(value)
+        elif payload:
+            flags |= FLAG_PAYLOAD
+            pack_value(payload, parts)
+
+        parts[0] = self.HEADER.pack(self.magic, method, flags)
+        return b"".join(parts)
+
+    def encode_value(self, value):
+        """Packs a single value so it can be passed to "encode" as part of
+        the "encoded" dictionary."""
+        parts = []
+        pack_value(value, parts)
+        return b"".join(parts)
+
+    def decode(self, data):
+        """Decodes a message encoded with the binary format.
+
+        Args:
+          data (bytes): The encoded message. This may also be a memoryview,
+            which is decoded in place.
+
+        Returns:
+          The decoded message.
+
+        """
+
+        # Values are unpacked straight from the message, so only copy it if
+        # indexing it doesn't return integers, as with Python 2 strings.
+        if (not isinstance(data, (bytes, bytearray, memoryview)) or
+                bytes is str):
+            data = bytearray(data)
+        magic, method, flags = self.HEADER.unpack_from(data)
+        offset = self.HEADER.size
+
+        message = {}
+        if method:
+            if method > len(METHODS):
+                raise ValueError("Unknown method in binary message: " +
+                                 str(method))
+            message["method"] = METHODS[method - 1]
+        if flags & FLAG_CUUID:
+            message["cuuid"], offset = unpack_value(data, offset)
+        if flags & FLAG_CID:
+            message["cid"], offset = unpack_varint(data, offset)
+        if flags & FLAG_EUUID:
+            message["euuid"], offset = unpack_value(data, offset)
+        if flags & FLAG_PRIORITY_NORMAL:
+            message["priority"] = "normal"
+        elif flags & FLAG_PRIORITY_HIGH:
+            message["priority"] = "high"
+        if flags & FLAG_PAYLOAD:
+            payload, offset = unpack_value(data, offset)
+            for key, value in payload.items():
+                if isinstance(key, int):
+                    if not 0 < key <= len(KEYS):
+                        raise ValueError("Unknown key in binary message: " +
+                                         str(key))
+                    key = KEYS[key - 1]
+                message[key] = value
+
+        return message
+
+
+# All of the available codecs by name and by their magic byte.
+CODECS = {}
+CODECS_BY_MAGIC = {}
+
+
+def register_codec(codec):
+    """Makes a codec available to be negotiated and used to decode received
+    messages.
+
+    Args:
+      codec (object): An instance of a codec with "name" and "magic"
+        attributes and "encode" and "decode" methods.
+
+    Returns:
+      None
+
+    """
+    CODECS[codec.name] = codec
+    if codec.magic:
+        CODECS_BY_MAGIC[codec.magic] = codec
+
+
+def get_codec(name):
+    """Returns the codec with the given name.
+
+    Args:
+      name (string): The name of the codec, e.g. "json" or "binary".
+
+    Returns:
+      The codec instance.
+
+    """
+    return CODECS[name]
+
+
+def detect_codec(data):
+    """Returns the codec that was used to encode a message based on its first
+    byte. Messages without a known magic byte are decoded as json.
+
+    Args:
+      data (bytes): The encoded message. This may also be a memoryview.
+
+    Returns:
+      The codec instance.
+
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return CODECS_BY_MAGIC.get(bytes(data[:1]), JSON)
+    return JSON
+
+
+JSON = JSONCodec()
+BINARY = BinaryCodec()
+register_codec(JSON)
+register_codec(BINARY)
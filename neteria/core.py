@@ -28,20 +28,43 @@
 sending and receiving UDP datagrams."""
 
 import binascii
-import json
 import logging
 import socket
 import errno
+import heapq
+import random
 import struct
 import time
 import traceback
 import zlib
 
+from threading import Condition
+
+from .codec import detect_codec
+from .codec import pack_varint
+from .codec import unpack_varint
+from .codec import JSON
+from .fragment import Fragmenter
+from .fragment import FRAGMENT_ACK_MAGIC
+from .fragment import FRAGMENT_MAGIC
+
 # Create a logger for optional handling of debug messages.
 logger = logging.getLogger(__name__)
 
+# Several packets to the same host can be sent as a single datagram. Bundles
+# start with this magic byte, followed by each packet prefixed with its length.
+BUNDLE_MAGIC = b"\xb5"
+
+# Use a monotonic clock for scheduling if one is available, so scheduled calls
+# are not affected by changes to the system time.
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
 
-def serialize_data(data, compression=False, encryption=False, public_key=None):
+
+def serialize_data(data, compression=False, encryption=False, public_key=None,
+                   codec=None, session=None, encoded=None):
     """Serializes normal Python datatypes into plaintext using json.
 
     You may also choose to enable compression and encryption when serializing
@@ -56,67 +79,247 @@ def serialize_data(data, compression=False, encryption=False, public_key=None):
         message if encryption is desired.
       public_key (str): The public key to use to encrypt if encryption is
         enabled.
+      codec (object): The codec used to encode the data instead of json. See
+        the codec module. Defaults to None.
+      session (encryption.Session): A session used to encrypt the message
+        with a symmetric key. If set, it is used instead of "encryption".
+      encoded (dict): Additional keys of the message whose values were
+        already encoded with the codec's "encode_value". Defaults to None.
 
     Returns:
-      The string message serialized using json.
+      The string message serialized using json or the given codec.
 
     """
 
-    message = json.dumps(data)
+    if encoded:
+        message = (codec or JSON).encode(data, encoded)
+    elif codec:
+        message = codec.encode(data)
+    else:
+        message = JSON.encode(data)
 
     if compression:
+        if not isinstance(message, bytes):
+            message = str.encode(message)
         message = zlib.compress(message)
         message = binascii.b2a_base64(message)
 
-    if encryption and public_key:
+    if session:
+        if not isinstance(message, bytes):
+            message = str.encode(message)
+        message = session.encrypt(message)
+
+    elif encryption and public_key:
         message = encryption.encrypt(message, public_key)
 
-    encoded_message = str.encode(message)
+    if not isinstance(message, bytes):
+        message = str.encode(message)
 
-    return encoded_message
+    return message
 
-def unserialize_data(data, compression=False, encryption=False):
+def unserialize_data(data, compression=False, encryption=False, session=None):
     """Unserializes the packet data and converts it from json format to normal
     Python datatypes.
 
     If you choose to enable encryption and/or compression when serializing
-    data, you MUST enable the same options when unserializing data.
+    data, you MUST enable the same options when unserializing data. The codec
+    used to encode the data is detected automatically.
 
     Args:
       data (str): The raw, serialized packet data delivered from the transport
-        protocol.
+        protocol. This may also be a memoryview of a receive buffer, which is
+        parsed in place. Nothing in the returned message refers to it.
       compression (boolean): True or False value on whether or not to
         uncompress the serialized data.
       encryption (rsa.encryption): An encryption instance used to decrypt the
         message if encryption is desired.
+      session (encryption.Session): A session used to decrypt the message
+        with a symmetric key. If set, it is used instead of "encryption".
 
     Returns:
       The message unserialized in normal Python datatypes.
 
     """
     try:
-        if encryption:
+        if session:
+            data = session.decrypt(data)
+        elif encryption:
+            if isinstance(data, memoryview):
+                data = data.tobytes()
             data = encryption.decrypt(data)
 
     except Exception as err:
         logger.error("Decryption Error: " + str(err))
-        message = False
+        return False
     try:
         if compression:
             data = binascii.a2b_base64(data)
             data = zlib.decompress(data)
-            message = json.loads(data)
 
     except Exception as err:
         logger.error("Decompression Error: " + str(err))
-        message = False
+        return False
 
-    decoded_message = data.decode()
+    return detect_codec(data).decode(data)
 
-    if not encryption and not compression:
-        message = json.loads(decoded_message)
 
-    return message
+def bundle_packets(packets):
+    """Packs several serialized packets into a single datagram. Each packet is
+    kept as is, so packets encrypted for the same host can be bundled.
+
+    Args:
+      packets (list): The raw serialized packets to bundle.
+
+    Returns:
+      The bundle as bytes.
+
+    """
+
+    parts = [BUNDLE_MAGIC]
+    for packet in packets:
+        parts.append(pack_varint(len(packet)))
+        parts.append(packet)
+    return b"".join(parts)
+
+def unbundle_packets(data):
+    """Splits a datagram created with bundle_packets into its packets.
+
+    Args:
+      data (bytes): The raw bundle. This may also be a memoryview.
+
+    Returns:
+      A list of the packets in the bundle.
+
+    """
+
+    # Python 2 strings and memoryviews index as characters, so the lengths
+    # are read from a copy, while the packets are still sliced from the data.
+    lengths = bytearray(data) if bytes is str else data
+    packets = []
+    offset = 1
+    while offset < len(data):
+        length, offset = unpack_varint(lengths, offset)
+        if offset + length > len(data):
+            raise ValueError("Bundled packet is truncated")
+        packets.append(data[offset:offset + length])
+        offset += length
+    return packets
+
+
+class RTTEstimator(object):
+    """Estimates the round trip time to a host from how long it takes for
+    our messages to be acknowledged, and the retransmission timeout (RTO)
+    to use for it, as described in RFC 6298.
+
+    Following Karn's rule, messages that were retransmitted must not be
+    sampled, since we can't tell which copy was acknowledged.
+
+    Args:
+      initial (float): The RTO to use until the first sample. Defaults to 2.0
+        seconds.
+      min_rto (float): The smallest RTO to use. Defaults to 0.1 seconds.
+      max_rto (float): The largest RTO to use, including backoff. Defaults to
+        30.0 seconds.
+
+    """
+
+    __slots__ = ("srtt", "rttvar", "rto", "min_rto", "max_rto")
+
+    def __init__(self, initial=2.0, min_rto=0.1, max_rto=30.0):
+        self.srtt = None    # The smoothed round trip time.
+        self.rttvar = None  # The round trip time variation.
+        self.rto = initial
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+    def sample(self, rtt):
+        """Updates the estimate with a measured round trip time.
+
+        Args:
+          rtt (float): The time in seconds between sending a message and
+            receiving its acknowledgement.
+
+        Returns:
+          None
+
+        """
+
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto),
+                       self.max_rto)
+
+    def timeout(self, retry=0):
+        """Returns the time to wait before retransmitting a message. The RTO
+        is doubled for every time the message has already been retransmitted,
+        with some random jitter so that retransmits to many hosts are spread
+        out.
+
+        Args:
+          retry (int): The number of times the message has been
+            retransmitted. Defaults to 0.
+
+        Returns:
+          The timeout in seconds.
+
+        """
+
+        if not retry:
+            return self.rto
+        backoff = min(self.rto * 2 ** retry, self.max_rto)
+        return backoff * random.uniform(0.75, 1.0)
+
+    def stats(self):
+        """Returns the current estimate as a dictionary."""
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "rto": self.rto}
+
+
+class ScheduledCall(object):
+    """A handle to a call scheduled with ListenerUDP.call_later.
+
+    Args:
+      ts (float): The monotonic timestamp at which the call should be executed.
+      callback (function): The method to execute when our time has been
+        reached.
+      args (dict): The arguments to send to the callback.
+
+    """
+
+    __slots__ = ('ts', 'callback', 'args', 'cancelled', 'scheduler')
+
+    def __init__(self, ts, callback, args):
+        self.ts = ts
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = None
+
+    def __lt__(self, other):
+        return self.ts < other.ts
+
+    def cancel(self):
+        """Cancels the scheduled call so that it will never be executed.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        if self.cancelled:
+            return
+        self.cancelled = True
+
+        # Let the scheduler know so it can clean up its heap if it needs to.
+        scheduler = self.scheduler
+        if scheduler:
+            scheduler.cancelled_call()
 
 
 class ListenerUDP(object):
@@ -140,11 +343,31 @@ class ListenerUDP(object):
       bufsize (int): The size of our buffer used for receiving
         messages in bytes. If a message received is larger than this
         buffer size, the message will be truncated. Defaults to 10240.
+      batch_size (int): If set, the listener will drain up to this many
+        datagrams from the socket at once into a ring of preallocated buffers
+        and process them as a batch before blocking again. Received data is
+        then passed to the app as a memoryview that is only valid until the
+        next batch is received. Defaults to 0, which receives one datagram
+        at a time.
+      reuse_port (boolean): Whether or not to bind the socket with
+        SO_REUSEPORT, allowing several processes to listen on the same port.
+        The kernel will then consistently deliver datagrams from the same
+        address to the same socket. Defaults to False.
+      mtu (int): The largest unicast datagram to send in bytes. Larger
+        messages are split into fragments that are reassembled by the
+        receiving listener, and only the missing fragments are resent if
+        some are lost. See fragment.Fragmenter. Defaults to 1400, which fits
+        in a typical ethernet frame. If set to 0, messages are never
+        fragmented and can't be larger than "bufsize".
+      max_message_size (int): The largest message in bytes that can be sent
+        or received in fragments. Defaults to 1 MiB.
 
     """
 
     def __init__(self, app, threading=True, stats=False, listen_address='',
-                 listen_port=40080, listen_type="unicast", bufsize=10240):
+                 listen_port=40080, listen_type="unicast", bufsize=10240,
+                 batch_size=0, reuse_port=False, mtu=1400,
+                 max_message_size=1048576):
 
         self.app = app
         self.threading = threading
@@ -154,8 +377,17 @@ class ListenerUDP(object):
         self.listen_port = listen_port
         self.listen_type = listen_type
         self.bufsize = bufsize
+        self.batch_size = batch_size
         self.listening = False
 
+        # Split messages larger than the mtu into fragments, and put the
+        # fragments we receive back together.
+        self.mtu = mtu
+        self.fragments = Fragmenter(self, mtu or 1400, max_message_size)
+
+        # Preallocate our receive buffers if we're receiving in batches.
+        self.buffers = [bytearray(bufsize) for i in range(batch_size)]
+
         self.stats_enabled = stats
         self.stats = {}
         self.stats['bytes_sent'] = 0
@@ -170,6 +402,8 @@ class ListenerUDP(object):
         self.sock = socket.socket(
             socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.sock.bind((listen_address, listen_port))
 
         # If this is a multicast receiver, set it up as such.
@@ -179,9 +413,11 @@ class ListenerUDP(object):
             self.sock.setsockopt(
                 socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
 
-        # Create a list of callbacks that we can schedule to run while we're
-        # listening.
+        # Create a heap of callbacks that we can schedule to run while we're
+        # listening, ordered by the time they should be executed.
         self.scheduled_calls = []
+        self.cancelled_calls = 0
+        self.scheduler_condition = Condition()
 
         # If stats are enabled, start a recurring task that will calculate our
         # network stats every x seconds.
@@ -227,6 +463,10 @@ class ListenerUDP(object):
 
         """
 
+        if self.batch_size:
+            self.listen_loop_batched()
+            return
+
         while self.listening:
             try:
                 data, address = self.sock.recvfrom(self.bufsize)
@@ -241,28 +481,104 @@ class ListenerUDP(object):
 
         logger.info("Shutting down the listener...")
 
-    def scheduler(self, sleep_time=0.2):
-        """Starts the scheduler to check for scheduled calls and execute them
-        at the correct time.
+    def listen_loop_batched(self):
+        """Starts the listen loop in batch mode. The loop blocks until a
+        datagram is received, then drains any other waiting datagrams without
+        blocking into our preallocated buffers and executes the
+        receive_datagram method for the whole batch.
 
         Args:
-          sleep_time (float): The amount of time to wait in seconds between
-            each loop iteration. This prevents the scheduler from consuming
-            100% of the host's CPU. Defaults to 0.2 seconds.
+          None
 
         Returns:
           None
 
         """
 
+        views = [memoryview(buf) for buf in self.buffers]
+        batch = []
+
+        # If the platform doesn't support non-blocking receive flags, switch
+        # the socket to non-blocking mode while we drain it instead.
+        dontwait = getattr(socket, "MSG_DONTWAIT", 0)
+
         while self.listening:
-            # If we have any scheduled calls, execute them and remove them from
-            # our list of scheduled calls.
-            if self.scheduled_calls:
-                timestamp = time.time()
-                self.scheduled_calls[:] = [item for item in self.scheduled_calls
-                                           if not self.time_reached(timestamp, item)]
-            time.sleep(sleep_time)
+            try:
+                nbytes, address = self.sock.recvfrom_into(views[0])
+                batch.append((views[0][:nbytes], address))
+
+                if not dontwait:
+                    self.sock.setblocking(False)
+                try:
+                    for view in views[1:]:
+                        nbytes, address = self.sock.recvfrom_into(
+                            view, 0, dontwait)
+                        batch.append((view[:nbytes], address))
+                except socket.error as error:
+                    if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                finally:
+                    if not dontwait:
+                        self.sock.setblocking(True)
+
+            except socket.error as error:
+                if error.errno == errno.WSAECONNRESET:
+                    logger.info("connection reset")
+                else:
+                    raise
+
+            for data, address in batch:
+                self.receive_datagram(data, address)
+                if self.stats_enabled:
+                    self.stats['bytes_recieved'] += len(data)
+            del batch[:]
+
+        logger.info("Shutting down the listener...")
+
+    def scheduler(self):
+        """Starts the scheduler to execute scheduled calls at the correct time.
+
+        Scheduled calls are kept in a heap ordered by their deadline, so the
+        scheduler only ever has to look at the earliest call. It sleeps until
+        that deadline is reached or until an earlier call is scheduled.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        while self.listening:
+            with self.scheduler_condition:
+                # Skip over any calls that were cancelled before they were
+                # due. They are removed lazily so cancelling stays O(1).
+                while self.scheduled_calls and \
+                        self.scheduled_calls[0].cancelled:
+                    heapq.heappop(self.scheduled_calls)
+                    self.cancelled_calls = max(self.cancelled_calls - 1, 0)
+
+                if not self.scheduled_calls:
+                    self.scheduler_condition.wait()
+                    continue
+
+                delay = self.scheduled_calls[0].ts - monotonic()
+                if delay > 0:
+                    self.scheduler_condition.wait(delay)
+                    continue
+
+                scheduled_call = heapq.heappop(self.scheduled_calls)
+                scheduled_call.scheduler = None
+
+            # Execute the callback outside of the lock so it is free to
+            # schedule new calls.
+            try:
+                scheduled_call.callback(scheduled_call.args)
+            except Exception:
+                logger.error("Error executing scheduled call " +
+                             str(scheduled_call.callback))
+                logger.error(traceback.format_exc())
 
         logger.info("Shutting down the call scheduler...")
 
@@ -282,44 +598,44 @@ class ListenerUDP(object):
           arguments (dict): A dictionary of arguments to send to the callback.
 
         Returns:
-          None
+          A ScheduledCall handle that can be used to cancel the call.
 
         """
 
-        scheduled_call = {'ts': time.time() + time_seconds,
-                          'callback': callback,
-                          'args': arguments}
-        self.scheduled_calls.append(scheduled_call)
+        scheduled_call = ScheduledCall(monotonic() + time_seconds,
+                                       callback, arguments)
+
+        with self.scheduler_condition:
+            scheduled_call.scheduler = self
+            heapq.heappush(self.scheduled_calls, scheduled_call)
 
-    def time_reached(self, current_time, scheduled_call):
-        """Checks to see if it's time to run a scheduled call or not.
+            # Only wake up the scheduler if this call is now the next one due,
+            # otherwise it is already sleeping until an earlier deadline.
+            if self.scheduled_calls[0] is scheduled_call:
+                self.scheduler_condition.notify()
 
-        If it IS time to run a scheduled call, this function will execute the
-        method associated with that call.
+        return scheduled_call
+
+    def cancelled_call(self):
+        """Keeps track of cancelled calls that are still sitting in the heap.
+        If more than half of the heap is made up of cancelled calls, the heap
+        is rebuilt without them.
 
         Args:
-          current_time (float): Current timestamp from time.time().
-          scheduled_call (dict): A scheduled call dictionary that contains the
-            timestamp to execute the call, the method to execute, and the
-            arguments used to call the method.
+          None
 
         Returns:
           None
 
-        Examples:
-
-        >>> scheduled_call
-        {'callback': <function foo at 0x7f022c42cf50>,
-                 'args': {'k': 'v'},
-                 'ts': 1415066599.769509}
-
         """
 
-        if current_time >= scheduled_call['ts']:
-            scheduled_call['callback'](scheduled_call['args'])
-            return True
-        else:
-            return False
+        with self.scheduler_condition:
+            self.cancelled_calls += 1
+            if self.cancelled_calls > len(self.scheduled_calls) // 2:
+                self.scheduled_calls[:] = [item for item in self.scheduled_calls
+                                           if not item.cancelled]
+                heapq.heapify(self.scheduled_calls)
+                self.cancelled_calls = 0
 
     def send_datagram(self, message, address, message_type="unicast"):
         """Sends a UDP datagram packet to the requested address.
@@ -342,7 +658,13 @@ class ListenerUDP(object):
 
         """
 
-        if self.bufsize is not 0 and len(message) > self.bufsize:
+        # Messages that are too large for a single datagram are sent in
+        # fragments.
+        if self.mtu and len(message) > self.mtu and message_type == "unicast":
+            self.send_datagrams(self.fragments.split(message, address))
+            return
+
+        if self.bufsize != 0 and len(message) > self.bufsize:
             raise Exception("Datagram is too large. Messages should be " +
                             "under " + str(self.bufsize) + " bytes in size.")
 
@@ -359,6 +681,63 @@ class ListenerUDP(object):
         except socket.error:
             logger.error("Failed to send, [Errno 101]: Network is unreachable.")
 
+    def send_datagrams(self, datagrams):
+        """Sends a batch of unicast UDP datagrams one after the other.
+
+        Args:
+          datagrams (list): A list of (message, address) tuples to send.
+
+        Returns:
+          None
+
+        """
+
+        sendto = self.sock.sendto
+        sent = 0
+        for message, address in self.fragment(datagrams):
+            if self.bufsize and len(message) > self.bufsize:
+                logger.error("Datagram to %s is too large. Messages should be "
+                             "under %d bytes in size." % (str(address),
+                                                         self.bufsize))
+                continue
+            try:
+                sendto(message, address)
+                sent += len(message)
+            except socket.error as err:
+                logger.error("Failed to send to %s: %s" % (str(address),
+                                                           str(err)))
+
+        if self.stats_enabled:
+            self.stats['bytes_sent'] += sent
+
+    def fragment(self, datagrams):
+        """Splits the messages in a batch of datagrams that are larger than
+        the mtu into fragments.
+
+        Args:
+          datagrams (list): A list of (message, address) tuples to send.
+
+        Returns:
+          A list of (message, address) tuples that fit in the mtu.
+
+        """
+
+        mtu = self.mtu
+        if not mtu or all(len(message) <= mtu for message, _ in datagrams):
+            return datagrams
+
+        fragmented = []
+        for message, address in datagrams:
+            if len(message) <= mtu:
+                fragmented.append((message, address))
+                continue
+            try:
+                fragmented.extend(self.fragments.split(message, address))
+            except Exception as err:
+                logger.error("Failed to send to %s: %s" % (str(address),
+                                                           str(err)))
+        return fragmented
+
     def receive_datagram(self, data, address):
         """Executes when UDP data has been received and sends the packet data
         to our app to process the request.
@@ -378,6 +757,28 @@ class ListenerUDP(object):
             logger.debug("Packet received", address, data)
             return False
 
+        # Process each packet of a bundle as if it was received on its own.
+        if data[:1] == BUNDLE_MAGIC:
+            try:
+                packets = unbundle_packets(data)
+            except (IndexError, ValueError):
+                logger.error("Malformed bundle received from " + str(address))
+                return False
+            for packet in packets:
+                self.receive_datagram(packet, address)
+            return
+
+        # Put fragmented messages back together, and resend the fragments
+        # the other side is missing.
+        if data[:1] == FRAGMENT_MAGIC:
+            message = self.fragments.receive(data, address)
+            if message is not None:
+                self.receive_datagram(message, address)
+            return
+        if data[:1] == FRAGMENT_ACK_MAGIC:
+            self.fragments.acknowledge(data, address)
+            return
+
         # Send the data we've recieved from the network and send it
         # to our application for processing.
         try:
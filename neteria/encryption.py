@@ -2,18 +2,32 @@
 """The encryption module is used to encrypt and decrypt messages using the
 python-rsa package.
 
+RSA keys are only used to exchange a random session key when a client
+registers. All other messages are encrypted with that session key using
+AES-GCM from the "cryptography" package, which is much faster and also
+authenticates each message. If the "cryptography" package is not installed,
+every message is encrypted with RSA instead.
+
 You can run an example by running the following from the command line:
 `python -m neteria.encryption`"""
 
 import json
 import binascii
-import textwrap
+import itertools
+import os
+import struct
+import threading
 
 try:
     import rsa
 except:
     rsa = False
 
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
 
 class Encryption():
 
@@ -57,12 +71,13 @@ class Encryption():
         # Get the maximum message length based on the key
         max_str_len = rsa.common.byte_size(public_key.n) - 11
 
+        if not isinstance(message, bytes):
+            message = message.encode()
+
         # If the message is longer than the key size, split it into a list to
         # be encrypted
-        if len(message) > max_str_len:
-            message = textwrap.wrap(message, width=max_str_len)
-        else:
-            message = [message]
+        message = [message[i:i + max_str_len]
+                   for i in range(0, len(message), max_str_len)]
 
         # Create a list for the encrypted message to send
         enc_msg = []
@@ -76,7 +91,7 @@ class Encryption():
 
             # Convert the encrypted bytestring into ASCII, so we can send it
             # over the network
-            enc_line_converted = binascii.b2a_base64(enc_line)
+            enc_line_converted = binascii.b2a_base64(enc_line).decode()
 
             enc_msg.append(enc_line_converted)
 
@@ -115,18 +130,208 @@ class Encryption():
             unencrypted_msg.append(unencrypted_line)
 
         # Convert the message from a list back into a string
-        unencrypted_msg = "".join(unencrypted_msg)
+        unencrypted_msg = b"".join(unencrypted_msg)
 
         return unencrypted_msg
 
 
+    def encrypt_key(self, key, public_key):
+        """Encrypts a session key so it can be sent to the owner of the given
+        public key.
+
+        Args:
+          key (bytes): The session key to encrypt.
+          public_key (rsa.PublicKey): The key object used to encrypt the
+            session key.
+
+        Returns:
+          The encrypted key as an ASCII string.
+
+        """
+
+        return binascii.b2a_base64(rsa.encrypt(key, public_key)).decode()
+
+
+    def decrypt_key(self, message):
+        """Decrypts a session key that was encrypted with our public key.
+
+        Args:
+          message (string): The encrypted key from "encrypt_key".
+
+        Returns:
+          The session key.
+
+        """
+
+        return rsa.decrypt(binascii.a2b_base64(message), self.private_key)
+
+
+class Session():
+
+    """Encrypts and decrypts messages with a symmetric session key using
+    AES-GCM. Each encrypted message is the magic byte, a 12 byte nonce and
+    the authenticated ciphertext.
+
+    The nonce is made up of the direction of the message and a sequence
+    number, so the client and the server can share a key without ever reusing
+    a nonce.
+
+    Messages are only decrypted once. Messages encrypted in our own direction,
+    e.g. reflected back at us, are rejected, and so are sequence numbers that
+    have already been received. We remember the highest sequence number
+    received and which of the REPLAY_WINDOW numbers below it have been seen,
+    so older messages are rejected too. Packets that are sent again must be
+    encrypted again, e.g. with "reseal".
+
+    Args:
+      key (bytes): The session key. If not set, a new random key is generated.
+      direction (int): The direction of the messages we encrypt. Either
+        Session.CLIENT or Session.SERVER.
+
+    """
+
+    magic = b"\xe5"
+
+    CLIENT = 0
+    SERVER = 1
+
+    NONCE = struct.Struct("!IQ")
+
+    REPLAY_WINDOW = 1024
+
+    def __init__(self, key=None, direction=CLIENT):
+        self.key = key or os.urandom(32)
+        self.direction = direction
+        self.sequence = itertools.count()
+        self.aead = AESGCM(self.key)
+        self.received = -1  # The highest sequence number received.
+        self.seen = 0       # Bitmap of the numbers received below it.
+        self.lock = threading.Lock()
+
+
+    def encrypt(self, message):
+        """Encrypts a message with the session key.
+
+        Args:
+          message (bytes): The message to encrypt.
+
+        Returns:
+          The encrypted message.
+
+        """
+
+        nonce = self.NONCE.pack(self.direction, next(self.sequence))
+        return self.magic + nonce + self.aead.encrypt(nonce, message, None)
+
+
+    def decrypt(self, message):
+        """Decrypts a message encrypted with the session key. An exception is
+        raised if the message was not encrypted with our key, has been
+        tampered with, was encrypted in our own direction or has already been
+        received.
+
+        Args:
+          message (bytes): The encrypted message.
+
+        Returns:
+          The decrypted message.
+
+        """
+
+        if message[:1] != self.magic:
+            raise ValueError("Message is not encrypted with a session key.")
+        nonce = bytes(message[1:13])
+        direction, sequence = self.NONCE.unpack(nonce)
+        if direction == self.direction:
+            raise ValueError("Message was encrypted in our own direction.")
+
+        # Only remember the sequence number once the message is authentic, so
+        # forged messages can't use up numbers.
+        message = self.aead.decrypt(nonce, message[13:], None)
+        if not self.receive(sequence):
+            raise ValueError("Message has already been received.")
+        return message
+
+
+    def receive(self, sequence):
+        """Marks a sequence number as received.
+
+        Args:
+          sequence (int): The sequence number of a decrypted message.
+
+        Returns:
+          True if the number is new, or False if it was already received or
+          is too old to tell.
+
+        """
+
+        with self.lock:
+            if sequence > self.received:
+                shift = sequence - self.received
+                if shift < self.REPLAY_WINDOW:
+                    self.seen = ((self.seen << shift | 1) &
+                                 ((1 << self.REPLAY_WINDOW) - 1))
+                else:
+                    self.seen = 1
+                self.received = sequence
+                return True
+
+            offset = self.received - sequence
+            if offset >= self.REPLAY_WINDOW or self.seen >> offset & 1:
+                return False
+            self.seen |= 1 << offset
+            return True
+
+
+    def reseal(self, message, session=None):
+        """Decrypts a message that we encrypted with the session key and
+        encrypts it again with another session, e.g. when the peer has been
+        given a new session key. Messages that aren't encrypted with a
+        session key are encrypted as they are.
+
+        Args:
+          message (bytes): The message we encrypted.
+          session (Session): The session to encrypt the message with. If
+            None, the decrypted message is returned. Defaults to None.
+
+        Returns:
+          The message encrypted with the other session.
+
+        """
+
+        if message[:1] == self.magic:
+            message = self.aead.decrypt(message[1:13], message[13:], None)
+        if session:
+            return session.encrypt(message)
+        return message
+
+
+    def renew(self, message):
+        """Encrypts a message that we encrypted with the session key again
+        with a new nonce, so it isn't rejected as a replay when it is sent
+        again. Messages that aren't encrypted with a session key are returned
+        as they are.
+
+        Args:
+          message (bytes): The message we encrypted.
+
+        Returns:
+          The message encrypted with a new nonce.
+
+        """
+
+        if message[:1] != self.magic:
+            return message
+        return self.reseal(message, self)
+
+
 # Run an example if we execute standalone
 if __name__ == '__main__':
 
     import zlib
 
-    message = "hello asdmkasd" * 50
-    # message = "hi"
+    message = b"hello asdmkasd" * 50
+    # message = b"hi"
     print("Plain text:", message)
     message = zlib.compress(message)
     message = binascii.b2a_base64(message)
@@ -145,3 +350,13 @@ if __name__ == '__main__':
     uncompressed_msg = zlib.decompress(decrypted_msg)
     print("")
     print("Decompressed message:", uncompressed_msg)
+
+    if AESGCM:
+        session = Session()
+        key = enc.decrypt_key(enc.encrypt_key(session.key, enc.public_key))
+        msg = session.encrypt(uncompressed_msg)
+        print("")
+        print("Session encrypted message:", msg)
+        print("")
+        print("Session decrypted message:",
+              Session(key, Session.SERVER).decrypt(msg))
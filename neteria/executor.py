@@ -0,0 +1,228 @@
+#!/usr/bin/python
+#
+# Neteria
+# Copyright (C) 2014, William Edwards <shadowapex@gmail.com>,
+#
+# This file is part of Neteria.
+#
+# Neteria is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neteria is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neteria.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contributor(s):
+#
+# William Edwards <shadowapex@gmail.com>
+# Derek Clark <derekjohn.clark@gmail.com>
+#
+"""The executor module is used by the Neteria server to execute LEGAL events
+in the middleware.
+
+Events are queued per client, so the events of each client are always
+executed one at a time in the order they were received, while events from
+different clients are executed in parallel by a fixed number of workers.
+
+In "process" mode the work is done by a module level function in a pool of
+worker processes, which can't change the server's game state. The result of
+the function is returned to the server process, where the submitted function
+is called with it to apply it.
+
+Examples:
+  >>> from neteria.executor import EventExecutor
+  >>> from neteria.server import NeteriaServer
+  >>>
+  >>> executor = EventExecutor(mode="thread", workers=8, max_queue=4096)
+  >>> myserver = NeteriaServer(middleware, executor=executor)
+
+"""
+
+import logging
+import threading
+import traceback
+
+from collections import deque
+
+# Create a logger for optional handling of debug messages.
+logger = logging.getLogger(__name__)
+
+
+class EventExecutor(object):
+    """Executes functions in order per key with a fixed number of workers and a
+    bounded queue.
+
+    Args:
+      mode (string): How functions are executed. "thread" executes them in a
+        pool of worker threads. "process" executes "function" in a pool of
+        worker processes and then the submitted function with its result, so
+        the arguments must be picklable. "inline" executes them immediately
+        in the calling thread. Defaults to "thread".
+      function (function): The function executed in the worker processes in
+        "process" mode, with the arguments of each submitted function. It
+        must be a picklable module level function and return a picklable
+        result. The submitted function is then called in the calling process
+        with the same arguments plus the result. Required in "process" mode,
+        and ignored otherwise. Defaults to None.
+      workers (int): The number of worker threads or processes. Defaults to 4.
+      max_queue (int): The maximum number of functions that can be waiting to
+        be executed over all keys. Defaults to 1024.
+      policy (string): What to do when the queue is full. "block" waits until
+        there is space in the queue. "drop" discards the function. Defaults
+        to "block".
+
+    """
+
+    def __init__(self, mode="thread", workers=4, max_queue=1024,
+                 policy="block", function=None):
+        if mode not in ("thread", "process", "inline"):
+            raise ValueError("Unknown executor mode: " + str(mode))
+        if mode == "process" and function is None:
+            raise ValueError("The process mode requires a function to "
+                             "execute in the worker processes")
+        if policy not in ("block", "drop"):
+            raise ValueError("Unknown executor policy: " + str(policy))
+
+        self.mode = mode
+        self.workers = workers
+        self.max_queue = max_queue
+        self.policy = policy
+        self.function = function
+
+        # Queued functions for each key, and the keys that have functions
+        # waiting to be executed and are not being executed right now.
+        self.queues = {}
+        self.ready = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        self.metrics = {"queue_depth": 0,
+                        "max_queue_depth": 0,
+                        "executed": 0,
+                        "dropped": 0}
+
+        self.pool = None
+        self.threads = []
+        if mode == "process":
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(workers)
+
+        if mode != "inline":
+            for i in range(workers):
+                thread = threading.Thread(target=self.worker)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, key, function, *args):
+        """Queues a function to be executed after all other functions that
+        were submitted with the same key.
+
+        Args:
+          key (any): The key to order functions by, e.g. a client's cuuid.
+          function (function): The function to execute.
+          *args: The arguments to execute the function with.
+
+        Returns:
+          True if the function was queued, or False if it was dropped because
+          the queue is full.
+
+        """
+
+        if self.mode == "inline":
+            self.execute(function, args)
+            with self.lock:
+                self.metrics["executed"] += 1
+            return True
+
+        with self.lock:
+            while self.metrics["queue_depth"] >= self.max_queue:
+                if self.policy == "drop":
+                    self.metrics["dropped"] += 1
+                    logger.warning("Executor queue is full. Dropping event "
+                                   "for: " + str(key))
+                    return False
+                self.not_full.wait()
+
+            if key in self.queues:
+                self.queues[key].append((function, args))
+            else:
+                self.queues[key] = deque([(function, args)])
+                self.ready.append(key)
+                self.not_empty.notify()
+
+            self.metrics["queue_depth"] += 1
+            if self.metrics["queue_depth"] > self.metrics["max_queue_depth"]:
+                self.metrics["max_queue_depth"] = self.metrics["queue_depth"]
+
+        return True
+
+    def worker(self):
+        """Executes queued functions. Only one worker will execute functions
+        for a given key at any time.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        while True:
+            with self.lock:
+                while not self.ready:
+                    self.not_empty.wait()
+                key = self.ready.popleft()
+                function, args = self.queues[key].popleft()
+
+            self.execute(function, args)
+
+            with self.lock:
+                self.metrics["queue_depth"] -= 1
+                self.metrics["executed"] += 1
+                self.not_full.notify()
+
+                # Put the key at the back of the line if it has more to do, so
+                # busy clients can't starve the others.
+                if self.queues[key]:
+                    self.ready.append(key)
+                    self.not_empty.notify()
+                else:
+                    del self.queues[key]
+
+    def execute(self, function, args):
+        try:
+            if self.pool:
+                result = self.pool.submit(self.function, *args).result()
+                function(*(args + (result,)))
+            else:
+                function(*args)
+        except Exception:
+            logger.error("Error executing " + str(function))
+            logger.error(traceback.format_exc())
+
+    def stats(self):
+        """Returns the executor's queue metrics.
+
+        Args:
+          None
+
+        Returns:
+          A dictionary with the current and maximum number of queued functions,
+          the number of executed and dropped functions and the number of keys
+          with queued functions.
+
+        """
+
+        with self.lock:
+            stats = dict(self.metrics)
+            stats["queued_keys"] = len(self.queues)
+        return stats
@@ -0,0 +1,448 @@
+#!/usr/bin/python
+#
+# Neteria
+# Copyright (C) 2014, William Edwards <shadowapex@gmail.com>,
+#
+# This file is part of Neteria.
+#
+# Neteria is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neteria is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neteria.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contributor(s):
+#
+# William Edwards <shadowapex@gmail.com>
+# Derek Clark <derekjohn.clark@gmail.com>
+#
+"""The fragment module splits messages that are too large for a single
+datagram into fragments, and puts them back together on the other side.
+
+Every fragment starts with a small header with the id of the message, its
+total size, the size of each fragment and the index of the fragment:
+
+  FRAGMENT_MAGIC | id | size | fragment size | index | data
+
+The receiver copies each fragment into a buffer that is allocated once for
+the whole message. If fragments stop arriving before the message is
+complete, the receiver sends a FRAGMENT ACK with a bitmap of the fragments
+it has, and the sender resends only the ones that are missing:
+
+  FRAGMENT_ACK_MAGIC | id | bitmap
+
+A FRAGMENT ACK without a bitmap is sent when the message is complete, so the
+sender can forget it. If the sender is asked to send the same message to the
+same address again before then, e.g. when a NOTIFY is retransmitted, only the
+fragments that haven't been acknowledged are sent.
+
+Examples:
+  >>> fragments = Fragmenter(listener, mtu=1400)
+  >>> datagrams = fragments.split(message, address)
+  >>> fragments.receive(datagrams[0][0], address)
+
+"""
+
+import itertools
+import logging
+import random
+import threading
+
+from collections import OrderedDict
+
+from .codec import pack_varint
+from .codec import unpack_varint
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+# Create a logger for optional handling of debug messages.
+logger = logging.getLogger(__name__)
+
+# Fragments and their acknowledgements start with these magic bytes.
+FRAGMENT_MAGIC = b"\xb6"
+FRAGMENT_ACK_MAGIC = b"\xb7"
+
+# The largest possible fragment header, with four 5 byte varints.
+HEADER_SIZE = 21
+
+# The number of completed messages to remember per fragmenter, so late
+# fragments of a message we've already delivered are acknowledged instead of
+# being reassembled again.
+COMPLETED_HISTORY = 256
+
+
+def as_bytes(data):
+    """Returns data that can be indexed for integers. Python 2 strings and
+    memoryviews index as characters, so they are copied into a bytearray."""
+    if bytes is str or not isinstance(data, (bytes, bytearray, memoryview)):
+        return bytearray(data)
+    return data
+
+
+def pack_bitmap(bits):
+    """Packs a bitmap as little endian bytes, like int.to_bytes, which
+    Python 2 doesn't have."""
+    return bytes(bytearray((bits >> shift) & 0xff
+                           for shift in range(0, bits.bit_length(), 8)))
+
+
+def unpack_bitmap(data):
+    """Unpacks a bitmap packed with pack_bitmap."""
+    bits = 0
+    for index, byte in enumerate(bytearray(data)):
+        bits |= byte << (8 * index)
+    return bits
+
+
+class Reassembly(object):
+    """A message whose fragments are being received.
+
+    Args:
+      size (int): The total size of the message in bytes.
+      fragment_size (int): The size of every fragment but the last one.
+      now (float): The monotonic time the first fragment arrived.
+
+    """
+
+    __slots__ = ("buffer", "fragment_size", "count", "received", "remaining",
+                 "started", "progress")
+
+    def __init__(self, size, fragment_size, now):
+        self.buffer = bytearray(size)
+        self.fragment_size = fragment_size
+        self.count = (size + fragment_size - 1) // fragment_size
+        self.received = 0   # Bit n is set if fragment n has arrived.
+        self.remaining = self.count
+        self.started = now
+        self.progress = True  # Whether a fragment arrived since the last check.
+
+
+class Fragmenter(object):
+    """Splits large messages into fragments for a listener, and reassembles
+    the fragments it receives.
+
+    Args:
+      listener (core.ListenerUDP): The listener that sends the fragments and
+        acknowledgements, and schedules checks for missing fragments.
+      mtu (int): The largest datagram to send in bytes, including the
+        fragment header. Defaults to 1400.
+      max_message_size (int): The largest message in bytes that will be sent
+        or reassembled. Defaults to 1 MiB.
+      memory_limit (int): The maximum number of bytes used for messages being
+        reassembled, and separately for sent messages kept to resend missing
+        fragments. Defaults to 8 MiB.
+      timeout (float): The number of seconds to wait for the fragments of a
+        message to arrive, and to keep sent messages for resending. Defaults
+        to 5.0 seconds.
+      nack_delay (float): The number of seconds without any new fragments
+        after which the receiver asks for the missing ones. Defaults to 0.1
+        seconds.
+
+    """
+
+    def __init__(self, listener, mtu=1400, max_message_size=1048576,
+                 memory_limit=8388608, timeout=5.0, nack_delay=0.1):
+        if mtu <= HEADER_SIZE:
+            raise ValueError("The mtu must be larger than %d bytes" %
+                             HEADER_SIZE)
+
+        self.listener = listener
+        self.mtu = mtu
+        self.fragment_size = mtu - HEADER_SIZE
+        self.max_message_size = max_message_size
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        self.nack_delay = nack_delay
+        # Start at a random id, so a restarted sender isn't mistaken for
+        # the one before it.
+        self.message_ids = itertools.count(random.randrange(1 << 20))
+        self.lock = threading.Lock()
+
+        # Sent messages keyed by (address, message), and the same entries
+        # keyed by (address, id) to find them by their acknowledgements. Each
+        # entry is a list of [id, key, fragments, acked bitmap, sent time].
+        self.sent = OrderedDict()
+        self.sent_ids = {}
+        self.sent_memory = 0
+
+        # Messages being reassembled keyed by (address, id), and the keys of
+        # recently completed messages.
+        self.received = OrderedDict()
+        self.received_memory = 0
+        self.completed = OrderedDict()
+
+        self.stats = {"fragmented": 0,
+                      "reassembled": 0,
+                      "resent": 0,
+                      "dropped": 0}
+
+    def split(self, message, address):
+        """Splits a message into fragments. If the same message was split
+        for the same address recently, only the fragments that haven't been
+        acknowledged yet are returned.
+
+        Args:
+          message (bytes): The raw serialized message to send.
+          address (tuple): The address and port the message is sent to.
+
+        Returns:
+          A list of (fragment, address) tuples to send.
+
+        """
+
+        if len(message) > self.max_message_size:
+            raise Exception("Message is too large. Messages should be under "
+                            "%d bytes in size." % self.max_message_size)
+
+        now = monotonic()
+        key = (address, bytes(message))
+        with self.lock:
+            self.forget(now)
+
+            entry = self.sent.get(key)
+            if entry:
+                entry[4] = now
+                self.sent[key] = self.sent.pop(key)
+                missing = [(fragment, address)
+                           for index, fragment in enumerate(entry[2])
+                           if not (entry[3] >> index) & 1]
+                self.stats["resent"] += len(missing)
+                return missing
+
+            message_id = next(self.message_ids)
+            view = memoryview(key[1])
+            size = len(view)
+            step = self.fragment_size
+            header = (FRAGMENT_MAGIC + pack_varint(message_id) +
+                      pack_varint(size) + pack_varint(step))
+            fragments = [header + pack_varint(index) +
+                         view[offset:offset + step].tobytes()
+                         for index, offset in enumerate(range(0, size, step))]
+
+            entry = [message_id, key, fragments, 0, now]
+            self.sent[key] = entry
+            self.sent_ids[(address, message_id)] = entry
+            self.sent_memory += size
+            self.stats["fragmented"] += 1
+
+            # Forget the oldest messages if we're keeping too many.
+            while self.sent_memory > self.memory_limit and len(self.sent) > 1:
+                self.discard(next(iter(self.sent)))
+
+        return [(fragment, address) for fragment in fragments]
+
+    def receive(self, data, address):
+        """Copies a received fragment into the buffer of its message.
+
+        Args:
+          data (bytes): The raw fragment. This may also be a memoryview.
+          address (tuple): The address and port the fragment came from.
+
+        Returns:
+          The complete message as a bytearray once its last fragment has
+          arrived, otherwise None.
+
+        """
+
+        data = as_bytes(data)
+        try:
+            message_id, offset = unpack_varint(data, 1)
+            size, offset = unpack_varint(data, offset)
+            fragment_size, offset = unpack_varint(data, offset)
+            index, offset = unpack_varint(data, offset)
+        except IndexError:
+            logger.error("Malformed fragment received from " + str(address))
+            return None
+
+        key = (address, message_id)
+        now = monotonic()
+        ack = None
+        message = None
+        with self.lock:
+            reassembly = self.received.get(key)
+            if reassembly is None:
+                # The sender didn't hear that we have the whole message.
+                if key in self.completed:
+                    ack = self.pack_ack(message_id, -1)
+                elif not self.start(key, size, fragment_size, now):
+                    return None
+                else:
+                    reassembly = self.received[key]
+
+            if reassembly is not None:
+                start = index * reassembly.fragment_size
+                end = min(start + reassembly.fragment_size, size)
+                if (index >= reassembly.count or len(data) - offset !=
+                        end - start or size != len(reassembly.buffer)):
+                    logger.error("Malformed fragment received from " +
+                                 str(address))
+                    return None
+
+                if not (reassembly.received >> index) & 1:
+                    reassembly.buffer[start:end] = data[offset:]
+                    reassembly.received |= 1 << index
+                    reassembly.remaining -= 1
+                    reassembly.progress = True
+
+                if not reassembly.remaining:
+                    del self.received[key]
+                    self.received_memory -= size
+                    self.completed[key] = True
+                    if len(self.completed) > COMPLETED_HISTORY:
+                        self.completed.popitem(last=False)
+                    self.stats["reassembled"] += 1
+                    message = reassembly.buffer
+                    ack = self.pack_ack(message_id, -1)
+
+        if ack:
+            self.listener.send_datagrams([(ack, address)])
+        return message
+
+    def start(self, key, size, fragment_size, now):
+        """Allocates the buffer for a new message if it is within our limits.
+        Must be called with the lock held.
+
+        Returns:
+          True if the message is being reassembled, otherwise False.
+
+        """
+
+        if not 0 < fragment_size < size or size > self.max_message_size:
+            logger.warning("Dropping fragmented message of %d bytes from "
+                           "%s" % (size, str(key[0])))
+            self.stats["dropped"] += 1
+            return False
+
+        # Give up on messages that have run out of time, then make sure the
+        # new buffer fits in our memory limit.
+        for other in list(self.received):
+            if now - self.received[other].started <= self.timeout:
+                break
+            self.drop(other)
+        if self.received_memory + size > self.memory_limit:
+            logger.warning("Reassembly memory limit reached. Dropping "
+                           "fragmented message from %s" % str(key[0]))
+            self.stats["dropped"] += 1
+            return False
+
+        self.received[key] = Reassembly(size, fragment_size, now)
+        self.received_memory += size
+        self.listener.call_later(self.nack_delay, self.check, key)
+        return True
+
+    def check(self, key):
+        """Asks the sender for the missing fragments of a message if no new
+        fragments have arrived since the last check, and gives up on the
+        message once it has run out of time.
+
+        Args:
+          key (tuple): The (address, id) of the message.
+
+        Returns:
+          None
+
+        """
+
+        with self.lock:
+            reassembly = self.received.get(key)
+            if reassembly is None:
+                return
+
+            if monotonic() - reassembly.started > self.timeout:
+                logger.warning("Timed out reassembling message from " +
+                               str(key[0]))
+                self.drop(key)
+                return
+
+            ack = None
+            if not reassembly.progress:
+                ack = self.pack_ack(key[1], reassembly.received)
+            reassembly.progress = False
+
+        if ack:
+            self.listener.send_datagrams([(ack, key[0])])
+        self.listener.call_later(self.nack_delay, self.check, key)
+
+    def acknowledge(self, data, address):
+        """Handles a FRAGMENT ACK from the receiver of a message, resending
+        the fragments it is missing.
+
+        Args:
+          data (bytes): The raw acknowledgement. This may also be a
+            memoryview.
+          address (tuple): The address and port the acknowledgement came from.
+
+        Returns:
+          None
+
+        """
+
+        data = as_bytes(data)
+        try:
+            message_id, offset = unpack_varint(data, 1)
+        except IndexError:
+            logger.error("Malformed fragment ack received from " +
+                         str(address))
+            return
+
+        with self.lock:
+            entry = self.sent_ids.get((address, message_id))
+            if entry is None:
+                return
+
+            fragments = entry[2]
+            if offset < len(data):
+                entry[3] |= unpack_bitmap(data[offset:])
+            else:
+                entry[3] = (1 << len(fragments)) - 1
+            if entry[3] == (1 << len(fragments)) - 1:
+                self.discard(entry[1])
+                return
+
+            entry[4] = monotonic()
+            self.sent[entry[1]] = self.sent.pop(entry[1])
+            missing = [(fragment, address)
+                       for index, fragment in enumerate(fragments)
+                       if not (entry[3] >> index) & 1]
+            self.stats["resent"] += len(missing)
+
+        self.listener.send_datagrams(missing)
+
+    def pack_ack(self, message_id, received):
+        """Returns a FRAGMENT ACK with the bitmap of received fragments. A
+        bitmap of -1 acknowledges the whole message."""
+        if received < 0:
+            return FRAGMENT_ACK_MAGIC + pack_varint(message_id)
+        return (FRAGMENT_ACK_MAGIC + pack_varint(message_id) +
+                pack_bitmap(received))
+
+    def forget(self, now):
+        """Forgets sent messages that haven't been resent or acknowledged in
+        time. Must be called with the lock held."""
+        for key in list(self.sent):
+            if now - self.sent[key][4] <= self.timeout:
+                break
+            self.discard(key)
+
+    def discard(self, key):
+        """Forgets a sent message. Must be called with the lock held."""
+        entry = self.sent.pop(key)
+        del self.sent_ids[(key[0], entry[0])]
+        self.sent_memory -= len(key[1])
+
+    def drop(self, key):
+        """Gives up on a message being reassembled. Must be called with the
+        lock held."""
+        reassembly = self.received.pop(key)
+        self.received_memory -= len(reassembly.buffer)
+        self.stats["dropped"] += 1
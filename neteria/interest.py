@@ -0,0 +1,211 @@
+#!/usr/bin/python
+#
+# Neteria
+# Copyright (C) 2014, William Edwards <shadowapex@gmail.com>,
+#
+# This file is part of Neteria.
+#
+# Neteria is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neteria is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neteria.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contributor(s):
+#
+# William Edwards <shadowapex@gmail.com>
+# Derek Clark <derekjohn.clark@gmail.com>
+#
+"""The interest module decides which clients an update in the game world is
+relevant to, so it is only sent to the clients that are close enough to
+see it.
+
+Clients and entities are stored with a position and a radius in a uniform
+grid of square cells. Each of them is added to every cell that its circle
+overlaps, so finding everything that overlaps an area only has to look at
+the few cells the area covers, no matter how many clients there are in the
+rest of the world. Cells work best when they are about as large as the
+clients' areas of interest. Circles that would overlap too many cells are
+kept apart instead, and checked by every query.
+
+Positions can have any number of dimensions, as long as they all have the
+same number.
+
+Examples:
+  >>> grid = SpatialGrid(cell_size=100.0)
+  >>> grid.update(cuuid, (120.0, 64.0), radius=250.0)
+  >>> grid.query((300.0, 80.0), radius=10.0)
+  ['45e2e9c6-6c4a-11e4-a5c7-080027ad5e2c']
+
+"""
+
+import itertools
+import math
+import threading
+
+# The largest number of cells a circle is added to. Larger circles are
+# checked by every query instead.
+MAX_CELLS = 64
+
+
+class SpatialGrid(object):
+    """Indexes circles by the cells of a uniform grid they overlap.
+
+    Args:
+      cell_size (float): The width of each cell. Defaults to 100.0.
+      max_cells (int): The largest number of cells a circle is added to.
+        Larger circles are kept apart and checked by every query. Defaults
+        to MAX_CELLS.
+
+    """
+
+    def __init__(self, cell_size=100.0, max_cells=MAX_CELLS):
+        if cell_size <= 0:
+            raise ValueError("The cell size must be larger than 0")
+
+        self.cell_size = float(cell_size)
+        self.max_cells = max_cells
+        self.cells = {}   # The keys in each cell by cell coordinates.
+        self.items = {}   # (position, radius, bounds) by key.
+        self.large = set()  # The keys of the circles that aren't in cells.
+        self.lock = threading.Lock()
+
+    def bounds(self, position, radius):
+        """Returns the lowest and highest cell coordinates a circle
+        overlaps."""
+        size = self.cell_size
+        return (tuple(int(math.floor((value - radius) / size))
+                      for value in position),
+                tuple(int(math.floor((value + radius) / size))
+                      for value in position))
+
+    def count(self, bounds):
+        """Returns the number of cells between two corners."""
+        count = 1
+        for low, high in zip(*bounds):
+            count *= high - low + 1
+        return count
+
+    def update(self, key, position, radius=0.0):
+        """Adds a circle to the grid, or moves it. Moving a circle within the
+        cells it already overlaps doesn't change the grid.
+
+        Args:
+          key (any): The hashable key of the circle, e.g. a client's cuuid.
+          position (tuple): The coordinates of the center of the circle.
+          radius (float): The radius of the circle. Defaults to 0.0.
+
+        Returns:
+          None
+
+        """
+
+        position = tuple(position)
+        bounds = self.bounds(position, radius)
+        if self.count(bounds) > self.max_cells:
+            bounds = None
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[2] != bounds:
+                if item is not None:
+                    self.unlink(key, item[2])
+                if bounds is None:
+                    self.large.add(key)
+                else:
+                    for cell in self.covered(bounds):
+                        keys = self.cells.get(cell)
+                        if keys is None:
+                            keys = self.cells[cell] = set()
+                        keys.add(key)
+            self.items[key] = (position, radius, bounds)
+
+    def remove(self, key):
+        """Removes a circle from the grid.
+
+        Returns:
+          True if the circle was in the grid, otherwise False.
+
+        """
+
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return False
+            self.unlink(key, item[2])
+            return True
+
+    def unlink(self, key, bounds):
+        """Removes a key from the cells it was in. Must be called with the
+        lock held."""
+        if bounds is None:
+            self.large.discard(key)
+            return
+        for cell in self.covered(bounds):
+            keys = self.cells.get(cell)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.cells[cell]
+
+    def covered(self, bounds):
+        """Returns an iterator over the cells between two corners."""
+        return itertools.product(*[range(low, high + 1)
+                                   for low, high in zip(*bounds)])
+
+    def query(self, position, radius=0.0):
+        """Finds the circles that overlap a circle.
+
+        Args:
+          position (tuple): The coordinates of the center of the circle.
+          radius (float): The radius of the circle. Defaults to 0.0.
+
+        Returns:
+          A list of the keys of the overlapping circles.
+
+        """
+
+        position = tuple(position)
+        bounds = self.bounds(position, radius)
+        found = []
+        with self.lock:
+            # Look at every circle instead if the area covers more cells
+            # than there are circles.
+            if self.count(bounds) > len(self.items):
+                candidates = self.items
+            else:
+                candidates = set(self.large)
+                for cell in self.covered(bounds):
+                    keys = self.cells.get(cell)
+                    if keys:
+                        candidates.update(keys)
+
+            for key in candidates:
+                center, reach, cells = self.items[key]
+                reach += radius
+                distance = 0.0
+                for a, b in zip(position, center):
+                    distance += (a - b) * (a - b)
+                if distance <= reach * reach:
+                    found.append(key)
+
+        return found
+
+    def get(self, key, default=None):
+        """Returns the (position, radius) of a circle."""
+        item = self.items.get(key)
+        if item is None:
+            return default
+        return item[0], item[1]
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
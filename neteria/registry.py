@@ -0,0 +1,225 @@
+#!/usr/bin/python
+#
+# Neteria
+# Copyright (C) 2014, William Edwards <shadowapex@gmail.com>,
+#
+# This file is part of Neteria.
+#
+# Neteria is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neteria is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neteria.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contributor(s):
+#
+# William Edwards <shadowapex@gmail.com>
+# Derek Clark <derekjohn.clark@gmail.com>
+#
+"""The registry module keeps track of the clients that are registered with a
+Neteria server.
+
+Each client is stored as a small ClientRecord, which can be looked up by the
+client's cuuid or by the (address, port) that its packets are sent from.
+
+Examples:
+  >>> record = myserver.registry.get_by_address(("192.168.0.20", 51280))
+  >>> record.cuuid
+  '45e2e9c6-6c4a-11e4-a5c7-080027ad5e2c'
+  >>> myserver.registry[record.cuuid]["host"]
+  '192.168.0.20'
+
+"""
+
+import itertools
+import threading
+
+from collections import OrderedDict
+from collections import deque
+
+from .window import ReceiveWindow
+from .window import SendWindow
+
+
+class ClientRecord(object):
+    """The registry information of a single client.
+
+    For compatibility, the fields of a record can also be accessed like a
+    dictionary, e.g. record["host"].
+
+    Args:
+      cuuid (string): The client's universally unique identifier.
+      host (string): The address of the client.
+      port (int): The port of the client.
+      time (datetime): The time the client registered.
+      registered (float): The monotonic time the client registered.
+      cid (int): The connection id the client identifies itself with.
+
+    """
+
+    __slots__ = ("cuuid", "host", "port", "address", "time", "authenticated",
+                 "encryption", "session", "codec", "registered", "last_seen",
+                 "expire_call", "windows", "responses", "judged", "cid", "sequence",
+                 "multicast", "outbox", "outbox_size", "unreliable_sequence",
+                 "latest_sequence", "rtt", "retransmit_call", "retransmit_due",
+                 "notify_queue", "state_baseline")
+
+    def __init__(self, cuuid, host, port, time, registered=0.0, cid=None):
+        self.cuuid = cuuid
+        self.cid = cid
+        self.host = host
+        self.port = port
+        self.address = (host, port)
+        self.time = time
+        self.registered = registered
+        self.last_seen = registered  # Monotonic time of the last packet.
+        self.expire_call = None  # The scheduled call to expire the client.
+        # Our judgements and NOTIFY messages that the client hasn't
+        # confirmed yet, and the scheduled call that retransmits them.
+        self.windows = {"EVENT": SendWindow(), "NOTIFY": SendWindow()}
+        self.retransmit_call = None
+        self.retransmit_due = 0.0
+        self.notify_queue = deque()  # NOTIFY messages waiting for room.
+        self.state_baseline = 0  # The newest state snapshot it has applied.
+        self.responses = OrderedDict()  # Recent serialized responses by euuid.
+        self.judged = ReceiveWindow()  # The events we've already judged.
+        self.sequence = itertools.count(1)  # Ids of NOTIFY messages we send.
+        self.unreliable_sequence = itertools.count(1)  # Ids of unreliable ones.
+        self.latest_sequence = 0  # The newest sequenced event we've received.
+        self.rtt = None  # The core.RTTEstimator for the client.
+        self.multicast = False  # Whether the client joined the multicast group.
+        self.outbox = []        # Packets waiting for the next tick.
+        self.outbox_size = 0    # The size of the outbox as a bundle.
+        self.authenticated = False
+        self.encryption = None  # The client's RSA public key.
+        self.session = None     # The session used to encrypt the client's traffic.
+        self.codec = None       # The codec the client negotiated.
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def __repr__(self):
+        return "ClientRecord(%s)" % ", ".join(
+            "%s=%r" % (key, getattr(self, key)) for key in self.__slots__)
+
+
+class Registry(object):
+    """Stores client records indexed by cuuid and by (address, port).
+
+    Looking up a client by either index is a single dictionary lookup. The
+    indexes are copied and replaced whenever a client is added or removed, so
+    looking up and iterating over clients never needs a lock, even while
+    another thread is registering clients.
+
+    The registry behaves like a read only dictionary of records keyed by
+    cuuid.
+
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.addresses = {}
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        """Adds a client record to the registry, replacing any existing record
+        with the same cuuid.
+
+        Args:
+          record (ClientRecord): The client record to add.
+
+        Returns:
+          None
+
+        """
+
+        with self.lock:
+            clients = self.clients.copy()
+            addresses = self.addresses.copy()
+
+            previous = clients.get(record.cuuid)
+            if previous and addresses.get(previous.address) is previous:
+                del addresses[previous.address]
+
+            clients[record.cuuid] = record
+            addresses[record.address] = record
+
+            self.clients = clients
+            self.addresses = addresses
+
+    def remove(self, cuuid):
+        """Removes a client from the registry.
+
+        Args:
+          cuuid (string): The cuuid of the client to remove.
+
+        Returns:
+          The removed client record, or None if the client was not registered.
+
+        """
+
+        with self.lock:
+            if cuuid not in self.clients:
+                return None
+
+            clients = self.clients.copy()
+            addresses = self.addresses.copy()
+
+            record = clients.pop(cuuid)
+            if addresses.get(record.address) is record:
+                del addresses[record.address]
+
+            self.clients = clients
+            self.addresses = addresses
+
+        return record
+
+    def get(self, cuuid, default=None):
+        """Returns the record of the client with the given cuuid."""
+        return self.clients.get(cuuid, default)
+
+    def get_by_address(self, address, default=None):
+        """Returns the record of the client at the given (address, port)."""
+        return self.addresses.get(address, default)
+
+    def records(self):
+        """Returns a snapshot of all client records that is safe to iterate
+        over while clients are registering."""
+        return self.clients.values()
+
+    def __getitem__(self, cuuid):
+        return self.clients[cuuid]
+
+    def __contains__(self, cuuid):
+        return cuuid in self.clients
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(self.clients)
+
+    def keys(self):
+        return self.clients.keys()
+
+    def items(self):
+        return self.clients.items()
+
+    def values(self):
+        return self.clients.values()
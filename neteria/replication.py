@@ -0,0 +1,377 @@
+#!/usr/bin/python
+#
+# Neteria
+# Copyright (C) 2014, William Edwards <shadowapex@gmail.com>,
+#
+# This file is part of Neteria.
+#
+# Neteria is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neteria is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neteria.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contributor(s):
+#
+# William Edwards <shadowapex@gmail.com>
+# Derek Clark <derekjohn.clark@gmail.com>
+#
+"""The replication module keeps a mirror of the server's game state on every
+client, sending only what has changed.
+
+The server registers named state dictionaries with a Replicator. Every tick
+the replicator takes a snapshot of all of them, flattened into a dictionary
+of leaf values keyed by their path, and numbers it if anything changed since
+the previous snapshot. Only the paths that changed are kept for each
+snapshot number.
+
+Each client acknowledges the newest snapshot it has applied, which becomes
+its baseline. The client is then sent a STATE message with every path that
+changed after its baseline, with the current values, and the paths that
+were removed:
+
+  {"method": "STATE", "seq": 12, "base": 9,
+   "set": {"world": {"players": {"p1": {"x": 120}}}},
+   "removed": [["world", "players", "p2"]]}
+
+STATE messages aren't retransmitted. If one is lost, the next one still
+holds everything that changed since the baseline. A message with a "base"
+of 0 holds the whole state, and is sent to new clients and to clients whose
+baseline is older than the changes we remember.
+
+Floats can be quantized to a fixed precision, so small changes aren't sent
+and the values are packed as small integers.
+
+Examples:
+  >>> myserver.add_state("world", world, quantize={"x": 0.01, "y": 0.01})
+  >>> myserver.replicate()
+  >>> myclient.replica.state["world"]["players"]["p1"]["x"]
+  120.0
+
+"""
+
+import math
+import threading
+
+from collections import OrderedDict
+
+from .codec import numpy
+
+
+def quantize(value, precision):
+    """Rounds a number, or the numbers in a list, to a whole number of
+    "precision" units. Booleans and numbers that aren't finite are kept
+    as they are."""
+    value_type = type(value)
+    if value_type in (list, tuple):
+        return [quantize(item, precision) for item in value]
+    if value_type is int or (value_type is float and math.isfinite(value)):
+        return int(round(value / precision))
+    return value
+
+
+def dequantize(value, precision):
+    """Converts a number, or the numbers in a list, quantized with quantize
+    back to floats."""
+    value_type = type(value)
+    if value_type is list:
+        return [dequantize(item, precision) for item in value]
+    if value_type is int:
+        return value * precision
+    return value
+
+
+def copy_leaf(value):
+    """Returns a copy of a leaf value that won't change along with the state
+    it was taken from."""
+    value_type = type(value)
+    if value_type in (list, tuple):
+        return [copy_leaf(item) for item in value]
+    if value_type is dict:
+        return {}
+    if value_type is bytearray:
+        return bytes(value)
+    if numpy is not None and value_type is numpy.ndarray:
+        return value.copy()
+    if hasattr(value, "typecode"):
+        return value[:]
+    return value
+
+
+def same(old, new):
+    """Returns whether a leaf value is unchanged between two snapshots."""
+    if type(old) is not type(new):
+        return False
+    if numpy is not None and type(new) is numpy.ndarray:
+        return (old.dtype == new.dtype and old.shape == new.shape and
+                bool((old == new).all()))
+    return old == new
+
+
+def flatten(state, prefix, precisions, flat):
+    """Adds the leaf values of a nested state dictionary to a flat dictionary
+    keyed by their path. Empty dictionaries are leaves.
+
+    Args:
+      state (dict): The state to flatten.
+      prefix (tuple): The path of the state.
+      precisions (dict): The precision to quantize the values of each key
+        to. Keys that aren't in it aren't quantized.
+      flat (dict): The flat dictionary to add the leaf values to.
+
+    Returns:
+      None
+
+    """
+
+    for key, value in state.items():
+        path = prefix + (key,)
+        if type(value) is dict and value:
+            flatten(value, path, precisions, flat)
+        elif key in precisions:
+            flat[path] = quantize(copy_leaf(value), precisions[key])
+        else:
+            flat[path] = copy_leaf(value)
+
+
+class Replicator(object):
+    """Takes numbered snapshots of the server's states and builds the
+    deltas that bring a client from its baseline up to date.
+
+    Args:
+      history (int): The number of snapshots to remember the changes of.
+        Clients whose baseline is older are sent the whole state. Defaults
+        to 32.
+
+    """
+
+    def __init__(self, history=32):
+        self.history = history
+        self.states = OrderedDict()  # (state, precisions) by name.
+        self.added = {}       # The snapshot each state was first part of.
+        self.seq = 0          # The number of the latest snapshot.
+        self.flat = {}        # The latest snapshot by path.
+        self.changes = OrderedDict()  # The paths changed by each snapshot.
+        self.deltas = {}      # Deltas to the latest snapshot by baseline.
+        self.lock = threading.Lock()
+        self.stats = {"snapshots": 0,
+                      "deltas": 0,
+                      "full": 0}
+
+    def add(self, name, state, quantize=None):
+        """Starts replicating a state.
+
+        Args:
+          name (string): The name of the state on the clients.
+          state (dict): The state to replicate. This may also be an object,
+            whose public attributes are replicated, or a function that
+            returns the state.
+          quantize (dict): The precision to quantize the floats under each
+            key to, e.g. {"x": 0.01}. Defaults to None.
+
+        Returns:
+          None
+
+        """
+
+        with self.lock:
+            self.states[name] = (state, quantize or {})
+            self.added.pop(name, None)
+
+    def remove(self, name):
+        """Stops replicating a state. It is removed from the clients with
+        the next snapshot."""
+        with self.lock:
+            self.states.pop(name, None)
+
+    def snapshot(self):
+        """Takes a snapshot of every state, and numbers it if anything has
+        changed since the previous one.
+
+        Returns:
+          The number of the latest snapshot.
+
+        """
+
+        with self.lock:
+            flat = {}
+            for name, (state, precisions) in self.states.items():
+                if callable(state):
+                    state = state()
+                elif type(state) is not dict:
+                    state = dict((key, value)
+                                 for key, value in vars(state).items()
+                                 if not key.startswith("_"))
+                if state:
+                    flatten(state, (name,), precisions, flat)
+                else:
+                    flat[(name,)] = {}
+
+            previous = self.flat
+            changed = set(path for path in previous if path not in flat)
+            for path, value in flat.items():
+                if path not in previous or not same(previous[path], value):
+                    changed.add(path)
+            if not changed:
+                return self.seq
+
+            self.seq += 1
+            self.flat = flat
+            self.changes[self.seq] = changed
+            while len(self.changes) > self.history:
+                self.changes.popitem(last=False)
+            self.deltas = {}
+            for name in self.states:
+                self.added.setdefault(name, self.seq)
+            self.stats["snapshots"] += 1
+
+            return self.seq
+
+    def delta(self, baseline):
+        """Returns the changes since a snapshot that a client has applied.
+
+        Args:
+          baseline (int): The snapshot the client has acknowledged, or 0 if
+            it doesn't have one.
+
+        Returns:
+          A dictionary with the "seq" and "base" of the delta, the "set"
+          values and "removed" paths, and the precisions of the states that
+          are new to the client as "quantize". None if the client is up to
+          date. Deltas are cached, so they must not be changed.
+
+        """
+
+        with self.lock:
+            if baseline >= self.seq:
+                return None
+
+            # Send the whole state if we don't remember every change since
+            # the baseline.
+            if baseline and baseline + 1 not in self.changes:
+                baseline = 0
+            if baseline in self.deltas:
+                return self.deltas[baseline]
+
+            if baseline:
+                paths = set()
+                for seq in range(baseline + 1, self.seq + 1):
+                    paths.update(self.changes[seq])
+                self.stats["deltas"] += 1
+            else:
+                paths = self.flat
+                self.stats["full"] += 1
+
+            values = {}
+            removed = []
+            for path in paths:
+                if path not in self.flat:
+                    removed.append(list(path))
+                    continue
+                node = values
+                for key in path[:-1]:
+                    node = node.setdefault(key, {})
+                node[path[-1]] = self.flat[path]
+
+            delta = {"seq": self.seq, "base": baseline}
+            if values:
+                delta["set"] = values
+            if removed:
+                delta["removed"] = removed
+            precisions = dict(
+                (name, state[1]) for name, state in self.states.items()
+                if state[1] and self.added.get(name, 0) > baseline)
+            if precisions:
+                delta["quantize"] = precisions
+
+            self.deltas[baseline] = delta
+            return delta
+
+
+class Mirror(object):
+    """The client's copy of the states replicated by the server.
+
+    Attributes:
+      state (dict): The replicated states by name. It is changed in place
+        by the thread that handles the server's messages.
+      seq (int): The number of the latest snapshot applied.
+
+    """
+
+    def __init__(self):
+        self.state = {}
+        self.seq = 0
+        self.precisions = {}  # The precisions of each state by name.
+        self.replicating = False  # Whether the server has sent us any.
+
+    def reset(self):
+        """Forgets the snapshot we have, so only a whole state is applied
+        next. Used when registering with the server again."""
+        self.seq = 0
+
+    def apply(self, message):
+        """Applies a STATE message to the mirror, if it is newer than the
+        snapshot we have and we have the snapshot it was built against.
+
+        Args:
+          message (dict): The STATE message.
+
+        Returns:
+          True if the message was applied, otherwise False.
+
+        """
+
+        self.replicating = True
+        seq = message["seq"]
+        base = message["base"]
+        if seq <= self.seq or base > self.seq:
+            return False
+
+        if not base:
+            self.state = {}
+            self.precisions = {}
+        self.precisions.update(message.get("quantize", {}))
+
+        # Removing a path also removes the dictionaries it leaves empty. An
+        # empty dictionary that is still in the state is sent again.
+        for path in message.get("removed", ()):
+            nodes = [self.state]
+            for key in path[:-1]:
+                node = nodes[-1].get(key)
+                if type(node) is not dict:
+                    break
+                nodes.append(node)
+            else:
+                nodes[-1].pop(path[-1], None)
+                for index in range(len(nodes) - 1, 0, -1):
+                    if nodes[index]:
+                        break
+                    del nodes[index - 1][path[index - 1]]
+
+        for name, values in message.get("set", {}).items():
+            self.merge(self.state, name, values,
+                       self.precisions.get(name) or {})
+
+        self.seq = seq
+        return True
+
+    def merge(self, parent, key, value, precisions):
+        """Sets a value in the mirror, merging nested dictionaries."""
+        if type(value) is not dict or not value:
+            if key in precisions:
+                value = dequantize(value, precisions[key])
+            parent[key] = value
+            return
+
+        node = parent.get(key)
+        if type(node) is not dict:
+            node = parent[key] = {}
+        for child, item in value.items():
+            self.merge(node, child, item, precisions)
@@ -40,18 +40,33 @@ processing.
 You can run an example by running the following from the command line:
 `python -m neteria.server`"""
 
+import itertools
 import logging
 import threading
 import uuid
 
+from collections import OrderedDict
 from datetime import datetime
 from pprint import pformat
 from rsa import PublicKey
 
+from .codec import CODECS
+from .codec import JSON
+from .core import bundle_packets
+from .core import monotonic
 from .core import serialize_data
+from .core import RTTEstimator
 from .core import unserialize_data
 from .core import ListenerUDP
+from .encryption import AESGCM
 from .encryption import Encryption
+from .encryption import Session
+from .executor import EventExecutor
+from .interest import SpatialGrid
+from .registry import ClientRecord
+from .registry import Registry
+from .replication import Replicator
+from .stream import Streams
 
 # Create a logger for optional handling of debug messages.
 logger = logging.getLogger(__name__)
@@ -74,12 +89,20 @@ class NeteriaServer(object):
       server_name (string): The hostname of the server. Defaults to None.
       compression (boolean): Whether or not to enable zlib compression on all
         network traffic. Defaults to False.
-      encryption (boolean): Whether or not to enable RSA encryption on traffic
-        to the client. Defaults to False.
+      encryption (boolean): Whether or not to enable encryption on traffic
+        to the client. RSA keys are used to send each client a session key
+        when it registers, which is then used to encrypt all traffic with
+        AES-GCM. Defaults to False.
       timeout (float): The amount of time to wait in seconds for a confirmation
-        before retrying to send the message. Defaults to 2.0 seconds.
+        before retrying to send the message, until the round trip time to the
+        client has been measured. The timeout is then adapted to the round
+        trip time, and doubled with every retry. Defaults to 2.0 seconds.
       max_retries (int): The maximum number of retry attempts the server should
         try before considering the message has failed. Defaults to 4.
+      min_timeout (float): The smallest adapted timeout in seconds. Defaults
+        to 0.1 seconds.
+      max_timeout (float): The largest timeout in seconds, including the
+        backoff of retries. Defaults to 30.0 seconds.
       registration_limit (int): The maximum number of clients that can be
         connected and registered with the server. Defaults to 50.
       stats (boolean): Whether or not to keep track of network statistics
@@ -88,6 +111,71 @@ class NeteriaServer(object):
         to True.
       auth_server (object): Instance of your authentication server. Must contain a
         method verify_login that can recieve a msg_data dictionary and return a boolean.
+      batch_size (int): The number of datagrams the listener should drain from
+        the socket at once under load. Defaults to 0, which receives one
+        datagram at a time. See core.ListenerUDP.
+      reuse_port (boolean): Whether or not to bind with SO_REUSEPORT so several
+        server processes can share the same port. Defaults to False. See
+        cluster.NeteriaCluster.
+      codecs (list): The names of the codecs that clients are allowed to
+        negotiate during registration. Defaults to ["json", "binary"]. See the
+        codec module.
+      executor (executor.EventExecutor): The executor used to execute LEGAL
+        events in the middleware. Events from each client are executed in
+        order. If the executor runs in "process" mode, the middleware's
+        "event_apply" is called with the result of the executor's function
+        instead of "event_execute". Defaults to an EventExecutor with a pool
+        of 4 threads.
+      idle_ttl (float): The number of seconds a client can go without sending
+        any packets before it is evicted from the registry. Defaults to None,
+        which never evicts idle clients.
+      hard_ttl (float): The maximum number of seconds a client can stay
+        registered, no matter how active it is. The client must register again
+        after it has been evicted. Defaults to None, which never expires
+        registrations.
+      dedup_window (int): The number of recent events per client whose
+        LEGAL/ILLEGAL responses are kept, so retransmitted events are
+        answered again. Older retransmitted events are dropped, so no event
+        is ever executed twice. Defaults to 256.
+      debug_ids (boolean): Whether or not to identify NOTIFY messages with
+        uuid strings instead of sequence numbers. This makes packets easier to
+        follow while debugging, but larger. Defaults to False.
+      multicast_group (tuple): The (address, port) of a multicast group to
+        send notify_all messages to, e.g. ("239.255.0.80", 40081). Clients
+        without encryption can ask to join the group when they register,
+        instead of being sent a copy of every message. Defaults to None,
+        which sends every message by unicast.
+      multicast_history (int): The number of recent multicast messages to
+        keep, so they can be resent to clients that missed them. Defaults to
+        256.
+      tick (float): If set, messages to registered clients are queued and
+        sent every "tick" seconds, with all of the messages to the same client
+        bundled into a single datagram. Defaults to None, which sends every
+        message right away.
+      bundle_size (int): The maximum size of a bundle in bytes. If a client's
+        queued messages would grow larger, they are sent before the next tick.
+        Defaults to 1400, which fits in a typical ethernet frame.
+      mtu (int): The largest datagram to send in bytes. Larger messages, such
+        as big NOTIFY payloads, are sent in fragments. Defaults to 1400. See
+        core.ListenerUDP.
+      window_size (int): The maximum number of NOTIFY messages to each client
+        that can be waiting for its acknowledgement at once. Defaults to None,
+        which doesn't limit them.
+      window_policy (string): What to do with new NOTIFY messages to a client
+        whose window is full. "queue" keeps them and sends them as soon as
+        there is room. "reject" doesn't send them. Defaults to "queue".
+      replication_tick (float): If set, the states added with "add_state"
+        are replicated to every client every "replication_tick" seconds.
+        Defaults to None, which only replicates them when "replicate" is
+        called.
+      replication_history (int): The number of state snapshots whose
+        changes are kept, so clients that are further behind are sent the
+        whole state. Defaults to 32. See replication.Replicator.
+      interest_cell_size (float): The width of the grid cells that clients'
+        areas of interest and entities are indexed in, for
+        "notify_relevant". It should be about as large as a typical area of
+        interest. Defaults to 100.0. See interest.SpatialGrid.
+
     Examples:
       >>> from neteria.tools import _Middleware
       >>> from neteria.server import NeteriaServer
@@ -98,19 +186,33 @@ class NeteriaServer(object):
 
     """
 
+    # The listener class used to send and receive messages.
+    listener_class = ListenerUDP
+
     def __init__(self, middleware, version="1.0.3", app=None, server_address='',
                  server_port=40080, server_name=None, compression=False, encryption=False,
                  timeout=2.0, max_retries=4, registration_limit=50, stats=False,
-                 discoverable=True, auth_server=None):
+                 discoverable=True, auth_server=None, batch_size=0,
+                 reuse_port=False, codecs=("json", "binary"),
+                 executor=None, idle_ttl=None, hard_ttl=None,
+                 dedup_window=256, debug_ids=False, multicast_group=None,
+                 multicast_history=256, tick=None, bundle_size=1400,
+                 min_timeout=0.1, max_timeout=30.0, window_size=None,
+                 window_policy="queue", mtu=1400, replication_tick=None,
+                 replication_history=32, interest_cell_size=100.0):
+        if window_policy not in ("queue", "reject"):
+            raise ValueError("Unknown window policy: " + str(window_policy))
+
         self.version = version
         self.allowed_versions = [version]   # Client versions allowed to register.
-        self.event_uuids = {}
         self.middleware = middleware
         self.port = server_port
         self.server_name = server_name
         self.compression = compression
         self.discoverable = discoverable
         self.auth_server = auth_server
+        self.codecs = codecs
+        self.executor = executor or EventExecutor()
 
         # Generate a keypair if encryption is enabled
         if encryption:
@@ -118,10 +220,6 @@ class NeteriaServer(object):
         else:
             self.encryption = False
 
-        # Keep a separate key pair that matches hosts to cuuid to find their
-        # public key.
-        self.encrypted_hosts = {}
-
         # Provide access to the app the created the server class.
         self.app = app
 
@@ -129,18 +227,74 @@ class NeteriaServer(object):
         self.middleware.server = self
 
         # Create a listener to allow us to send and recieve messages.
-        self.listener = ListenerUDP(self, listen_address=server_address,
-                                    listen_port=server_port, stats=stats)
+        self.listener = self.listener_class(self, listen_address=server_address,
+                                            listen_port=server_port,
+                                            stats=stats, batch_size=batch_size,
+                                            reuse_port=reuse_port, mtu=mtu)
 
         # Set a timeout and maximum number of retries for responses from
         # clients.
         self.timeout = timeout
         self.max_retries = max_retries
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+
+        # Large blobs sent to and received from clients in chunks.
+        self.streams = Streams(self.send_message, self.listener.call_later,
+                               max_retries)
+
+        # States that are mirrored on every client, and the scheduled call
+        # that replicates them.
+        self.replication = Replicator(replication_history)
+        self.replication_tick = replication_tick
+        self.replication_call = None
+
+        # The areas of the game world each client is interested in, and the
+        # positions of entities, so updates are only sent to the clients
+        # near them.
+        self.interest = SpatialGrid(interest_cell_size)
+        self.entities = SpatialGrid(interest_cell_size)
+
+        # Limit the number of NOTIFY messages in flight to each client, so a
+        # slow client isn't flooded with messages it will have to drop.
+        self.window_size = window_size
+        self.window_policy = window_policy
 
         # Set a limit on the number of registrations to prevent registration
         # attacks.
         self.registration_limit = registration_limit
-        self.registry = {}
+        self.registry = Registry()
+
+        # Evict clients that have gone quiet or have been registered for too
+        # long, so long running servers don't fill up their registry.
+        self.idle_ttl = idle_ttl
+        self.hard_ttl = hard_ttl
+
+        # The number of responses to remember for each client to answer
+        # duplicate events with.
+        self.dedup_window = dedup_window
+
+        # Each client is given a small connection id when it registers, which
+        # it sends instead of its cuuid.
+        self.connection_ids = itertools.count(1)
+        self.debug_ids = debug_ids
+
+        # Messages sent to the multicast group are numbered, and recent ones
+        # are kept to resend to clients that NACK them.
+        self.multicast_group = multicast_group
+        self.multicast_history = multicast_history
+        self.group_sequence = itertools.count(1)
+        self.group_seq = 0
+        self.group_messages = OrderedDict()
+
+        # Clients with messages queued for the next tick, and the scheduled
+        # call that sends them.
+        self.tick = tick
+        self.bundle_size = bundle_size
+        self.outbox_records = set()
+        self.window_lock = threading.Lock()
+        self.outbox_lock = threading.Lock()
+        self.flush_call = None
 
 
     def listen(self):
@@ -158,54 +312,147 @@ class NeteriaServer(object):
         self.listener.listen()
 
 
-    def retransmit(self, data):
-        """Processes messages that have been delivered from the listener.
+    def stats(self):
+        """Returns the statistics of the server.
+
+        Args:
+          None
+
+        Returns:
+          A dictionary with the number of registered clients, events being
+          processed and NOTIFY messages waiting for room in a client's window
+          as "queued", the executor's metrics, the listener's network
+          statistics if they are enabled, the number of messages sent and
+          received in fragments as "fragments", the number of streams being
+          sent and received as "streams", the number of state snapshots
+          taken and deltas and whole states built as "replication", the
+          number of clients with an area of interest and of entities as
+          "interest", and a "clients" dictionary with the round trip time
+          estimate of each client keyed by cuuid.
+
+        Examples:
+          >>> myserver.stats()["clients"]
+          {'45e2e9c6-6c4a-11e4-a5c7-080027ad5e2c': {'srtt': 0.012,
+           'rttvar': 0.004, 'rto': 0.1}}
+
+        """
+
+        stats = {"registered": len(self.registry),
+                 "events": sum(len(window) for record in self.registry.records()
+                               for window in record.windows.values()),
+                 "queued": sum(len(record.notify_queue)
+                               for record in self.registry.records())}
+        stats.update(self.executor.stats())
+        if self.listener.stats_enabled:
+            stats.update(self.listener.stats)
+        stats["fragments"] = dict(self.listener.fragments.stats)
+        stats["streams"] = self.streams.stats()
+        stats["replication"] = dict(self.replication.stats)
+        stats["interest"] = {"clients": len(self.interest),
+                             "entities": len(self.entities)}
+        stats["clients"] = dict((record.cuuid, record.rtt.stats())
+                                for record in self.registry.records())
+
+        return stats
+
+
+    def retransmit(self, cuuid):
+        """Retransmits the messages to a client that haven't been confirmed in
+        time, and schedules itself again for when the next message is due.
+        Each client has a single scheduled retransmit, no matter how many of
+        its messages are in flight.
 
         Args:
-          data (dict): A dictionary containing the uuid, euuid, and message
-            response. E.g. {"cuuid": x, "euuid": y, "response": z}.
+          cuuid (string): The client uuid whose messages to retransmit.
 
         Returns:
           None
 
         """
 
-        # If that shit is still in self.event_uuids, then that means we STILL
-        # haven't gotten a response from the client. Then we resend that shit
-        # and WAIT
-        if data["euuid"] in self.event_uuids:
-            # Increment the current retry count of the euuid
-            self.event_uuids[data["euuid"]] += 1
-
-            # If we've tried more than the maximum, just log an error
-            # and stahap.
-            if (self.event_uuids[data["euuid"]] > self.max_retries or
-                    data["cuuid"] not in self.registry):
-                logger.warning("<%s> Retry limit exceeded. "
-                               "Timed out waiting for client for "
-                               "event: %s" % (data["cuuid"], data["euuid"]))
-                logger.warning("<%s> Deleting event from currently processing "
-                               "event uuids" % data["cuuid"])
-                del self.event_uuids[data["euuid"]]
-            else:
-                # Retransmit that shit
-                logger.debug("<%s> Timed out waiting for response. Retry %s. "
-                             "Retransmitting message: "
-                             "%s" % (data["cuuid"],
-                                     pformat(self.event_uuids[data["euuid"]]),
-                                     data["response"]))
+        record = self.registry.get(cuuid)
+        if not record:
+            return
+
+        # If any of our messages are still in the client's windows, then that
+        # means we STILL haven't gotten a response from the client. Then we
+        # resend that shit and WAIT
+        now = monotonic()
+        packets = []
+        next_due = None
+        with self.window_lock:
+            record.retransmit_call = None
+            for kind, window in record.windows.items():
+                resend, expired, due = window.poll(now, record.rtt,
+                                                   self.max_retries)
+                packets.extend(resend)
+                for euuid in expired:
+                    logger.warning("<%s> Retry limit exceeded. Timed out "
+                                   "waiting for client for %s: "
+                                   "%s" % (cuuid, kind.lower(), euuid))
+                if due is not None and (next_due is None or due < next_due):
+                    next_due = due
+
+            # Then we set another schedule to check again
+            if next_due is not None:
+                record.retransmit_due = next_due
+                record.retransmit_call = self.listener.call_later(
+                    max(next_due - now, 0), self.retransmit, cuuid)
+
+        # Retransmit that shit. A packet shared by several messages, such as
+        # a VERDICT, is only sent once. The client's session only decrypts
+        # each nonce once, so packets get a new one every time they're sent.
+        if packets:
+            logger.debug("<%s> Timed out waiting for response. Retransmitting "
+                         "%d messages" % (cuuid, len(packets)))
+            sent = set()
+            for packet in packets:
+                if id(packet) not in sent:
+                    sent.add(id(packet))
+                    if record.session:
+                        packet = record.session.renew(packet)
+                    self.send(record, packet)
+
+        # Messages that were given up on make room for queued ones.
+        if record.notify_queue:
+            self.drain(record)
+
+
+    def track(self, record, kind, euuid, packet, now=None):
+        """Keeps a reliable message to a client in its window until the
+        client confirms it, and makes sure the client's retransmit is
+        scheduled. This is done before sending, so a fast confirmation
+        finds it.
+
+        Args:
+          record (registry.ClientRecord): The client the message is sent to.
+          kind (string): Either "EVENT" for a judgement of one of the
+            client's events, or "NOTIFY" for one of our NOTIFY messages.
+          euuid (int): The id of the message.
+          packet (bytes): The serialized packet to retransmit.
+          now (float): The monotonic time the message is sent. Defaults to
+            the current time.
+
+        Returns:
+          None
 
-                # Look up the host and port based on cuuid
-                host = self.registry[data["cuuid"]]["host"]
-                port = self.registry[data["cuuid"]]["port"]
+        """
 
-                # Send the packet to the client
-                self.listener.send_datagram(data["response"], (host, port))
+        if now is None:
+            now = monotonic()
+        rto = record.rtt.rto
+        with self.window_lock:
+            record.windows[kind].add(euuid, packet, now, now + rto)
 
-                # Then we set another schedule to check again
-                logger.debug("<%s> Scheduling to retry in %s "
-                             "seconds" % (data["cuuid"], str(self.timeout)))
-                self.listener.call_later(self.timeout, self.retransmit, data)
+            # Move the retransmit up if it's waiting on a backed off message
+            # that is due later than this one.
+            if record.retransmit_call and record.retransmit_due > now + rto:
+                record.retransmit_call.cancel()
+                record.retransmit_call = None
+            if not record.retransmit_call:
+                record.retransmit_due = now + rto
+                record.retransmit_call = self.listener.call_later(
+                    rto, self.retransmit, record.cuuid)
 
 
     def handle_message(self, msg, host):
@@ -224,19 +471,55 @@ class NeteriaServer(object):
 
         response = None
 
+        # Look up the client that sent this packet by its address.
+        record = self.registry.get_by_address(host)
+
         # Unserialize the packet, and decrypt if the host has encryption enabled
-        if host in self.encrypted_hosts:
+        session = record.session if record else None
+
+        if session and msg[:1] != Session.magic:
+            # Hosts with a session key may only send REGISTER and OHAI
+            # packets unencrypted.
+            msg_data = unserialize_data(msg, self.compression)
+            if msg_data and msg_data.get("method") not in ("REGISTER", "OHAI"):
+                logger.warning("Unencrypted packet received from encrypted "
+                               "host: " + str(host))
+                return response
+        elif session:
+            msg_data = unserialize_data(msg, self.compression, session=session)
+        elif record and record.encryption:
             msg_data = unserialize_data(msg, self.compression, self.encryption)
+        elif msg[:1] == Session.magic:
+            # We no longer have a session key for this host, e.g. because it
+            # was evicted, so let it know it has to register again.
+            logger.warning("Encrypted packet received from unregistered "
+                           "host: " + str(host))
+            return serialize_data({"method": "BYE EVENT",
+                                   "data": "Not registered"},
+                                  self.compression, encryption=False)
         else:
             msg_data = unserialize_data(msg, self.compression)
 
-        logger.debug("Packet received: " + pformat(msg_data))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Packet received: " + pformat(msg_data))
 
         # If the message data is blank, return none
         if not msg_data: return response
 
+        # Keep track of when we last heard from the client so it isn't evicted
+        # while it is active.
+        if record:
+            record.last_seen = monotonic()
+
+        # Registered clients send their connection id instead of their cuuid.
+        if "cid" in msg_data:
+            if record and record.cid == msg_data["cid"]:
+                msg_data["cuuid"] = record.cuuid
+            else:
+                msg_data["cuuid"] = None
+
         # For debug purposes, check if the client is registered or not
-        if self.is_registered(msg_data["cuuid"], host[0]):
+        if record and record.cuuid == msg_data["cuuid"]:
             logger.debug("<%s> Client is currently registered" % msg_data["cuuid"])
         else:
             logger.debug("<%s> Client is not registered"  % msg_data["cuuid"])
@@ -255,12 +538,12 @@ class NeteriaServer(object):
             elif msg_data["method"] == "AUTH":
                 logger.debug("<%s> Authentication packet recieved" % msg_data["cuuid"])
                 response = self.auth_server.verify_login(msg_data)
-                if response:
-                    self.registry[host]["authenticated"] = True
+                if response and record:
+                    record.authenticated = True
 
             else:
                 if self.auth_server:
-                    if self.registry[host]["authenticated"]:
+                    if record and record.authenticated:
                         response = self.handle_message_registered(msg_data, host)
                 else:
                     response = self.handle_message_registered(msg_data, host)
@@ -284,6 +567,25 @@ class NeteriaServer(object):
         """
         response = None
 
+        # Only the client itself can confirm our messages to it, so anything
+        # that changes what we send a client has to come from its address.
+        # The client's ids are easy to guess.
+        sender = self.sender(msg_data, host)
+
+        # Clients that support them acknowledge our messages in batches, either
+        # in an ACK or along with their next event.
+        if sender:
+            if "ack_events" in msg_data:
+                self.acknowledge(sender, "EVENT", msg_data["ack_events"])
+            if "ack_notifies" in msg_data:
+                self.acknowledge(sender, "NOTIFY", msg_data["ack_notifies"])
+            # Acknowledgements can arrive out of order, but deltas from an
+            # older baseline still apply to a newer mirror. An ack of 0 asks
+            # for the whole state.
+            ack = msg_data.get("ack_state")
+            if type(ack) is int and 0 <= ack <= self.replication.seq:
+                sender.state_baseline = ack
+
         if msg_data["method"] == "EVENT":
             logger.debug("<%s> <euuid:%s> Event message "
                          "received" % (msg_data["cuuid"], msg_data["euuid"]))
@@ -294,30 +596,168 @@ class NeteriaServer(object):
                                   msg_data["timestamp"],
                                   msg_data["priority"])
 
-        elif msg_data["method"] == "OK EVENT":
+        elif msg_data["method"] == "EVENTS":
+            logger.debug("<%s> Batch of %d events "
+                         "received" % (msg_data["cuuid"],
+                                       len(msg_data["events"])))
+            response = self.event_many(msg_data["cuuid"],
+                                       host,
+                                       msg_data["events"],
+                                       msg_data["timestamp"],
+                                       msg_data["priority"])
+
+        elif msg_data["method"] == "UNRELIABLE EVENT":
+            response = self.event_unreliable(msg_data["cuuid"],
+                                             host,
+                                             msg_data["euuid"],
+                                             msg_data["event_data"],
+                                             msg_data.get("sequenced", False))
+
+        elif msg_data["method"] == "OK EVENT" and sender:
             logger.debug("<%s> <euuid:%s> Event confirmation message "
-                         "received" % (msg_data["cuuid"], msg_data["euuid"]))
-            try:
-                del self.event_uuids[msg_data["euuid"]]
-            except KeyError:
-                logger.warning("<%s> <euuid:%s> Euuid does not exist in event "
-                               "buffer. Key was removed before we could process "
-                               "it." % (msg_data["cuuid"], msg_data["euuid"]))
-
-        elif msg_data["method"] == "OK NOTIFY":
-            logger.debug("<%s> <euuid:%s> Ok notify "
-                         "received" % (msg_data["cuuid"], msg_data["euuid"]))
-            try:
-                del self.event_uuids[msg_data["euuid"]]
-            except KeyError:
-                logger.warning("<%s> <euuid:%s> Euuid does not exist in event "
-                               "buffer. Key was removed before we could process "
-                               "it." % (msg_data["cuuid"], msg_data["euuid"]))
+                         "received" % (sender.cuuid, msg_data["euuid"]))
+            self.confirm(sender.cuuid, msg_data["euuid"], "EVENT")
 
+        elif msg_data["method"] == "OK NOTIFY" and sender:
+            logger.debug("<%s> <euuid:%s> Ok notify "
+                         "received" % (sender.cuuid, msg_data["euuid"]))
+            self.confirm(sender.cuuid, msg_data["euuid"], "NOTIFY")
+
+        elif msg_data["method"] in ("OK EVENT", "OK NOTIFY"):
+            logger.warning("<%s> %s received from another address: "
+                           "%s" % (msg_data["cuuid"], msg_data["method"],
+                                   str(host)))
+
+        elif msg_data["method"] == "NACK" and sender:
+            logger.debug("<%s> Group notify NACK received for: "
+                         "%s" % (sender.cuuid, str(msg_data["missing"])))
+            self.resend_group(sender.cuuid, msg_data["missing"])
+
+        elif msg_data["method"] == "NACK":
+            # A spoofed NACK would make us send the group messages to the
+            # client's address, so don't let other hosts send them.
+            logger.warning("<%s> NACK received from another address: "
+                           "%s" % (msg_data["cuuid"], str(host)))
+
+        elif msg_data["method"] in ("STREAM", "STREAM ACK", "STREAM CANCEL"):
+            # Streams are keyed by client, so another host could ack or
+            # cancel a client's stream if we went by the cuuid alone.
+            if sender:
+                self.streams.handle(sender.cuuid, msg_data)
+            else:
+                logger.warning("<%s> %s received from another address: "
+                               "%s" % (msg_data["cuuid"], msg_data["method"],
+                                       str(host)))
+
+        # Send our response with the other messages for this client at the
+        # next tick.
+        if response and self.tick:
+            record = self.registry.get(msg_data["cuuid"])
+            if record:
+                self.send(record, response)
+                response = None
 
         return response
 
 
+    def sender(self, msg_data, host):
+        """Returns the record of the client that sent a message, if the
+        message came from the address the client registered from.
+
+        Args:
+          msg_data (dict): The unserialized message, with the "cuuid" of the
+            client it claims to be from.
+          host (tuple): The (address, port) tuple the message came from.
+
+        Returns:
+          The registry.ClientRecord of the client, or None if no client is
+          registered from that address or it is another client.
+
+        """
+
+        record = self.registry.get_by_address(host)
+        if record and record.cuuid == msg_data.get("cuuid"):
+            return record
+        return None
+
+
+    def acknowledge(self, record, kind, ack):
+        """Confirms every event covered by an acknowledgement from a client.
+
+        Args:
+          record (registry.ClientRecord): The record of the client that sent
+            the acknowledgement.
+          kind (string): Either "EVENT" or "NOTIFY". See "confirm".
+          ack (list): The cumulative and selective acknowledgement as a list
+            of [sequence, bitmap]. Every message up to and including
+            "sequence" was received, and bit n of "bitmap" is set if message
+            "sequence + n + 1" was received.
+
+        Returns:
+          None
+
+        """
+
+        if (type(ack) is not list or len(ack) != 2 or
+                type(ack[0]) is not int or type(ack[1]) is not int):
+            logger.warning("<%s> Malformed acknowledgement received: "
+                           "%s" % (record.cuuid, str(ack)))
+            return
+
+        cumulative, bits = ack
+        with self.window_lock:
+            samples = record.windows[kind].ack(cumulative, bits)
+
+        # Measure the round trip time to the client with the messages that
+        # weren't retransmitted.
+        now = monotonic()
+        for sent in samples:
+            record.rtt.sample(now - sent)
+
+        if kind == "NOTIFY" and record.notify_queue:
+            self.drain(record)
+
+
+    def confirm(self, cuuid, euuid, kind):
+        """Removes a message from the client's window once the client has
+        confirmed it, so it won't be retransmitted.
+
+        Args:
+          cuuid (string): The client uuid that sent the confirmation.
+          euuid (int): The id of the event that was confirmed.
+          kind (string): Either "EVENT" for a confirmation of our judgement of
+            one of the client's events, or "NOTIFY" for a confirmation of one
+            of our NOTIFY messages.
+
+        Returns:
+          None
+
+        """
+
+        # Events and notifies are numbered separately for each client, so
+        # they are tracked in separate windows.
+        record = self.registry.get(cuuid)
+        if not record:
+            return
+
+        with self.window_lock:
+            entry = record.windows[kind].remove(euuid)
+        if entry is None:
+            logger.warning("<%s> <euuid:%s> Euuid does not exist in event "
+                           "buffer. Key was removed before we could process "
+                           "it." % (cuuid, euuid))
+            return
+
+        # Measure the round trip time to the client, unless the message was
+        # retransmitted.
+        sent, retries = entry
+        if not retries:
+            record.rtt.sample(monotonic() - sent)
+
+        if kind == "NOTIFY" and record.notify_queue:
+            self.drain(record)
+
+
     def autodiscover(self, message):
         """This function simply returns the server version number as a response
         to the client.
@@ -388,47 +828,166 @@ class NeteriaServer(object):
             return response
 
         # Insert a new record in the database with the client's information
-        data = {"host": host[0], "port": host[1], "time": datetime.now()}
+        record = ClientRecord(cuuid, host[0], host[1], datetime.now(),
+                              monotonic())
+
+        # Keep the connection id, authentication state and any unconfirmed
+        # events if the client is registering again. The time it first
+        # registered is kept too, so registering again doesn't get around
+        # the hard TTL.
+        previous = self.registry.get(cuuid)
+        if previous:
+            record.time = previous.time
+            record.registered = previous.registered
+            record.cid = previous.cid
+            record.authenticated = previous.authenticated
+            record.windows = previous.windows
+            record.retransmit_call = previous.retransmit_call
+            record.retransmit_due = previous.retransmit_due
+            record.responses = previous.responses
+            record.judged = previous.judged
+            record.sequence = previous.sequence
+            record.rtt = previous.rtt
+            record.unreliable_sequence = previous.unreliable_sequence
+            record.latest_sequence = previous.latest_sequence
+            record.notify_queue = previous.notify_queue
+            if previous.expire_call:
+                previous.expire_call.cancel()
+        else:
+            record.cid = next(self.connection_ids)
+            record.rtt = RTTEstimator(self.timeout, self.min_timeout,
+                                      self.max_timeout)
 
         # Prepare an OK REGISTER response to the client to let it know that it
-        # has registered
-        return_msg = {"method": "OK REGISTER"}
+        # has registered, with the connection id it should use from now on.
+        return_msg = {"method": "OK REGISTER", "cid": record.cid}
+
+        # If the client asked for a session key and we are able to encrypt
+        # with one, it will be used to encrypt all messages after this one
+        # instead of RSA.
+        if ("encryption" in message and self.encryption and
+                message.get("session") and AESGCM):
+            record.session = Session(direction=Session.SERVER)
+
+        # Our unconfirmed messages and the judgements we answer duplicate
+        # events with were encrypted with the previous session key, which the
+        # client doesn't have anymore. Anyone can register with a known cuuid,
+        # so they're only encrypted again for the client's own address, and
+        # dropped otherwise.
+        if previous and previous.session:
+            if previous.address == record.address:
+                self.reseal(record, previous.session)
+            else:
+                logger.warning("<%s> Registered again from a new address. "
+                               "Dropping kept messages." % cuuid)
+                self.discard(record)
+
+        # Use the first codec the client asked for that we support. Per message
+        # RSA encryption only handles text, so those clients always use json.
+        if "codecs" in message and ("encryption" not in message or
+                                    record.session):
+            for name in message["codecs"]:
+                if name in self.codecs and name in CODECS:
+                    return_msg["codec"] = name
+                    if name != "json":
+                        record.codec = CODECS[name]
+                    break
+
+        # Let clients without encryption join our multicast group, starting
+        # from the next message we send to it.
+        if (self.multicast_group and message.get("multicast") and
+                "encryption" not in message):
+            record.multicast = True
+            return_msg["multicast"] = list(self.multicast_group)
+            return_msg["group_seq"] = self.group_seq
 
         # If the register request has a public key included in it, then include
-        # it in the registry.
+        # it in the registry so we know to decrypt messages from this host.
         if "encryption" in message and self.encryption:
-            data["encryption"] = PublicKey(message["encryption"][0],
-                                           message["encryption"][1])
-
-            # Add the host to the encrypted_hosts dictionary so we know to
-            # decrypt messages from this host
-            self.encrypted_hosts[host] = cuuid
+            record.encryption = PublicKey(message["encryption"][0],
+                                          message["encryption"][1])
 
             # If the client requested encryption and we have it enabled, send
             # our public key to the client
             return_msg["encryption"] = [self.encryption.n, self.encryption.e]
 
+            # Send the session key encrypted with the client's public key.
+            if record.session:
+                return_msg["session_key"] = self.encryption.encrypt_key(
+                    record.session.key, record.encryption)
+
         # Add the entry to the registry
-        if cuuid in self.registry:
-            for key in data:
-                self.registry[cuuid][key]=data[key]
-        else:
-            self.registry[cuuid] = data
-            self.registry[cuuid]["authenticated"] = False
+        self.registry.add(record)
+
+        # Schedule a check for when the client could first expire.
+        deadline = self.expire_deadline(record)
+        if deadline is not None:
+            record.expire_call = self.listener.call_later(
+                max(deadline - monotonic(), 0), self.expire, record)
 
         # Serialize our response to the client
         response = serialize_data(return_msg,
                                   self.compression, encryption=False)
 
          # For debugging, print all the current rows in the registry
-        logger.debug("<%s> Registry entries:" % cuuid)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("<%s> Registry entries:" % cuuid)
 
-        for (key, value) in self.registry.items():
-            logger.debug("<%s> %s %s" % (str(cuuid), str(key), pformat(value)))
+            for (key, value) in self.registry.items():
+                logger.debug("<%s> %s %s" % (str(cuuid), str(key),
+                                             pformat(value)))
 
         return response
 
 
+    def reseal(self, record, session):
+        """Encrypts the messages kept for a client that registered again with
+        its new session key, or none if it has no session anymore.
+
+        Args:
+          record (registry.ClientRecord): The new record of the client.
+          session (encryption.Session): The session the messages were
+            encrypted with.
+
+        Returns:
+          None
+
+        """
+
+        # A packet shared by several messages, such as a VERDICT, is only
+        # encrypted again once so it stays shared.
+        sealed = {}
+        def reseal(packet):
+            if id(packet) not in sealed:
+                sealed[id(packet)] = (packet,
+                                      session.reseal(packet, record.session))
+            return sealed[id(packet)][1]
+
+        with self.window_lock:
+            for window in record.windows.values():
+                window.replace(reseal)
+            for euuid, response in record.responses.items():
+                record.responses[euuid] = reseal(response)
+
+
+    def discard(self, record):
+        """Drops the unconfirmed messages and cached judgements kept for a
+        client.
+
+        Args:
+          record (registry.ClientRecord): The record of the client.
+
+        Returns:
+          None
+
+        """
+
+        with self.window_lock:
+            for window in record.windows.values():
+                window.clear()
+            record.responses.clear()
+
+
     def is_registered(self, cuuid, host):
         """This function will check to see if a given host with client uuid is
         currently registered.
@@ -445,10 +1004,8 @@ class NeteriaServer(object):
         """
         # Check to see if the host with the client uuid exists in the registry
         # table.
-        if (cuuid in self.registry) and (self.registry[cuuid]["host"] == host):
-            return True
-        else:
-            return False
+        record = self.registry.get(cuuid)
+        return record is not None and record.address == tuple(host)
 
 
     def event(self, cuuid, host, euuid, event_data, timestamp, priority):
@@ -477,65 +1034,78 @@ class NeteriaServer(object):
         response = None
 
         # If the host we're sending to is using encryption, get their key to
-        # encrypt.
-        if host in self.encrypted_hosts:
-            logger.debug("Encrypted!")
-            client_key = self.registry[cuuid]["encryption"]
+        # encrypt, and encode the response with the codec the client
+        # negotiated.
+        record = self.registry.get(cuuid)
+        if record:
+            client_key = record.encryption
+            codec = record.codec
+            session = record.session
         else:
-            logger.debug("Not encrypted :<")
             client_key = None
-
-        # Get the port and host
-        port = host[1]
-        host = host[0]
+            codec = None
+            session = None
 
         # First, we need to check if the request is coming from a registered
         # client. If it's not coming from a registered client, we tell them to
         # fuck off and register first.
-        if not self.is_registered(cuuid, host):
+        if not record or record.host != host[0]:
             logger.warning("<%s> Sending BYE EVENT: Client not registered." % cuuid)
             response = serialize_data({"method": "BYE EVENT",
                                        "data": "Not registered"},
                                       self.compression,
-                                      self.encryption, client_key)
+                                      self.encryption, client_key,
+                                      session=session)
             return response
 
-        # Check our stored event uuid's to see if we're already processing
-        # this event.
-        if euuid in self.event_uuids:
+        # If we've already judged this event, the client didn't get our
+        # response, so send the same response again without executing the
+        # event twice.
+        cached = record.responses.get(euuid)
+        if cached is not None:
+            logger.debug("<%s> <euuid:%s> Duplicate event. Resending "
+                         "judgement." % (cuuid, euuid))
+            if record.session:
+                return record.session.renew(cached)
+            return cached
+
+        # Check the client's window to see if we're already processing this
+        # event.
+        if euuid in record.windows["EVENT"]:
             logger.warning("<%s> Event ID is already being processed: %s" % (cuuid,
                                                                              euuid))
             # If we're already working on this event, return none so we do not
             # reply to the client
             return response
 
-        # If we're not already processing this event, store the event uuid
-        # until we receive a confirmation from the client that it received our
-        # judgement.
-        self.event_uuids[euuid] = 0
-        logger.debug("<%s> <euuid:%s> Currently processing events: "
-                     "%s" % (cuuid, euuid, str(self.event_uuids)))
-        logger.debug("<%s> <euuid:%s> New event being processed" % (cuuid, euuid))
-        logger.debug("<%s> <euuid:%s> Event Data: %s" % (cuuid,
-                                                         euuid,
-                                                         pformat(event_data)))
+        # Drop events we've judged before whose responses we no longer keep.
+        # The client has confirmed them, or we're still retransmitting them.
+        if not self.unseen(record, euuid):
+            logger.debug("<%s> <euuid:%s> Dropping event that was already "
+                         "judged." % (cuuid, euuid))
+            return response
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("<%s> <euuid:%s> New event being processed" % (cuuid,
+                                                                        euuid))
+            logger.debug("<%s> <euuid:%s> Event Data: %s" % (cuuid,
+                                                             euuid,
+                                                             pformat(event_data)))
 
         # Send the event to the game middleware to determine if the event is
         # legal or not and to process the event in the Game Server if it is
         # legal.
-        if self.middleware.event_legal(cuuid, euuid, event_data):
+        legal = self.judge(cuuid, euuid, event_data)
+
+        if legal:
             logger.debug("<%s> <euuid:%s> Event LEGAL. Sending judgement "
                          "to client." % (cuuid, euuid))
             response = serialize_data({"method": "LEGAL",
                                        "euuid": euuid,
                                        "priority": priority},
                                       self.compression,
-                                      self.encryption, client_key)
-            # Execute the event
-            thread = threading.Thread(target=self.middleware.event_execute,
-                                      args=(cuuid, euuid, event_data)
-                                      )
-            thread.start()
+                                      self.encryption, client_key, codec,
+                                      session)
 
         else:
             logger.debug("<%s> <euuid:%s> Event ILLEGAL. Sending judgement "
@@ -544,18 +1114,202 @@ class NeteriaServer(object):
                                        "euuid": euuid,
                                        "priority": priority},
                                       self.compression,
-                                      self.encryption, client_key)
+                                      self.encryption, client_key, codec,
+                                      session)
+
+        # Keep the judgement until we receive a confirmation from the client
+        # that it received it.
+        self.track(record, "EVENT", euuid, response)
 
-        # Schedule a task to run in x seconds to check to see if we've timed
-        # out in receiving a response from the client.
-        self.listener.call_later(self.timeout, self.retransmit,
-                                 {"euuid": euuid,
-                                  "response": response, "cuuid": cuuid})
+        # Remember the response to answer duplicates of this event with.
+        record.responses[euuid] = response
+        if len(record.responses) > self.dedup_window:
+            record.responses.popitem(last=False)
 
         return response
 
 
-    def notify(self, cuuid, event_data):
+    def event_many(self, cuuid, host, events, timestamp, priority):
+        """Processes a batch of events that a client sent in a single EVENTS
+        packet. Each event is judged by the middleware just like a single
+        event, and the judgements of all of them are sent back in a single
+        VERDICT message.
+
+        Args:
+          cuuid (string): The client uuid that the events came from.
+          host (tuple): The (address, port) tuple of the client.
+          events (list): A list of [euuid, event_data] pairs.
+          timestamp (string): The client provided timestamp of when the
+            events were sent.
+          priority (string): The priority of all of the events. See event.
+
+        Returns:
+          A VERDICT response to be sent to the client, bundled with our
+          earlier responses to any events in the batch that were already
+          judged.
+
+        """
+
+        record = self.registry.get(cuuid)
+        if not record or record.host != host[0]:
+            logger.warning("<%s> Sending BYE EVENT: Client not registered." % cuuid)
+            return serialize_data({"method": "BYE EVENT",
+                                   "data": "Not registered"},
+                                  self.compression, self.encryption,
+                                  record.encryption if record else None,
+                                  session=record.session if record else None)
+
+        responses = []
+        legal = []
+        illegal = []
+        for euuid, event_data in events:
+            # Resend our judgements of events we've already judged.
+            cached = record.responses.get(euuid)
+            if cached is not None:
+                if cached not in responses:
+                    responses.append(cached)
+                continue
+
+            if (euuid in record.windows["EVENT"] or
+                    not self.unseen(record, euuid)):
+                continue
+
+            if self.judge(cuuid, euuid, event_data):
+                legal.append(euuid)
+            else:
+                illegal.append(euuid)
+
+        if record.session:
+            responses = [record.session.renew(packet) for packet in responses]
+
+        if legal or illegal:
+            logger.debug("<%s> Sending judgement of %d events to "
+                         "client." % (cuuid, len(legal) + len(illegal)))
+            response = serialize_data({"method": "VERDICT",
+                                       "legal": legal,
+                                       "illegal": illegal,
+                                       "priority": priority},
+                                      self.compression,
+                                      self.encryption, record.encryption,
+                                      record.codec, record.session)
+
+            # Every event is confirmed separately, and the verdict is
+            # retransmitted until all of them are.
+            now = monotonic()
+            for euuid in legal + illegal:
+                self.track(record, "EVENT", euuid, response, now)
+                record.responses[euuid] = response
+            while len(record.responses) > self.dedup_window:
+                record.responses.popitem(last=False)
+
+            responses.append(response)
+
+        if not responses:
+            return None
+        return self.bundle(responses)
+
+
+    def event_unreliable(self, cuuid, host, euuid, event_data, sequenced):
+        """Processes an event that the client sent without expecting a
+        judgement. The event is judged and executed like any other event,
+        but nothing is sent back and it is never retransmitted, so it isn't
+        kept track of either.
+
+        Args:
+          cuuid (string): The client uuid that the event came from.
+          host (tuple): The (address, port) tuple of the client.
+          euuid (int): The client's unreliable sequence number of the event.
+          event_data (any): The event data to judge and execute.
+          sequenced (boolean): Whether only the latest event matters. If so,
+            the event is dropped if a newer one was already received.
+
+        Returns:
+          None, or a BYE EVENT response if the client isn't registered.
+
+        """
+
+        record = self.registry.get(cuuid)
+        if not record or record.host != host[0]:
+            logger.warning("<%s> Sending BYE EVENT: Client not registered." % cuuid)
+            return serialize_data({"method": "BYE EVENT",
+                                   "data": "Not registered"},
+                                  self.compression, self.encryption,
+                                  record.encryption if record else None,
+                                  session=record.session if record else None)
+
+        if sequenced:
+            if euuid <= record.latest_sequence:
+                logger.debug("<%s> <euuid:%s> Dropping stale sequenced "
+                             "event." % (cuuid, euuid))
+                return None
+            record.latest_sequence = euuid
+
+        if not self.judge(cuuid, euuid, event_data):
+            logger.debug("<%s> <euuid:%s> Unreliable event "
+                         "ILLEGAL." % (cuuid, euuid))
+        return None
+
+
+    def unseen(self, record, euuid):
+        """Marks an event as judged, keeping track of the events with
+        sequence numbers in a window, so retransmits are recognized even
+        after their responses were forgotten.
+
+        Args:
+          record (registry.ClientRecord): The client the event came from.
+          euuid (int): The id of the event.
+
+        Returns:
+          True if the event hasn't been judged before, otherwise False.
+
+        """
+
+        if type(euuid) is not int:
+            return True
+
+        received = record.judged.receive(euuid)
+        if received is None:
+            # The client skips the ids of events it didn't send, e.g. while
+            # its window was full, so catch up with it.
+            record.judged.catch_up(euuid)
+            received = record.judged.receive(euuid)
+        return received
+
+
+    def judge(self, cuuid, euuid, event_data):
+        """Asks the middleware whether an event is legal, and queues legal
+        events to be executed after any other events from the same client.
+
+        Args:
+          cuuid (string): The client uuid that the event came from.
+          euuid (int): The id of the event.
+          event_data (any): The event data to judge.
+
+        Returns:
+          True if the event is LEGAL. If the executor's queue is full and the
+          event is dropped, it is judged ILLEGAL so the client will roll it
+          back.
+
+        """
+
+        # Events executed in worker processes are applied to the game by the
+        # middleware's "event_apply" once they're done.
+        if self.executor.mode == "process":
+            execute = self.middleware.event_apply
+        else:
+            execute = self.middleware.event_execute
+
+        legal = self.middleware.event_legal(cuuid, euuid, event_data)
+        if legal and not self.executor.submit(cuuid, execute,
+                                              cuuid, euuid, event_data):
+            logger.warning("<%s> <euuid:%s> Event dropped by the "
+                           "executor." % (cuuid, euuid))
+            legal = False
+
+        return legal
+
+
+    def notify(self, cuuid, event_data, reliability="reliable"):
         """This function will send a NOTIFY event to a registered client.
 
         NOTIFY messages are nearly identical to EVENT messages, except that
@@ -569,65 +1323,800 @@ class NeteriaServer(object):
           cuuid (string): The client uuid to send the event data to.
           event_data (any): The event data that we will be sending to the
             client.
+          reliability (string): "reliable" messages are retransmitted until
+            the client acknowledges them. "unreliable" messages are sent once
+            and never acknowledged, which suits data that is sent often,
+            such as positions. "sequenced" messages are unreliable messages
+            that the client drops if it has already received a newer one, so
+            only the latest value is used. Defaults to "reliable".
+
+        Returns:
+          False if the client isn't registered, or if the client's window is
+          full and the window policy is "reject". Otherwise None.
+
+        """
+
+        if reliability not in ("reliable", "unreliable", "sequenced"):
+            raise ValueError("Unknown reliability: " + str(reliability))
+
+        # Look up the host details based on cuuid
+        record = self.registry.get(cuuid)
+        if not record:
+            logger.warning("<%s> Host not found in registry! Transmit "
+                           "Canceled" % str(cuuid))
+            return False
+
+        # Unreliable messages are numbered separately, and sent without
+        # keeping track of them.
+        if reliability != "reliable":
+            packet = {"method": "UNRELIABLE NOTIFY",
+                      "euuid": next(record.unreliable_sequence),
+                      "event_data": event_data}
+            if reliability == "sequenced":
+                packet["sequenced"] = True
+            self.send(record, serialize_data(packet, self.compression,
+                                             self.encryption,
+                                             record.encryption, record.codec,
+                                             record.session))
+            return
+
+        # Wait for room in the client's window before sending the message.
+        if not self.admit(record, event_data):
+            if self.window_policy == "reject":
+                return False
+            return
+
+        self.send_notify(record, event_data)
+
+
+    def send_notify(self, record, event_data):
+        """Sends a reliable NOTIFY message to a client, and keeps it until the
+        client acknowledges it. See notify.
+
+        Args:
+          record (registry.ClientRecord): The client to send the message to.
+          event_data (any): The event data that we will be sending to the
+            client.
 
         Returns:
           None
 
         """
 
-        # Generate an event uuid for the notify event
-        euuid = str(uuid.uuid1())
+        cuuid = record.cuuid
 
-        # If the client uses encryption, get their key to encrypt
-        if "encryption" in self.registry[cuuid]:
-            client_key = self.registry[cuuid]["encryption"]
+        # Give the notify event the client's next sequence number as its id
+        if self.debug_ids:
+            euuid = str(uuid.uuid1())
         else:
-            client_key = None
-
-        logger.debug("<%s> <%s> Sending NOTIFY event to client with event data: "
-                     "%s" % (str(cuuid), str(euuid), pformat(event_data)))
+            euuid = next(record.sequence)
 
-        # Look up the host details based on cuuid
-        try:
-            ip_address = self.registry[cuuid]["host"]
-        except KeyError:
-            logger.warning("<%s> <%s> Host not found in registry! Transmit "
-                           "Canceled" % (str(cuuid), str(euuid)))
-            return False
-        try:
-            port = self.registry[cuuid]["port"]
-        except KeyError:
-            logger.warning("<%s> <%s> Port not found! Transmit "
-                           "Canceled" % (str(cuuid), str(euuid)))
-            return False
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("<%s> <%s> Sending NOTIFY event to client with event "
+                         "data: %s" % (str(cuuid), euuid, pformat(event_data)))
 
-        # Set up the packet and address to send to
+        # Set up the packet to send. If the client uses encryption, use their
+        # key to encrypt.
         packet = serialize_data({"method": "NOTIFY",
                                  "event_data": event_data,
                                  "euuid": euuid},
                                 self.compression,
-                                self.encryption, client_key)
-        address = (ip_address, port)
-
-        # If we're not already processing this event, store the event uuid
-        # until we receive a confirmation from the client that it received our
-        # notification.
-        self.event_uuids[euuid] = 0	# This is the current retry attempt
-        logger.debug("<%s> Currently processing events: "
-                     "%s" % (cuuid, pformat(self.event_uuids)))
-        logger.debug("<%s> New NOTIFY event being processed:" % cuuid)
-        logger.debug("<%s> EUUID: %s" % (cuuid, euuid))
-        logger.debug("<%s> Event Data: %s" % (cuuid, pformat(event_data)))
+                                self.encryption, record.encryption,
+                                record.codec, record.session)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("<%s> New NOTIFY event being processed:" % cuuid)
+            logger.debug("<%s> EUUID: %s" % (cuuid, euuid))
+            logger.debug("<%s> Event Data: %s" % (cuuid, pformat(event_data)))
+
+        # Keep the message until we receive a confirmation from the client
+        # that it received it.
+        self.track(record, "NOTIFY", euuid, packet)
 
         # Send the packet to the client
-        self.listener.send_datagram(packet, address)
-
-        # Schedule a task to run in x seconds to check to see if we've timed
-        # out in receiving a response from the client/
-        self.listener.call_later(self.timeout, self.retransmit,
-                                 {"euuid": euuid,
-                                  "response": packet,
-                                  "cuuid": cuuid})
+        self.send(record, packet)
+
+
+    def admit(self, record, event_data):
+        """Checks whether there is room in a client's window for another
+        NOTIFY message. If there isn't, the message is queued or rejected
+        depending on the window policy.
+
+        Args:
+          record (registry.ClientRecord): The client the message is for.
+          event_data (any): The event data of the message.
+
+        Returns:
+          True if the message can be sent now, otherwise False.
+
+        """
+
+        if not self.window_size:
+            return True
+
+        with self.window_lock:
+            # Messages that are already queued go first, so they are received
+            # in the order they were sent.
+            if (not record.notify_queue and
+                    len(record.windows["NOTIFY"]) < self.window_size):
+                return True
+
+            if self.window_policy == "queue":
+                record.notify_queue.append(event_data)
+            else:
+                logger.warning("<%s> Window is full. NOTIFY message not "
+                               "sent." % record.cuuid)
+        return False
+
+
+    def drain(self, record):
+        """Sends the queued NOTIFY messages to a client that fit in its
+        window.
+
+        Args:
+          record (registry.ClientRecord): The client to send the messages to.
+
+        Returns:
+          None
+
+        """
+
+        while True:
+            with self.window_lock:
+                if (not record.notify_queue or
+                        len(record.windows["NOTIFY"]) >= self.window_size):
+                    return
+                event_data = record.notify_queue.popleft()
+
+            self.send_notify(record, event_data)
+
+
+    def notify_many(self, cuuids, event_data):
+        """Sends the same NOTIFY event to a number of registered clients.
+
+        The event data is only encoded once for each codec in use, and every
+        client's message is then built by adding its own small header and
+        encrypting it with the client's own key, if it negotiated one. All of
+        the messages are sent in one batch.
+
+        Args:
+          cuuids (list): The client uuids to send the event data to.
+          event_data (any): The event data that we will be sending to the
+            clients.
+
+        Returns:
+          The number of clients the event was sent or queued to.
+
+        """
+
+        bodies = {}     # The encoded event data for each codec.
+        messages = []
+        queued = 0
+        now = monotonic()
+
+        for cuuid in cuuids:
+            record = self.registry.get(cuuid)
+            if not record:
+                logger.warning("<%s> Host not found in registry! Transmit "
+                               "Canceled" % str(cuuid))
+                continue
+
+            if not self.admit(record, event_data):
+                if self.window_policy == "queue":
+                    queued += 1
+                continue
+
+            if self.debug_ids:
+                euuid = str(uuid.uuid1())
+            else:
+                euuid = next(record.sequence)
+
+            # Encode the event data the first time we see each codec. Codecs
+            # that can't encode values on their own encode the whole message.
+            codec = record.codec or JSON
+            if codec not in bodies:
+                if hasattr(codec, "encode_value"):
+                    bodies[codec] = {"event_data": codec.encode_value(event_data)}
+                else:
+                    bodies[codec] = None
+
+            if bodies[codec] is None:
+                message = {"method": "NOTIFY", "euuid": euuid,
+                           "event_data": event_data}
+            else:
+                message = {"method": "NOTIFY", "euuid": euuid}
+
+            packet = serialize_data(message, self.compression,
+                                    self.encryption, record.encryption,
+                                    record.codec, record.session,
+                                    bodies[codec])
+
+            self.track(record, "NOTIFY", euuid, packet, now)
+            messages.append((record, packet))
+
+        if not messages:
+            return queued
+
+        logger.debug("Sending NOTIFY event to %d clients" % len(messages))
+        self.send_many(messages)
+
+        return len(messages) + queued
+
+
+    def notify_all(self, event_data):
+        """Sends the same NOTIFY event to every registered client. See
+        notify_many.
+
+        If the server has a multicast group, a single message is sent to the
+        group for all of the clients that joined it. Group messages aren't
+        acknowledged. Instead, clients NACK the messages they missed.
+
+        Args:
+          event_data (any): The event data that we will be sending to the
+            clients.
+
+        Returns:
+          The number of clients the event was sent to.
+
+        """
+
+        if not self.multicast_group:
+            return self.notify_many(self.registry.keys(), event_data)
+
+        members = 0
+        others = []
+        for record in self.registry.records():
+            if record.multicast:
+                members += 1
+            else:
+                others.append(record.cuuid)
+
+        if members:
+            self.notify_group(event_data)
+
+        return members + self.notify_many(others, event_data)
+
+
+    def notify_group(self, event_data):
+        """Sends a NOTIFY event to the multicast group.
+
+        Args:
+          event_data (any): The event data that we will be sending to the
+            clients in the group.
+
+        Returns:
+          The sequence number of the message.
+
+        """
+
+        seq = next(self.group_sequence)
+        packet = serialize_data({"method": "GROUP NOTIFY",
+                                 "euuid": seq,
+                                 "event_data": event_data},
+                                self.compression)
+
+        self.group_seq = seq
+        self.group_messages[seq] = packet
+        if len(self.group_messages) > self.multicast_history:
+            self.group_messages.popitem(last=False)
+
+        self.listener.send_datagram(packet, self.multicast_group,
+                                    message_type="multicast")
+        return seq
+
+
+    def resend_group(self, cuuid, missing):
+        """Resends multicast group messages that a client missed directly to
+        the client. Messages that are too old to be kept are skipped.
+
+        Args:
+          cuuid (string): The client uuid that sent the NACK.
+          missing (list): The sequence numbers of the messages it missed.
+
+        Returns:
+          None
+
+        """
+
+        record = self.registry.get(cuuid)
+        if not record or type(missing) is not list:
+            return
+
+        # Each message is only resent once, no matter how often it's listed.
+        messages = []
+        sent = set()
+        for seq in missing:
+            if type(seq) is not int or seq in sent:
+                continue
+            sent.add(seq)
+            packet = self.group_messages.get(seq)
+            if packet is not None:
+                messages.append((record, packet))
+        self.send_many(messages)
+
+
+    def set_interest(self, cuuid, position, radius):
+        """Sets or moves the area of the game world a client is interested
+        in, usually centered on the client's player with the distance it
+        can see as the radius. See notify_relevant.
+
+        Args:
+          cuuid (string): The client uuid.
+          position (tuple): The coordinates of the center of the area.
+          radius (float): The radius of the area.
+
+        Returns:
+          None
+
+        """
+
+        self.interest.update(cuuid, position, radius)
+
+
+    def set_entity(self, entity, position, radius=0.0):
+        """Sets or moves the position of an entity in the game world, so its
+        updates can be sent with notify_entity.
+
+        Args:
+          entity (any): The hashable id of the entity.
+          position (tuple): The coordinates of the entity.
+          radius (float): The size of the entity. Defaults to 0.0.
+
+        Returns:
+          None
+
+        """
+
+        self.entities.update(entity, position, radius)
+
+
+    def remove_entity(self, entity):
+        """Forgets the position of an entity."""
+        self.entities.remove(entity)
+
+
+    def relevant_clients(self, position, radius=0.0):
+        """Returns the cuuids of the registered clients whose area of
+        interest overlaps an area."""
+        return [cuuid for cuuid in self.interest.query(position, radius)
+                if cuuid in self.registry]
+
+
+    def relevant_entities(self, cuuid):
+        """Returns the ids of the entities in a client's area of interest,
+        or an empty list if the client has no area of interest."""
+        area = self.interest.get(cuuid)
+        if area is None:
+            return []
+        return self.entities.query(*area)
+
+
+    def notify_relevant(self, position, radius, event_data,
+                        reliability="reliable"):
+        """Sends a NOTIFY event about an area of the game world only to the
+        clients whose area of interest overlaps it. Finding the clients only
+        looks at the grid cells the area covers, so the cost depends on the
+        number of clients nearby rather than the number registered.
+
+        Args:
+          position (tuple): The coordinates of the center of the area.
+          radius (float): The radius of the area.
+          event_data (any): The event data that we will be sending to the
+            clients.
+          reliability (string): Whether the message is "reliable",
+            "unreliable" or "sequenced". See notify. Defaults to "reliable".
+
+        Returns:
+          The number of clients the event was sent or queued to.
+
+        Examples:
+          >>> myserver.set_interest(cuuid, (120.0, 64.0), 400.0)
+          >>> myserver.notify_relevant((300.0, 80.0), 10.0,
+          ...                          {"explosion": [300.0, 80.0]})
+          1
+
+        """
+
+        if reliability not in ("reliable", "unreliable", "sequenced"):
+            raise ValueError("Unknown reliability: " + str(reliability))
+
+        cuuids = self.relevant_clients(position, radius)
+        if not cuuids:
+            return 0
+        if reliability == "reliable":
+            return self.notify_many(cuuids, event_data)
+
+        for cuuid in cuuids:
+            self.notify(cuuid, event_data, reliability)
+        return len(cuuids)
+
+
+    def notify_entity(self, entity, event_data, reliability="reliable"):
+        """Sends a NOTIFY event about an entity to the clients whose area of
+        interest overlaps it. See notify_relevant.
+
+        Returns:
+          The number of clients the event was sent or queued to, or False if
+          the entity has no position.
+
+        """
+
+        area = self.entities.get(entity)
+        if area is None:
+            logger.warning("Entity %s has no position. Transmit "
+                           "Canceled" % str(entity))
+            return False
+        return self.notify_relevant(area[0], area[1], event_data, reliability)
+
+
+    def send_stream(self, cuuid, source, name=None, chunk_size=1024,
+                    window_size=64, callback=None):
+        """Sends a large blob to a registered client in chunks. Up to
+        "window_size" chunks are in flight at once, and the client
+        acknowledges them selectively so only lost chunks are retransmitted.
+        The client writes the blob to the sink it set with "receive_stream".
+
+        Args:
+          cuuid (string): The client uuid to send the blob to.
+          source (file or memoryview): A file-like object to read the blob
+            from, or an object supporting the buffer protocol such as bytes
+            or a memoryview. The blob is read one chunk at a time as there is
+            room in the window, so it never has to be in memory all at once.
+          name (string): The name of the stream, which the client uses to
+            pick its sink. Defaults to None.
+          chunk_size (int): The number of bytes to send in each message.
+            Defaults to 1024.
+          window_size (int): The number of chunks that can be in flight.
+            Defaults to 64.
+          callback (function): Called with the stream id and True once the
+            client has received the whole blob, or False if the stream failed.
+            Defaults to None.
+
+        Returns:
+          The id of the stream, or False if the client isn't registered.
+
+        Examples:
+          >>> myserver.send_stream(cuuid, open("levels/1.dat", "rb"),
+          ...                      name="level")
+          1
+
+        """
+
+        record = self.registry.get(cuuid)
+        if not record:
+            logger.warning("<%s> Host not found in registry! Transmit "
+                           "Canceled" % str(cuuid))
+            return False
+
+        # Json can't encode bytes, so the chunks are sent as base64 text.
+        text = getattr(record.codec, "name", "json") == "json"
+        return self.streams.open(cuuid, source, record.rtt, name, chunk_size,
+                                 window_size, text, callback)
+
+
+    def receive_stream(self, sink, name=None, callback=None):
+        """Sets where the blobs that clients send with "send_stream" are
+        written to.
+
+        Args:
+          sink (file): A writable file-like object, or a function that is
+            called with the cuuid of the client and the name of each new
+            stream and returns one. Since several clients can send a stream
+            with the same name, a function is usually what you want.
+          name (string): The name of the streams to write to the sink. If
+            None, the sink receives every stream that no other sink was set
+            for. Defaults to None.
+          callback (function): Called with the cuuid of the client, the name
+            of the stream and its size in bytes once a stream has been
+            received. Defaults to None.
+
+        Returns:
+          None
+
+        """
+
+        self.streams.listen(sink, name, callback)
+
+
+    def add_state(self, name, state, quantize=None):
+        """Starts mirroring a state on every client. Clients are sent only
+        the parts of the state that changed since the last snapshot they
+        acknowledged, and can read their mirror from "replica.state".
+
+        Args:
+          name (string): The name of the state on the clients.
+          state (dict): The state to replicate. Nested dictionaries are
+            compared key by key, and any other value is sent whole when it
+            changes. This may also be an object, whose public attributes are
+            replicated, or a function that returns the state.
+          quantize (dict): The precision to round the numbers under each key
+            to, e.g. {"x": 0.01, "y": 0.01}. Quantized numbers are sent as
+            integers, and changes smaller than the precision aren't sent.
+            They are always floats on the clients. Defaults to None.
+
+        Returns:
+          None
+
+        Examples:
+          >>> world = {"players": {"p1": {"x": 120.0, "y": 64.5}}}
+          >>> myserver.add_state("world", world, quantize={"x": 0.1, "y": 0.1})
+
+        """
+
+        self.replication.add(name, state, quantize)
+        if self.replication_tick and not self.replication_call:
+            self.replication_call = self.listener.call_later(
+                self.replication_tick, self.replication_loop, None)
+
+
+    def remove_state(self, name):
+        """Stops replicating a state. It is removed from every client's
+        mirror with the next snapshot."""
+        self.replication.remove(name)
+
+
+    def replicate(self):
+        """Takes a snapshot of the replicated states and sends every client
+        that isn't up to date a STATE message with the changes since its
+        baseline. Clients with the same baseline and codec share the same
+        encoded delta.
+
+        Args:
+          None
+
+        Returns:
+          The number of clients a STATE message was sent to.
+
+        """
+
+        self.replication.snapshot()
+
+        bodies = {}     # The encoded delta for each baseline and codec.
+        messages = []
+        for record in self.registry.records():
+            delta = self.replication.delta(record.state_baseline)
+            if delta is None:
+                continue
+
+            # Encode the delta the first time we need it with each codec.
+            # Codecs that can't encode values on their own encode the whole
+            # message.
+            codec = record.codec or JSON
+            key = (delta["base"], codec)
+            if key not in bodies:
+                if hasattr(codec, "encode_value"):
+                    bodies[key] = dict(
+                        (field, codec.encode_value(value))
+                        for field, value in delta.items()
+                        if field not in ("seq", "base"))
+                else:
+                    bodies[key] = None
+
+            message = {"method": "STATE", "seq": delta["seq"],
+                       "base": delta["base"]}
+            if bodies[key] is None:
+                message.update(delta)
+
+            messages.append((record, serialize_data(
+                message, self.compression, self.encryption,
+                record.encryption, record.codec, record.session,
+                bodies[key])))
+
+        if messages:
+            self.send_many(messages)
+
+        return len(messages)
+
+
+    def replication_loop(self, data=None):
+        """Replicates the states and schedules itself again for the next
+        replication tick.
+
+        Args:
+          data: Unused. Needed to be scheduled with call_later.
+
+        Returns:
+          None
+
+        """
+
+        try:
+            self.replicate()
+        finally:
+            self.replication_call = self.listener.call_later(
+                self.replication_tick, self.replication_loop, None)
+
+
+    def send_message(self, cuuid, message):
+        """Serializes a message for a registered client and sends it."""
+        record = self.registry.get(cuuid)
+        if record:
+            self.send(record, serialize_data(message, self.compression,
+                                             self.encryption,
+                                             record.encryption, record.codec,
+                                             record.session))
+
+
+    def send(self, record, packet):
+        """Sends a packet to a registered client. If the server has a tick,
+        the packet is queued and sent along with the client's other packets at
+        the next tick instead.
+
+        Args:
+          record (registry.ClientRecord): The client to send the packet to.
+          packet (bytes): The raw serialized packet to send.
+
+        Returns:
+          None
+
+        """
+
+        if not self.tick:
+            self.listener.send_datagram(packet, record.address)
+            return
+
+        # Make room for the packet and its length prefix in the bundle.
+        size = len(packet) + 3
+        full = None
+        with self.outbox_lock:
+            if record.outbox and record.outbox_size + size > self.bundle_size:
+                full = record.outbox
+                record.outbox = []
+                record.outbox_size = 1
+
+            if not record.outbox:
+                record.outbox_size = 1
+            record.outbox.append(packet)
+            record.outbox_size += size
+            self.outbox_records.add(record)
+
+            if not self.flush_call:
+                self.flush_call = self.listener.call_later(self.tick,
+                                                           self.flush, None)
+
+        if full:
+            self.listener.send_datagram(self.bundle(full), record.address)
+
+
+    def send_many(self, messages):
+        """Sends a number of packets to registered clients. See send.
+
+        Args:
+          messages (list): A list of (record, packet) tuples to send.
+
+        Returns:
+          None
+
+        """
+
+        if not self.tick:
+            self.listener.send_datagrams([(packet, record.address)
+                                          for record, packet in messages])
+            return
+
+        for record, packet in messages:
+            self.send(record, packet)
+
+
+    def flush(self, data=None):
+        """Sends all of the packets queued for the current tick, bundling the
+        packets to each client into a single datagram.
+
+        Args:
+          data: Unused. Needed to be scheduled with call_later.
+
+        Returns:
+          None
+
+        """
+
+        datagrams = []
+        with self.outbox_lock:
+            records = self.outbox_records
+            self.outbox_records = set()
+            self.flush_call = None
+
+            for record in records:
+                if record.outbox:
+                    datagrams.append((self.bundle(record.outbox),
+                                      record.address))
+                    record.outbox = []
+                    record.outbox_size = 0
+
+        self.listener.send_datagrams(datagrams)
+
+
+    def bundle(self, packets):
+        """Returns a single packet as is, or several packets as a bundle."""
+        if len(packets) == 1:
+            return packets[0]
+        return bundle_packets(packets)
+
+
+    def expire_deadline(self, record):
+        """Returns the monotonic time at which a client should be evicted, or
+        None if clients never expire."""
+        deadlines = []
+        if self.idle_ttl is not None:
+            deadlines.append(record.last_seen + self.idle_ttl)
+        if self.hard_ttl is not None:
+            deadlines.append(record.registered + self.hard_ttl)
+        return min(deadlines) if deadlines else None
+
+
+    def expire(self, record):
+        """Evicts a client if it has been idle or registered for too long.
+
+        Each client only ever has a single scheduled expiry check. Packets
+        from the client just update its "last_seen" time, and if the client
+        has been active since the check was scheduled, the check is pushed
+        back to the new deadline instead of evicting the client.
+
+        Args:
+          record (registry.ClientRecord): The record of the client to check.
+
+        Returns:
+          None
+
+        """
+
+        # Ignore checks for records that have been replaced by registering
+        # again.
+        if self.registry.get(record.cuuid) is not record:
+            return
+
+        now = monotonic()
+        deadline = self.expire_deadline(record)
+        if deadline > now:
+            record.expire_call = self.listener.call_later(
+                deadline - now, self.expire, record)
+            return
+
+        if (self.hard_ttl is not None and
+                now >= record.registered + self.hard_ttl):
+            reason = "expired"
+        else:
+            reason = "idle"
+        self.evict(record.cuuid, reason)
+
+
+    def evict(self, cuuid, reason="evicted"):
+        """Removes a client from the registry and cancels any retransmits of
+        events waiting for its confirmation. The middleware's
+        "client_evicted" method is called once the client is removed.
+
+        Args:
+          cuuid (string): The client uuid to evict.
+          reason (string): Why the client is being evicted. Defaults to
+            "evicted".
+
+        Returns:
+          True if the client was evicted, or False if it was not registered.
+
+        """
+
+        record = self.registry.remove(cuuid)
+        if not record:
+            return False
+
+        logger.info("<%s> Evicting client: %s" % (cuuid, reason))
+
+        if record.expire_call:
+            record.expire_call.cancel()
+            record.expire_call = None
+
+        with self.window_lock:
+            if record.retransmit_call:
+                record.retransmit_call.cancel()
+                record.retransmit_call = None
+            for window in record.windows.values():
+                window.clear()
+            record.notify_queue.clear()
+        self.streams.close(cuuid)
+        self.interest.remove(cuuid)
+
+        self.middleware.client_evicted(cuuid, reason)
+        return True
 
 
 # For testing you can run:
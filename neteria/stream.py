@@ -0,0 +1,650 @@
+#!/usr/bin/python
+#
+# Neteria
+# Copyright (C) 2014, William Edwards <shadowapex@gmail.com>,
+#
+# This file is part of Neteria.
+#
+# Neteria is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neteria is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neteria.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contributor(s):
+#
+# William Edwards <shadowapex@gmail.com>
+# Derek Clark <derekjohn.clark@gmail.com>
+#
+"""The stream module transfers large blobs, such as assets or save files,
+between a Neteria server and its clients.
+
+A blob is read in chunks from a file-like object or a memoryview, and the
+chunks are sent as STREAM messages numbered from 1. Up to "window_size"
+chunks past the last chunk the receiver has acknowledged are in flight at
+once. The receiver writes the chunks to its sink in order, and acknowledges
+them with STREAM ACK messages carrying a cumulative and selective
+acknowledgement, so only the chunks that were lost are retransmitted. The
+first chunk carries the name of the stream, and the last one is marked with
+"end".
+
+Both the server and the client own a Streams instance, which keeps track of
+the streams they are sending and receiving.
+
+Examples:
+  >>> myclient.receive_stream(open("level.dat", "wb"), name="level")
+  >>> myserver.send_stream(cuuid, open("levels/1.dat", "rb"), name="level")
+
+"""
+
+import base64
+import itertools
+import logging
+import threading
+
+from collections import OrderedDict
+
+from .window import SendWindow
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+# Create a logger for optional handling of debug messages.
+logger = logging.getLogger(__name__)
+
+# The largest number of chunks that are kept while waiting for an earlier
+# chunk to arrive.
+MAX_PENDING = 1024
+
+# The number of chunks sent after a missing chunk that have to be
+# acknowledged before the missing chunk is retransmitted without waiting for
+# its timeout.
+FAST_RETRANSMIT = 3
+
+# The number of finished streams to remember, so the last chunks of a stream
+# that are retransmitted after it is complete are still acknowledged.
+FINISHED_HISTORY = 64
+
+# The largest number of streams a single peer can be sending us at once.
+MAX_RECEIVERS = 16
+
+# The number of seconds after which a stream we're receiving is given up on
+# if no chunk of it has arrived.
+RECEIVER_TIMEOUT = 30.0
+
+
+class StreamSender(object):
+    """Sends a blob to a peer in chunks under a sliding window.
+
+    Args:
+      streams (Streams): The streams of the endpoint sending the blob.
+      peer (any): The peer to send the blob to.
+      stream_id (int): The id of the stream.
+      source (file or memoryview): A file-like object with a "read" method,
+        or an object supporting the buffer protocol such as bytes or a
+        memoryview.
+      rtt (core.RTTEstimator): The round trip time estimate of the peer.
+      name (string): The name of the stream. Defaults to None.
+      chunk_size (int): The number of bytes in each chunk.
+      window_size (int): The number of chunks that can be in flight.
+      text (boolean): Whether the chunks are sent as base64 strings, for
+        codecs that can't encode bytes.
+      callback (function): Called with the stream id and True once the peer
+        has received the whole blob, or False if the stream failed.
+
+    """
+
+    def __init__(self, streams, peer, stream_id, source, rtt, name=None,
+                 chunk_size=1024, window_size=64, text=False, callback=None):
+        self.streams = streams
+        self.peer = peer
+        self.stream_id = stream_id
+        self.rtt = rtt
+        self.name = name
+        self.chunk_size = chunk_size
+        self.window_size = window_size
+        self.text = text
+        self.callback = callback
+
+        # Read memoryviews and other buffers in place, and everything else
+        # with "read".
+        if hasattr(source, "read"):
+            self.source = source
+            self.view = None
+        else:
+            self.source = None
+            self.view = memoryview(source).cast("B")
+        self.offset = 0
+
+        self.window = SendWindow(window_size)
+        self.next_seq = 1
+        self.acked = 0      # Every chunk up to this one was received.
+        self.read_all = False
+        self.sent_bytes = 0
+        self.retransmit_call = None
+        self.retransmit_due = 0.0
+        self.progress = monotonic()  # When a chunk was last acknowledged.
+        self.lock = threading.Lock()
+
+    def read(self):
+        """Returns the next chunk of the blob, and whether it is the last."""
+        if self.view is not None:
+            chunk = self.view[self.offset:self.offset + self.chunk_size]
+            self.offset += len(chunk)
+            return chunk.tobytes(), self.offset >= len(self.view)
+
+        chunk = self.source.read(self.chunk_size)
+        return chunk, len(chunk) < self.chunk_size
+
+    def fill(self):
+        """Sends new chunks until the window is full or the blob has been
+        read.
+
+        Args:
+          None
+
+        Returns:
+          None
+
+        """
+
+        packets = []
+        now = monotonic()
+        with self.lock:
+            while (not self.read_all and
+                   self.next_seq <= self.acked + self.window_size):
+                chunk, last = self.read()
+                seq = self.next_seq
+                self.next_seq += 1
+                self.sent_bytes += len(chunk)
+
+                if self.text:
+                    chunk = base64.b64encode(chunk).decode("ascii")
+                packet = {"method": "STREAM",
+                          "euuid": seq,
+                          "stream": self.stream_id,
+                          "data": chunk}
+                if seq == 1 and self.name is not None:
+                    packet["name"] = self.name
+                if last:
+                    packet["end"] = True
+                    self.read_all = True
+
+                self.window.add(seq, packet, now, now + self.rtt.rto)
+                packets.append(packet)
+
+            # Move the retransmit up if it's waiting on a backed off chunk
+            # that is due later than the new ones.
+            rto = self.rtt.rto
+            if (packets and self.retransmit_call and
+                    self.retransmit_due > now + rto):
+                self.retransmit_call.cancel()
+                self.retransmit_call = None
+            if packets and not self.retransmit_call:
+                self.retransmit_due = now + rto
+                self.retransmit_call = self.streams.call_later(
+                    rto, self.retransmit, None)
+
+        for packet in packets:
+            self.streams.send(self.peer, packet)
+
+    def acknowledge(self, cumulative, bits):
+        """Handles a STREAM ACK from the peer, sending more chunks or
+        finishing the stream.
+
+        Args:
+          cumulative (int): Every chunk up to and including this one was
+            received.
+          bits (int): Bit n is set if chunk "cumulative + n + 1" was received.
+
+        Returns:
+          None
+
+        """
+
+        now = monotonic()
+        packets = []
+        with self.lock:
+            in_flight = len(self.window)
+            samples = self.window.ack(cumulative, bits)
+            if len(self.window) < in_flight:
+                self.progress = now
+            self.acked = max(self.acked, cumulative)
+            done = self.read_all and not len(self.window)
+
+            # Chunks that are missing while several chunks sent after them
+            # have arrived were most likely lost, so resend them right away.
+            for offset in range(bits.bit_length() - FAST_RETRANSMIT):
+                if not (bits >> offset) & 1:
+                    packet = self.window.resend(cumulative + offset + 1, now,
+                                                self.rtt)
+                    if packet:
+                        packets.append(packet)
+
+        for sent in samples:
+            self.rtt.sample(now - sent)
+
+        if done:
+            self.finish(True)
+            return
+
+        for packet in packets:
+            self.streams.send(self.peer, packet)
+        self.fill()
+
+    def retransmit(self, data=None):
+        """Retransmits the chunks that haven't been acknowledged in time, and
+        gives up on the stream if nothing has been acknowledged for as long
+        as it takes to retransmit a chunk "max_retries" times.
+
+        Args:
+          data: Unused. Needed to be scheduled with call_later.
+
+        Returns:
+          None
+
+        """
+
+        now = monotonic()
+        with self.lock:
+            self.retransmit_call = None
+            packets, expired, due = self.window.poll(now, self.rtt,
+                                                     float("inf"))
+            rto = self.rtt.rto
+            deadline = sum(min(rto * 2 ** retry, self.rtt.max_rto)
+                           for retry in range(self.streams.max_retries + 1))
+            expired = now - self.progress > deadline
+            if not expired and due is not None:
+                self.retransmit_due = due
+                self.retransmit_call = self.streams.call_later(
+                    max(due - now, 0), self.retransmit, None)
+
+        if expired:
+            logger.warning("Retry limit exceeded. Giving up on stream %s to "
+                           "%s" % (self.stream_id, str(self.peer)))
+            self.streams.send(self.peer, {"method": "STREAM CANCEL",
+                                          "stream": self.stream_id})
+            self.finish(False)
+            return
+
+        for packet in packets:
+            self.streams.send(self.peer, packet)
+
+    def cancel(self):
+        """Stops sending the stream."""
+        with self.lock:
+            if self.retransmit_call:
+                self.retransmit_call.cancel()
+                self.retransmit_call = None
+            self.window.clear()
+            self.read_all = True
+
+    def finish(self, success):
+        """Forgets the stream and lets the owner know how it ended."""
+        self.cancel()
+        if self.streams.senders.pop((self.peer, self.stream_id), None) is None:
+            return
+        if self.callback:
+            self.callback(self.stream_id, success)
+
+
+class StreamReceiver(object):
+    """Writes the chunks of a blob received from a peer to a sink in order.
+
+    Args:
+      stream_id (int): The id of the stream.
+      max_pending (int): The largest number of chunks past the next one we
+        can write that are kept until the missing chunks arrive.
+
+    """
+
+    __slots__ = ("stream_id", "sink", "callback", "name", "cumulative",
+                 "pending", "end", "size", "unacked", "ack_call",
+                 "max_pending", "received", "expire_call")
+
+    def __init__(self, stream_id, max_pending):
+        self.stream_id = stream_id
+        self.sink = None
+        self.callback = None
+        self.name = None
+        self.cumulative = 0  # Every chunk up to this one has been written.
+        self.pending = {}    # Chunks that arrived before the ones before them.
+        self.end = None      # The number of the last chunk, once it arrives.
+        self.size = 0
+        self.unacked = 0
+        self.ack_call = None
+        self.max_pending = max_pending
+        self.received = monotonic()  # When the last chunk arrived.
+        self.expire_call = None
+
+    def receive(self, seq, data, end):
+        """Keeps a chunk and writes every chunk that is now in order to the
+        sink, if we have one.
+
+        Args:
+          seq (int): The number of the chunk.
+          data (bytes): The chunk's data.
+          end (boolean): Whether this is the last chunk.
+
+        Returns:
+          True if the chunk should be acknowledged right away, because it is
+          a duplicate, arrived out of order or is the last chunk.
+
+        """
+
+        if seq <= self.cumulative or seq in self.pending:
+            return True
+        if seq > self.cumulative + self.max_pending:
+            return True
+
+        self.pending[seq] = data
+        if end:
+            self.end = seq
+        self.unacked += 1
+        self.write()
+
+        return bool(self.pending) or self.done() or end
+
+    def write(self):
+        """Writes the chunks that are in order to the sink."""
+        if self.sink is None:
+            return
+        while self.cumulative + 1 in self.pending:
+            data = self.pending.pop(self.cumulative + 1)
+            self.sink.write(data)
+            self.size += len(data)
+            self.cumulative += 1
+
+    def ack(self):
+        """Returns the cumulative and selective acknowledgement of the
+        chunks that have been received."""
+        bits = 0
+        for seq in self.pending:
+            bits |= 1 << (seq - self.cumulative - 1)
+        self.unacked = 0
+        return [self.cumulative, bits]
+
+    def done(self):
+        """Returns whether every chunk has been written."""
+        return self.end is not None and self.cumulative >= self.end
+
+
+class Streams(object):
+    """Keeps track of the streams an endpoint is sending and receiving.
+
+    Args:
+      send (function): Called with a peer and a message dictionary to send
+        the message to the peer.
+      call_later (function): Schedules a callback, e.g. the listener's
+        call_later.
+      max_retries (int): The stream is given up on if no chunk has been
+        acknowledged for as long as it takes to retransmit a chunk this many
+        times. Defaults to 4.
+      ack_delay (float): The amount of time in seconds to wait before
+        acknowledging chunks that arrived in order, so several chunks are
+        acknowledged at once. Defaults to 0.05 seconds.
+      ack_every (int): Acknowledge chunks that arrived in order right away
+        once this many haven't been acknowledged. Defaults to 8.
+      odd (boolean): Whether the ids of the streams we send are odd or even,
+        so they never clash with the ids of the streams the peer sends.
+        Defaults to True.
+      max_receivers (int): The largest number of streams a single peer can
+        be sending us at once. Chunks of any further streams are answered
+        with a STREAM CANCEL. Defaults to MAX_RECEIVERS.
+      receiver_timeout (float): The number of seconds after which a stream
+        we're receiving is given up on if no chunk of it has arrived.
+        Defaults to RECEIVER_TIMEOUT.
+
+    """
+
+    def __init__(self, send, call_later, max_retries=4, ack_delay=0.05,
+                 ack_every=8, odd=True, max_receivers=MAX_RECEIVERS,
+                 receiver_timeout=RECEIVER_TIMEOUT):
+        self.send = send
+        self.call_later = call_later
+        self.max_retries = max_retries
+        self.ack_delay = ack_delay
+        self.ack_every = ack_every
+        self.max_receivers = max_receivers
+        self.receiver_timeout = receiver_timeout
+        self.stream_ids = itertools.count(1 if odd else 2, 2)
+        self.lock = threading.Lock()
+
+        self.senders = {}       # StreamSenders keyed by (peer, stream id).
+        self.receivers = {}     # StreamReceivers keyed by (peer, stream id).
+        self.receiving = {}     # The number of StreamReceivers of each peer.
+        self.finished = OrderedDict()   # Final acks, or None if cancelled.
+        self.sinks = {}         # (sink, callback) keyed by stream name.
+
+    def open(self, peer, source, rtt, name=None, chunk_size=1024,
+             window_size=64, text=False, callback=None):
+        """Starts sending a blob to a peer. See StreamSender.
+
+        Returns:
+          The id of the stream.
+
+        """
+
+        stream_id = next(self.stream_ids)
+        if text:
+            # Base64 makes chunks a third larger, so send less per chunk.
+            chunk_size = max(chunk_size * 3 // 4, 1)
+        sender = StreamSender(self, peer, stream_id, source, rtt, name,
+                              chunk_size, window_size, text, callback)
+        self.senders[(peer, stream_id)] = sender
+        sender.fill()
+        return stream_id
+
+    def listen(self, sink, name=None, callback=None):
+        """Sets the sink that streams with a given name are written to.
+
+        Args:
+          sink (file): A writable file-like object with a "write" method, or
+            a function that is called with the peer and the name of each new
+            stream and returns one.
+          name (string): The name of the streams to write to the sink. If
+            None, the sink receives the streams that no other sink was set
+            for. Defaults to None.
+          callback (function): Called with the peer, the name of the stream
+            and its size in bytes once a stream has been received. Defaults to
+            None.
+
+        Returns:
+          None
+
+        """
+
+        self.sinks[name] = (sink, callback)
+
+    def handle(self, peer, message):
+        """Handles a STREAM, STREAM ACK or STREAM CANCEL message from a peer.
+
+        Args:
+          peer (any): The peer that sent the message.
+          message (dict): The unserialized message.
+
+        Returns:
+          None
+
+        """
+
+        key = (peer, message.get("stream"))
+        method = message["method"]
+
+        if method == "STREAM ACK":
+            sender = self.senders.get(key)
+            if sender:
+                sender.acknowledge(*message["ack"])
+
+        elif method == "STREAM CANCEL":
+            sender = self.senders.get(key)
+            if sender:
+                logger.warning("Stream %s was cancelled by %s" % (key[1],
+                                                                  str(peer)))
+                sender.finish(False)
+            with self.lock:
+                self.drop(key)
+
+        elif method == "STREAM":
+            self.receive(peer, key, message)
+
+    def receive(self, peer, key, message):
+        """Writes a received chunk to its stream's sink, and acknowledges it
+        right away or after a short delay."""
+        data = message.get("data", b"")
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+
+        cancel = False
+        ack = None
+        done = None
+        with self.lock:
+            receiver = self.receivers.get(key)
+            if receiver is None:
+                if key in self.finished:
+                    # Late chunks of a stream we cancelled are cancelled
+                    # again, instead of starting a stream without a sink.
+                    ack = self.finished[key]
+                    cancel = ack is None
+                elif self.receiving.get(peer, 0) >= self.max_receivers:
+                    logger.warning("Too many streams from %s. Cancelling "
+                                   "stream %s" % (str(peer), key[1]))
+                    cancel = True
+                else:
+                    receiver = StreamReceiver(key[1], MAX_PENDING)
+                    self.receivers[key] = receiver
+                    self.receiving[peer] = self.receiving.get(peer, 0) + 1
+                    receiver.expire_call = self.call_later(
+                        self.receiver_timeout, self.expire, key)
+
+            if receiver is not None:
+                receiver.received = monotonic()
+                # The first chunk tells us which sink to write to.
+                if message["euuid"] == 1 and receiver.sink is None:
+                    receiver.name = message.get("name")
+                    sink, callback = self.sinks.get(
+                        receiver.name, self.sinks.get(None, (None, None)))
+                    if sink is not None and not hasattr(sink, "write"):
+                        sink = sink(peer, receiver.name)
+                    if sink is None:
+                        logger.warning("No sink for stream %s from %s" % (
+                            receiver.name, str(peer)))
+                        cancel = True
+                        self.drop(key)
+                        self.remember(key, None)
+                    receiver.sink = sink
+                    receiver.callback = callback
+
+                if not cancel:
+                    urgent = receiver.receive(message["euuid"], data,
+                                              message.get("end"))
+                    if receiver.done():
+                        self.drop(key)
+                        ack = receiver.ack()
+                        self.remember(key, ack)
+                        done = receiver
+                    elif urgent or receiver.unacked >= self.ack_every:
+                        ack = receiver.ack()
+                    elif not receiver.ack_call:
+                        receiver.ack_call = self.call_later(
+                            self.ack_delay, self.send_ack, key)
+
+                    if ack and receiver.ack_call:
+                        receiver.ack_call.cancel()
+                        receiver.ack_call = None
+
+        if cancel:
+            self.send(peer, {"method": "STREAM CANCEL", "stream": key[1]})
+            return
+
+        if ack:
+            self.send(peer, {"method": "STREAM ACK", "stream": key[1],
+                             "ack": ack})
+
+        if done and done.callback:
+            done.callback(peer, done.name, done.size)
+
+    def remember(self, key, ack):
+        """Keeps the final acknowledgement of a finished stream, or None if
+        we cancelled it, for the chunks that arrive after it. Must be called
+        with the lock held."""
+        self.finished[key] = ack
+        if len(self.finished) > FINISHED_HISTORY:
+            self.finished.popitem(last=False)
+
+    def send_ack(self, key):
+        """Sends the delayed acknowledgement of a stream."""
+        with self.lock:
+            receiver = self.receivers.get(key)
+            if not receiver:
+                return
+            receiver.ack_call = None
+            ack = receiver.ack()
+        self.send(key[0], {"method": "STREAM ACK", "stream": key[1],
+                           "ack": ack})
+
+    def expire(self, key):
+        """Gives up on a stream we're receiving if no chunk of it has arrived
+        for "receiver_timeout" seconds, or checks again once that much time
+        has passed since the last one."""
+        with self.lock:
+            receiver = self.receivers.get(key)
+            if not receiver:
+                return
+            idle = monotonic() - receiver.received
+            if idle < self.receiver_timeout:
+                receiver.expire_call = self.call_later(
+                    self.receiver_timeout - idle, self.expire, key)
+                return
+            self.drop(key)
+        logger.warning("Timed out waiting for stream %s from %s" % (
+            key[1], str(key[0])))
+
+    def drop(self, key):
+        """Forgets a stream we're receiving and cancels its scheduled calls.
+        Must be called with the lock held.
+
+        Returns:
+          The StreamReceiver, or None if we weren't receiving the stream.
+
+        """
+
+        receiver = self.receivers.pop(key, None)
+        if receiver is None:
+            return None
+
+        peer = key[0]
+        self.receiving[peer] -= 1
+        if not self.receiving[peer]:
+            del self.receiving[peer]
+        for scheduled_call in (receiver.ack_call, receiver.expire_call):
+            if scheduled_call:
+                scheduled_call.cancel()
+        receiver.ack_call = None
+        receiver.expire_call = None
+        return receiver
+
+    def close(self, peer):
+        """Stops every stream to and from a peer, e.g. when a client is
+        evicted."""
+        for key in list(self.senders):
+            if key[0] == peer:
+                self.senders[key].finish(False)
+        with self.lock:
+            for key in list(self.receivers):
+                if key[0] == peer:
+                    self.drop(key)
+
+    def stats(self):
+        """Returns the number of streams being sent and received."""
+        return {"sending": len(self.senders),
+                "receiving": len(self.receivers)}
@@ -37,7 +37,8 @@ class _Middleware(object):
 
         Args:
           cuuid (string): The client's universally unique identifier (uuid).
-          euuid (string): The event's universally unique identifier (uuid).
+          euuid (int): The event's sequence number. This is unique for each
+            client, and is a uuid string if the client uses "debug_ids".
           event_data (any): Arbitrary data sent from the client.
 
         Returns:
@@ -53,7 +54,8 @@ class _Middleware(object):
 
         Args:
           cuuid (string): The client's universally unique identifier (uuid).
-          euuid (string): The event's universally unique identifier (uuid).
+          euuid (int): The event's sequence number. This is unique for each
+            client, and is a uuid string if the client uses "debug_ids".
           event_data (any): Arbitrary data sent from the client.
 
         Returns:
@@ -62,6 +64,41 @@ class _Middleware(object):
         """
         pass
 
+    def event_apply(self, cuuid, euuid, event_data, result):
+        """Used instead of "event_execute" when the server's executor runs in
+        "process" mode. The executor's function does the work of the event in
+        a worker process, and its result is applied to the game here, in the
+        server's process. This method MUST be overridden in the child class
+        when using "process" mode.
+
+        Args:
+          cuuid (string): The client's universally unique identifier (uuid).
+          euuid (int): The event's sequence number.
+          event_data (any): Arbitrary data sent from the client.
+          result (any): What the executor's function returned for the event.
+
+        Returns:
+          None
+
+        """
+        pass
+
+    def client_evicted(self, cuuid, reason):
+        """Called when a client is removed from the server's registry, e.g.
+        because it has been idle for too long. This method can be overridden
+        in the child class to clean up any state kept for the client.
+
+        Args:
+          cuuid (string): The client's universally unique identifier (uuid).
+          reason (string): Why the client was evicted. Either "idle",
+            "expired" or the reason given to NeteriaServer.evict.
+
+        Returns:
+          None
+
+        """
+        pass
+
 
 class _ControllerMiddleware(_Middleware):
 
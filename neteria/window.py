@@ -0,0 +1,426 @@
+#!/usr/bin/python
+#
+# Neteria
+# Copyright (C) 2014, William Edwards <shadowapex@gmail.com>,
+#
+# This file is part of Neteria.
+#
+# Neteria is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neteria is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neteria.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Contributor(s):
+#
+# William Edwards <shadowapex@gmail.com>
+# Derek Clark <derekjohn.clark@gmail.com>
+#
+"""The window module keeps track of the reliable messages that have been
+sent to a client but haven't been confirmed yet.
+
+Messages are numbered with sequence numbers, so instead of keeping every
+message in a dictionary with its own scheduled retransmit, each window keeps
+its messages in a ring buffer indexed by sequence number. A single scheduled
+call per client then walks the window to retransmit the messages that are
+due.
+
+The span of sequence numbers in the ring buffer is limited, so a peer that
+sends wildly different ids can't make it grow without bounds. Messages
+outside of the span are kept in a dictionary instead.
+
+On the receiving side, a ReceiveWindow keeps track of which numbered
+messages have arrived, as the highest sequence number up to which every
+message has been received plus a bitmap of the messages after it. This is
+what the receiver acknowledges, and how it recognizes duplicates.
+
+Examples:
+  >>> window = SendWindow()
+  >>> window.add(1, packet, now, now + 0.1)
+  >>> window.ack(1, 0)
+  [now]
+
+"""
+
+
+# The largest span of sequence numbers the ring buffer of a window grows to.
+MAX_SPAN = 4096
+
+# The number of messages after the cumulative acknowledgement that can be
+# selectively acknowledged. A message that is still missing after this many
+# newer messages have arrived is assumed to have been given up on.
+ACK_BITS = 1024
+
+# How far past the cumulative acknowledgement a message can be and still be
+# received. Anything further ahead is dropped, so a single bogus sequence
+# number can't make the bitmap huge or skip over the messages before it.
+MAX_AHEAD = 2 * ACK_BITS
+
+
+class SendWindow(object):
+    """The unconfirmed messages of one kind sent to a client.
+
+    For every message the window keeps the serialized packet, the time it
+    was first sent, the time it is due to be retransmitted and the number of
+    times it has been retransmitted. Messages with ids that aren't sequence
+    numbers, such as uuid strings in debug mode, or that are too far from
+    the other messages in flight, are kept in a dictionary instead.
+
+    Args:
+      capacity (int): The initial number of slots in the ring buffer. The
+        buffer grows when the messages in flight span more sequence numbers.
+        Defaults to 64.
+      max_span (int): The largest number of slots the ring buffer grows to.
+        Defaults to MAX_SPAN.
+
+    """
+
+    __slots__ = ("low", "high", "count", "packets", "sent", "due", "retries",
+                 "other", "max_span")
+
+    def __init__(self, capacity=64, max_span=MAX_SPAN):
+        self.low = 0    # The lowest sequence number that may be in flight.
+        self.high = 0   # One more than the highest sequence number in flight.
+        self.count = 0  # The number of messages in the ring buffer.
+        self.packets = [None] * capacity
+        self.sent = [0.0] * capacity
+        self.due = [0.0] * capacity
+        self.retries = [0] * capacity
+        self.other = {}  # [packet, sent, due, retries] of other ids.
+        self.max_span = max(max_span, capacity)
+
+    def __len__(self):
+        return self.count + len(self.other)
+
+    def __contains__(self, seq):
+        if type(seq) is not int or seq in self.other:
+            return seq in self.other
+        return (self.low <= seq < self.high and
+                self.packets[seq % len(self.packets)] is not None)
+
+    def add(self, seq, packet, sent, due):
+        """Adds a message that was just sent.
+
+        Args:
+          seq (int): The sequence number of the message.
+          packet (bytes): The serialized packet to retransmit.
+          sent (float): The monotonic time the message was sent.
+          due (float): The monotonic time the message should be retransmitted
+            if it hasn't been confirmed.
+
+        Returns:
+          None
+
+        """
+
+        if type(seq) is not int or seq in self.other:
+            self.other[seq] = [packet, sent, due, 0]
+            return
+
+        if not self.count:
+            self.low = self.high = seq
+        low = min(self.low, seq)
+        high = max(self.high, seq + 1)
+        if high - low > self.max_span:
+            self.other[seq] = [packet, sent, due, 0]
+            return
+        if high - low > len(self.packets):
+            self.resize(high - low)
+        self.low = low
+        self.high = high
+
+        index = seq % len(self.packets)
+        if self.packets[index] is None:
+            self.count += 1
+        self.packets[index] = packet
+        self.sent[index] = sent
+        self.due[index] = due
+        self.retries[index] = 0
+
+    def resize(self, span):
+        """Grows the ring buffer so it can hold messages spanning "span"
+        sequence numbers."""
+        size = len(self.packets)
+        while size < span:
+            size *= 2
+        size = min(size, self.max_span)
+
+        packets = [None] * size
+        sent = [0.0] * size
+        due = [0.0] * size
+        retries = [0] * size
+        for seq in range(self.low, self.high):
+            old = seq % len(self.packets)
+            if self.packets[old] is not None:
+                new = seq % size
+                packets[new] = self.packets[old]
+                sent[new] = self.sent[old]
+                due[new] = self.due[old]
+                retries[new] = self.retries[old]
+
+        self.packets = packets
+        self.sent = sent
+        self.due = due
+        self.retries = retries
+
+    def remove(self, seq):
+        """Removes a message that has been confirmed or given up on.
+
+        Args:
+          seq (int): The sequence number of the message.
+
+        Returns:
+          A tuple of the time the message was first sent and the number of
+          times it was retransmitted, or None if it wasn't in flight.
+
+        """
+
+        if type(seq) is not int or seq in self.other:
+            entry = self.other.pop(seq, None)
+            if entry is None:
+                return None
+            return entry[1], entry[3]
+
+        if not self.low <= seq < self.high:
+            return None
+        size = len(self.packets)
+        index = seq % size
+        if self.packets[index] is None:
+            return None
+
+        self.packets[index] = None
+        self.count -= 1
+
+        # Move the start of the window past the messages that are done.
+        if self.count:
+            while self.packets[self.low % size] is None:
+                self.low += 1
+        else:
+            self.low = self.high
+
+        return self.sent[index], self.retries[index]
+
+    def resend(self, seq, now, rtt):
+        """Marks a message as retransmitted ahead of its due time, e.g.
+        because messages sent after it have already been acknowledged.
+
+        Args:
+          seq (int): The sequence number of the message.
+          now (float): The current monotonic time.
+          rtt (core.RTTEstimator): The estimator used to back off the due
+            time of the message.
+
+        Returns:
+          The packet to retransmit, or None if the message isn't in flight or
+          has already been retransmitted.
+
+        """
+
+        entry = self.other.get(seq)
+        if entry is not None:
+            if entry[3]:
+                return None
+            entry[3] = 1
+            entry[2] = now + rtt.timeout(1)
+            return entry[0]
+
+        if not self.low <= seq < self.high:
+            return None
+        index = seq % len(self.packets)
+        if self.packets[index] is None or self.retries[index]:
+            return None
+
+        self.retries[index] = 1
+        self.due[index] = now + rtt.timeout(1)
+        return self.packets[index]
+
+    def ack(self, cumulative, bits):
+        """Removes every message covered by a cumulative and selective
+        acknowledgement.
+
+        Args:
+          cumulative (int): Every message up to and including this sequence
+            number was received.
+          bits (int): Bit n is set if message "cumulative + n + 1" was
+            received.
+
+        Returns:
+          A list of the times that the removed messages were sent, for the
+          messages that were never retransmitted.
+
+        """
+
+        samples = []
+        end = min(self.high, cumulative + 1 + bits.bit_length())
+        for seq in range(self.low, end):
+            if seq <= cumulative or (bits >> (seq - cumulative - 1)) & 1:
+                entry = self.remove(seq)
+                if entry and not entry[1]:
+                    samples.append(entry[0])
+
+        for seq in [seq for seq in self.other if type(seq) is int]:
+            if seq <= cumulative or (
+                    0 < seq - cumulative <= bits.bit_length() and
+                    (bits >> (seq - cumulative - 1)) & 1):
+                entry = self.remove(seq)
+                if entry and not entry[1]:
+                    samples.append(entry[0])
+        return samples
+
+    def poll(self, now, rtt, max_retries):
+        """Finds the messages that are due to be retransmitted. Their retry
+        count is increased and they are given a new due time, while messages
+        that have already been retransmitted "max_retries" times are removed.
+
+        Args:
+          now (float): The current monotonic time.
+          rtt (core.RTTEstimator): The estimator used to back off the due
+            times of retransmitted messages.
+          max_retries (int): The number of times to retransmit a message
+            before giving up on it.
+
+        Returns:
+          A tuple of the packets to retransmit, the ids of the messages that
+          were given up on, and the time the next message is due, or None if
+          the window is empty.
+
+        """
+
+        packets = []
+        expired = []
+        next_due = None
+        size = len(self.packets)
+
+        for seq in range(self.low, self.high):
+            index = seq % size
+            if self.packets[index] is None:
+                continue
+            if self.due[index] <= now:
+                if self.retries[index] >= max_retries:
+                    expired.append(seq)
+                    continue
+                self.retries[index] += 1
+                self.due[index] = now + rtt.timeout(self.retries[index])
+                packets.append(self.packets[index])
+            if next_due is None or self.due[index] < next_due:
+                next_due = self.due[index]
+
+        for seq, entry in list(self.other.items()):
+            if entry[2] <= now:
+                if entry[3] >= max_retries:
+                    expired.append(seq)
+                    continue
+                entry[3] += 1
+                entry[2] = now + rtt.timeout(entry[3])
+                packets.append(entry[0])
+            if next_due is None or entry[2] < next_due:
+                next_due = entry[2]
+
+        for seq in expired:
+            self.remove(seq)
+
+        return packets, expired, next_due
+
+    def replace(self, function):
+        """Replaces the packet of every message with the result of calling
+        a function with it, e.g. to encrypt it with a new key."""
+        for index, packet in enumerate(self.packets):
+            if packet is not None:
+                self.packets[index] = function(packet)
+        for entry in self.other.values():
+            entry[0] = function(entry[0])
+
+    def clear(self):
+        """Removes every message."""
+        for index in range(len(self.packets)):
+            self.packets[index] = None
+        self.count = 0
+        self.low = self.high
+        self.other.clear()
+
+
+class ReceiveWindow(object):
+    """Keeps track of which numbered messages have been received.
+
+    The window keeps the highest sequence number up to which every message
+    has been received, plus a bitmap of the messages received after it.
+
+    Args:
+      cumulative (int): The sequence number up to which every message counts
+        as received. Defaults to 0.
+
+    """
+
+    __slots__ = ("cumulative", "bits")
+
+    def __init__(self, cumulative=0):
+        self.cumulative = cumulative
+        self.bits = 0   # Bit n is set if message "cumulative + n + 1" arrived.
+
+    def receive(self, seq):
+        """Records that a message has been received.
+
+        Args:
+          seq (int): The sequence number of the message.
+
+        Returns:
+          True if this is the first time the message was received, False if
+          it is a duplicate, or None if it is too far ahead of the messages
+          we've received to be kept track of. Such messages should be dropped
+          without acknowledging them.
+
+        """
+
+        offset = seq - self.cumulative - 1
+        if offset >= MAX_AHEAD:
+            return None
+        if offset < 0 or (self.bits >> offset) & 1:
+            return False
+
+        self.bits |= 1 << offset
+        self.advance()
+
+        # If we're missing a message that the sender has probably given up on
+        # by now, stop waiting for it so the bitmap stays bounded.
+        excess = self.bits.bit_length() - ACK_BITS
+        if excess > 0:
+            self.bits >>= excess
+            self.cumulative += excess
+            self.advance()
+
+        return True
+
+    def advance(self):
+        """Moves the cumulative sequence number past every message that has
+        been received in order."""
+        while self.bits & 1:
+            self.bits >>= 1
+            self.cumulative += 1
+
+    def missing(self):
+        """Returns the sequence numbers of the messages missing before the
+        newest message received."""
+        return [self.cumulative + offset + 1
+                for offset in range(self.bits.bit_length())
+                if not (self.bits >> offset) & 1]
+
+    def skip(self):
+        """Stops waiting for any missing messages."""
+        self.cumulative += self.bits.bit_length()
+        self.bits = 0
+
+    def catch_up(self, seq):
+        """Stops waiting for the messages that are too far behind a message
+        to keep track of both, so the message can be received."""
+        excess = seq - self.cumulative - MAX_AHEAD
+        if excess > 0:
+            self.bits >>= excess
+            self.cumulative += excess
+            self.advance()
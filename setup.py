@@ -11,6 +11,7 @@ setup(name='neteria',
       packages=['neteria'],
       license='GPLv3',
       install_requires = ['rsa'],
+      extras_require = {'encryption': ['cryptography']},
 
       classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -0,0 +1,145 @@
+"""Tests for the asyncio listener, server and client."""
+
+import asyncio
+import threading
+import unittest
+
+from neteria.aio import AsyncNeteriaClient, AsyncNeteriaServer
+from neteria.executor import EventExecutor
+from neteria.tools import _Middleware
+
+
+class IllegalMiddleware(_Middleware):
+    """Judges events with "illegal" set ILLEGAL."""
+
+    def event_legal(self, cuuid, euuid, event_data):
+        return not event_data.get("illegal")
+
+
+class NotifyMiddleware(_Middleware):
+    """Echoes every event back to the client that sent it."""
+
+    def __init__(self):
+        _Middleware.__init__(self)
+        self.threads = []
+
+    def event_execute(self, cuuid, euuid, event_data):
+        self.threads.append(threading.current_thread())
+        self.server.notify(cuuid, event_data)
+
+
+async def wait_for(condition, timeout=5.0):
+    """Waits on the event loop until a condition is true, or the timeout has
+    passed."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+class AsyncTestCase(unittest.TestCase):
+
+    def run_loop(self, coroutine):
+        loop = asyncio.new_event_loop()
+        loop.set_debug(True)
+        errors = []
+        loop.set_exception_handler(lambda loop, context: errors.append(
+            context))
+        try:
+            asyncio.set_event_loop(loop)
+            with self.assertNoLogs("neteria", "ERROR"):
+                loop.run_until_complete(coroutine)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        self.assertEqual(errors, [])
+
+    async def connect(self, middleware, server_options={}):
+        server = AsyncNeteriaServer(middleware, server_address="127.0.0.1",
+                                    server_port=0, timeout=0.3,
+                                    **server_options)
+        await server.listen()
+        port = server.listener.sock.getsockname()[1]
+
+        client = AsyncNeteriaClient(client_address="127.0.0.1",
+                                    server_port=port, timeout=0.3)
+        await client.listen()
+        client.register(("127.0.0.1", port))
+        self.assertTrue(await wait_for(lambda: client.registered))
+        return server, client
+
+    def test_event_judgements(self):
+        async def main():
+            server, client = await self.connect(IllegalMiddleware())
+            legal = client.event({"x": 1})
+            illegal = client.event({"illegal": True})
+            self.assertTrue(await wait_for(lambda: not client.event_uuids))
+            self.assertEqual(list(client.event_rollbacks), [illegal])
+            self.assertNotIn(legal, client.event_rollbacks)
+
+            # Both endpoints run on the loop, without any extra threads.
+            self.assertIsNone(server.listener.listen_thread)
+            self.assertIsNone(client.listener.scheduler_thread)
+            server.listener.stop()
+            client.listener.stop()
+
+        self.run_loop(main())
+
+    def test_notify_from_middleware(self):
+        middleware = NotifyMiddleware()
+
+        async def main():
+            server, client = await self.connect(middleware)
+            client.event({"x": 1})
+            self.assertTrue(await wait_for(lambda: client.event_notifies))
+            self.assertEqual(list(client.event_notifies.values()),
+                             [{"x": 1}])
+            server.listener.stop()
+            client.listener.stop()
+
+        self.run_loop(main())
+        self.assertEqual(middleware.threads, [threading.main_thread()])
+
+    def test_notify_from_worker_thread(self):
+        middleware = NotifyMiddleware()
+
+        async def main():
+            server, client = await self.connect(
+                middleware, {"executor": EventExecutor(mode="thread")})
+            client.event({"x": 1})
+            self.assertTrue(await wait_for(lambda: client.event_notifies))
+            self.assertEqual(list(client.event_notifies.values()),
+                             [{"x": 1}])
+            server.listener.stop()
+            client.listener.stop()
+
+        self.run_loop(main())
+        self.assertNotEqual(middleware.threads, [threading.main_thread()])
+
+    def test_call_later_from_thread(self):
+        async def main():
+            server, client = await self.connect(_Middleware())
+            results = []
+
+            def schedule():
+                server.listener.call_later(0.01, results.append, "called")
+                server.listener.call_later(0.01, results.append,
+                                           "cancelled").cancel()
+
+            thread = threading.Thread(target=schedule)
+            thread.start()
+            thread.join()
+            self.assertTrue(await wait_for(lambda: results))
+            await asyncio.sleep(0.05)
+            self.assertEqual(results, ["called"])
+            server.listener.stop()
+            client.listener.stop()
+
+        self.run_loop(main())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+"""Tests for running a server in several worker processes."""
+
+import multiprocessing
+import socket
+import time
+import unittest
+
+from neteria.client import NeteriaClient
+from neteria.cluster import ClusterWorker, NeteriaCluster
+from neteria.tools import _Middleware
+
+
+class FakeServer(object):
+    """Records the notifies a worker's server is asked to send."""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.notified = []
+
+    def notify(self, cuuid, event_data):
+        self.notified.append((cuuid, event_data))
+
+    def notify_all(self, event_data):
+        self.notified.append((None, event_data))
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ClusterWorkerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.parent, child = multiprocessing.Pipe()
+        self.server = FakeServer({"local": None})
+        self.worker = ClusterWorker(0, child, self.server)
+
+    def test_notify_local_client(self):
+        self.worker.notify("local", {"x": 1})
+        self.assertEqual(self.server.notified, [("local", {"x": 1})])
+        self.assertFalse(self.parent.poll())
+
+    def test_notify_relays_other_clients(self):
+        self.worker.notify("remote", {"x": 1})
+        self.assertEqual(self.server.notified, [])
+        self.assertEqual(self.parent.recv(), ("notify", "remote", {"x": 1}))
+
+    def test_notify_all(self):
+        self.worker.notify_all({"x": 1})
+        self.assertEqual(self.server.notified, [(None, {"x": 1})])
+        self.assertEqual(self.parent.recv(), ("notify_all", {"x": 1}))
+
+    def test_run_commands(self):
+        self.parent.send(("notify", "local", {"x": 1}))
+        self.parent.send(("notify", "remote", {"x": 2}))
+        self.parent.send(("stop",))
+        self.server.listener = type("Listener", (object,), {})()
+        self.worker.run()
+        self.assertEqual(self.server.notified, [("local", {"x": 1})])
+        self.assertFalse(self.server.listener.listening)
+
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"),
+                     "SO_REUSEPORT is not supported")
+class ClusterTestCase(unittest.TestCase):
+
+    def test_notify_through_cluster(self):
+        port = free_port()
+        cluster = NeteriaCluster(_Middleware, workers=2,
+                                 server_address="127.0.0.1", server_port=port,
+                                 timeout=0.3)
+        cluster.start()
+        try:
+            client = NeteriaClient(client_address="127.0.0.1",
+                                   server_port=port, timeout=0.3)
+            client.listen()
+            client.register(("127.0.0.1", port))
+            deadline = time.time() + 5.0
+            while not client.registered and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(client.registered)
+
+            stats = cluster.stats()
+            self.assertEqual(len(stats["workers"]), 2)
+            self.assertEqual(stats["registered"], 1)
+
+            # Only the worker the client registered with sends the notify.
+            cluster.notify(str(client.cuuid), {"x": 1})
+            while not client.event_notifies and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(list(client.event_notifies.values()),
+                             [{"x": 1}])
+            time.sleep(0.1)
+            self.assertEqual(len(client.event_notifies), 1)
+        finally:
+            cluster.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
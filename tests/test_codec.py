@@ -0,0 +1,212 @@
+"""Tests for the json and binary codecs."""
+
+import array
+import enum
+import sys
+import unittest
+import uuid
+
+from collections import OrderedDict, defaultdict
+
+from neteria import codec as codec_module
+from neteria.codec import BINARY, JSON, detect_codec, get_codec
+from neteria.codec import FLAG_PAYLOAD, KEYS, METHODS
+from neteria.codec import pack_varint, unpack_varint
+from neteria.core import serialize_data, unserialize_data
+
+
+MESSAGE = {"method": "EVENT",
+           "cuuid": str(uuid.uuid1()),
+           "euuid": 42,
+           "priority": "normal",
+           "timestamp": "2014-11-16 13:59:21.000000",
+           "event_data": {"name": "player", "pos": [1.5, -2.25],
+                          "hp": -7, "alive": True, "item": None,
+                          "tags": ["a", "b"], "big": 2 ** 70},
+           "custom key": "kept"}
+
+
+class CodecTestCase(unittest.TestCase):
+
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 70):
+            packed = pack_varint(value)
+            self.assertEqual(unpack_varint(packed, 0), (value, len(packed)))
+        self.assertEqual(len(pack_varint(127)), 1)
+        self.assertEqual(len(pack_varint(128)), 2)
+
+    def test_round_trip(self):
+        for codec in (JSON, BINARY):
+            self.assertEqual(codec.decode(codec.encode(MESSAGE)), MESSAGE)
+
+    def test_binary_is_smaller(self):
+        self.assertLess(len(BINARY.encode(MESSAGE)),
+                        len(JSON.encode(MESSAGE)))
+
+    def test_binary_types(self):
+        data = {"bytes": b"\x00\xff", "tuple": (1, 2), "uuid": uuid.UUID(
+            "45e2e9c6-6c4a-11e4-a5c7-080027ad5e2c"), "float": 0.1,
+                "unicode": u"été", "empty": {}}
+        decoded = BINARY.decode(BINARY.encode(data))
+        self.assertEqual(decoded["bytes"], b"\x00\xff")
+        self.assertEqual(decoded["tuple"], [1, 2])
+        self.assertEqual(decoded["uuid"],
+                         "45e2e9c6-6c4a-11e4-a5c7-080027ad5e2c")
+        self.assertEqual(decoded["float"], 0.1)
+        self.assertEqual(decoded["unicode"], u"été")
+        self.assertEqual(decoded["empty"], {})
+
+    def test_subclasses(self):
+        class Color(enum.IntEnum):
+            RED = 1
+
+        class Name(str):
+            pass
+
+        counts = defaultdict(int)
+        counts["hits"] += 2
+        data = {"event_data": {"ordered": OrderedDict([("b", 1), ("a", 2)]),
+                               "counts": counts, "color": Color.RED,
+                               "name": Name("player"), "flag": True}}
+        expected = {"event_data": {"ordered": {"b": 1, "a": 2},
+                                   "counts": {"hits": 2}, "color": 1,
+                                   "name": "player", "flag": True}}
+        for codec in (JSON, BINARY):
+            decoded = codec.decode(codec.encode(data))
+            self.assertEqual(decoded, expected)
+            self.assertIs(type(decoded["event_data"]["color"]), int)
+            self.assertIs(decoded["event_data"]["flag"], True)
+            self.assertEqual(list(decoded["event_data"]["ordered"]),
+                             ["b", "a"])
+
+    def test_binary_unknown_type(self):
+        with self.assertRaises(TypeError):
+            BINARY.encode({"event_data": object()})
+
+    def test_binary_unknown_codes(self):
+        header = BINARY.HEADER.pack(BINARY.magic, len(METHODS) + 1, 0)
+        with self.assertRaises(ValueError):
+            BINARY.decode(header)
+
+        # Key 0 and keys past the known ones are rejected.
+        for key in (0, len(KEYS) + 1):
+            message = (BINARY.HEADER.pack(BINARY.magic, 1, FLAG_PAYLOAD) +
+                       BINARY.encode_value({key: 1}))
+            with self.assertRaises(ValueError):
+                BINARY.decode(message)
+
+        message = (BINARY.HEADER.pack(BINARY.magic, 1, FLAG_PAYLOAD) +
+                   BINARY.encode_value({len(KEYS): 1}))
+        self.assertEqual(BINARY.decode(message),
+                         {"method": METHODS[0], KEYS[-1]: 1})
+
+    def test_binary_decode_memoryview(self):
+        buf = bytearray(BINARY.encode(MESSAGE))
+        self.assertEqual(BINARY.decode(memoryview(buf)), MESSAGE)
+
+    def test_encoded_values(self):
+        for codec in (JSON, BINARY):
+            encoded = {"event_data": codec.encode_value({"x": [1, 2]})}
+            message = codec.encode({"method": "NOTIFY", "euuid": 1}, encoded)
+            self.assertEqual(codec.decode(message),
+                             {"method": "NOTIFY", "euuid": 1,
+                              "event_data": {"x": [1, 2]}})
+
+    def test_detect_codec(self):
+        self.assertIs(detect_codec(BINARY.encode(MESSAGE)), BINARY)
+        self.assertIs(detect_codec(JSON.encode(MESSAGE).encode()), JSON)
+        self.assertIs(get_codec("binary"), BINARY)
+
+    def test_serialize(self):
+        for codec in (None, BINARY):
+            for compression in (False, True):
+                packet = serialize_data(MESSAGE, compression, codec=codec)
+                self.assertIsInstance(packet, bytes)
+                self.assertEqual(unserialize_data(packet, compression),
+                                 MESSAGE)
+
+
+@unittest.skipIf(codec_module.numpy is not None,
+                 "Arrays are decoded as NumPy arrays")
+class ArrayTestCase(unittest.TestCase):
+
+    def round_trip(self, value):
+        return BINARY.decode(BINARY.encode({"event_data": value}))[
+            "event_data"]
+
+    def test_array(self):
+        for code, values in (("d", [1.5, -2.25, 3.0]), ("f", [0.5, 2.0]),
+                             ("h", [-1, 2, 3]), ("Q", [2 ** 63]),
+                             ("b", [-128, 127])):
+            decoded = self.round_trip(array.array(code, values))
+            self.assertIsInstance(decoded, memoryview)
+            self.assertEqual(decoded.format, code)
+            self.assertEqual(decoded.tolist(), values)
+
+    def test_decoded_as_view(self):
+        message = BINARY.encode({"event_data": array.array("d", [1.0, 2.0])})
+        decoded = BINARY.decode(message)["event_data"]
+        self.assertIs(decoded.obj, message)
+
+        # Views over a receive buffer would change when it is reused.
+        buf = bytearray(message)
+        decoded = BINARY.decode(memoryview(buf))["event_data"]
+        buf[:] = bytes(len(buf))
+        self.assertEqual(decoded.tolist(), [1.0, 2.0])
+
+    def test_shape(self):
+        view = memoryview(array.array("f", range(6))).cast("B").cast(
+            "f", (2, 3))
+        decoded = self.round_trip(view)
+        self.assertEqual(decoded.shape, (2, 3))
+        self.assertEqual(decoded.tolist(), [[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]])
+
+    def test_not_contiguous(self):
+        view = memoryview(array.array("i", range(10)))[::2]
+        self.assertEqual(self.round_trip(view).tolist(), [0, 2, 4, 6, 8])
+
+    def test_empty(self):
+        decoded = self.round_trip(array.array("d"))
+        self.assertEqual(decoded.tolist(), [])
+
+    def test_bytes_view(self):
+        self.assertEqual(self.round_trip(memoryview(b"\x00\x01")),
+                         b"\x00\x01")
+
+    def test_other_byte_order(self):
+        values = array.array("i", [1, -2, 70000])
+        parts = []
+        codec_module.pack_array(values, parts)
+        native = "<" if sys.byteorder == "little" else ">"
+        other = ">" if native == "<" else "<"
+        header = parts[0].replace((native + "i4").encode(),
+                                  (other + "i4").encode())
+        swapped = array.array("i", values)
+        swapped.byteswap()
+        decoded, offset = codec_module.unpack_value(
+            header + swapped.tobytes(), 0)
+        self.assertEqual(decoded.tolist(), [1, -2, 70000])
+
+    def test_unknown_dtype(self):
+        parts = []
+        codec_module.pack_array(array.array("i", [1]), parts)
+        header = parts[0].replace(b"i4", b"x4")
+        with self.assertRaises(ValueError):
+            codec_module.unpack_value(header + bytes(parts[1]), 0)
+
+    def test_truncated(self):
+        message = BINARY.encode({"event_data": array.array("d", [1.0, 2.0])})
+        with self.assertRaises(ValueError):
+            BINARY.decode(message[:-1])
+
+    def test_json_lists(self):
+        data = {"event_data": {"pos": array.array("d", [1.5, 2.5]),
+                               "view": memoryview(array.array("h", [1, 2]))}}
+        self.assertEqual(JSON.decode(JSON.encode(data)),
+                         {"event_data": {"pos": [1.5, 2.5], "view": [1, 2]}})
+        with self.assertRaises(TypeError):
+            JSON.encode({"event_data": object()})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+"""Tests for the listener, its scheduler and the serialization helpers."""
+
+import socket
+import threading
+import time
+import unittest
+
+from neteria.core import (ListenerUDP, RTTEstimator, bundle_packets,
+                          unbundle_packets)
+
+
+class App(object):
+    """Collects the messages a listener receives."""
+
+    def __init__(self):
+        self.messages = []
+        self.types = set()
+
+    def handle_message(self, data, address):
+        self.types.add(type(data))
+        self.messages.append((bytes(data), address))
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = ListenerUDP(App(), listen_address="127.0.0.1",
+                                    listen_port=0)
+        self.listener.listen()
+
+    def tearDown(self):
+        self.listener.listening = False
+        with self.listener.scheduler_condition:
+            self.listener.scheduler_condition.notify()
+        self.listener.sock.close()
+
+    def test_calls_run_in_order(self):
+        results = []
+        done = threading.Event()
+        self.listener.call_later(0.2, lambda args: done.set(), None)
+        self.listener.call_later(0.1, results.append, "second")
+        self.listener.call_later(0.05, results.append, "first")
+
+        self.assertTrue(done.wait(2.0))
+        self.assertEqual(results, ["first", "second"])
+
+    def test_earlier_call_wakes_scheduler(self):
+        called = threading.Event()
+        self.listener.call_later(60.0, lambda args: None, None)
+        time.sleep(0.05)
+        start = time.time()
+        self.listener.call_later(0.01, lambda args: called.set(), None)
+        self.assertTrue(called.wait(2.0))
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_cancel(self):
+        results = []
+        done = threading.Event()
+        self.listener.call_later(0.05, results.append, "cancelled").cancel()
+        self.listener.call_later(0.1, lambda args: done.set(), None)
+        self.assertTrue(done.wait(2.0))
+        self.assertEqual(results, [])
+
+    def test_cancelled_calls_are_compacted(self):
+        calls = [self.listener.call_later(60.0, lambda args: None, None)
+                 for i in range(10)]
+        for scheduled_call in calls[:6]:
+            scheduled_call.cancel()
+        with self.listener.scheduler_condition:
+            self.assertEqual(len(self.listener.scheduled_calls), 4)
+            self.assertFalse(any(scheduled_call.cancelled for scheduled_call
+                                 in self.listener.scheduled_calls))
+
+    def test_failing_call_keeps_scheduler_running(self):
+        called = threading.Event()
+
+        def fail(args):
+            raise ValueError("failed")
+
+        with self.assertLogs("neteria.core", "ERROR"):
+            self.listener.call_later(0.01, fail, None)
+            self.listener.call_later(0.05, lambda args: called.set(), None)
+            self.assertTrue(called.wait(2.0))
+
+
+class RTTEstimatorTestCase(unittest.TestCase):
+
+    def test_initial(self):
+        rtt = RTTEstimator(initial=1.5)
+        self.assertEqual(rtt.timeout(), 1.5)
+        self.assertEqual(rtt.stats(), {"srtt": None, "rttvar": None,
+                                       "rto": 1.5})
+
+    def test_first_sample(self):
+        rtt = RTTEstimator()
+        rtt.sample(0.2)
+        self.assertAlmostEqual(rtt.srtt, 0.2)
+        self.assertAlmostEqual(rtt.rttvar, 0.1)
+        self.assertAlmostEqual(rtt.rto, 0.6)
+
+    def test_smoothing(self):
+        rtt = RTTEstimator()
+        rtt.sample(0.2)
+        rtt.sample(0.4)
+        self.assertAlmostEqual(rtt.rttvar, 0.75 * 0.1 + 0.25 * 0.2)
+        self.assertAlmostEqual(rtt.srtt, 0.875 * 0.2 + 0.125 * 0.4)
+        self.assertAlmostEqual(rtt.rto, rtt.srtt + 4 * rtt.rttvar)
+
+        # A steady round trip time converges on it.
+        for i in range(100):
+            rtt.sample(0.3)
+        self.assertAlmostEqual(rtt.srtt, 0.3, places=3)
+
+    def test_bounds(self):
+        rtt = RTTEstimator(min_rto=0.5, max_rto=2.0)
+        rtt.sample(0.01)
+        self.assertEqual(rtt.rto, 0.5)
+        rtt = RTTEstimator(min_rto=0.5, max_rto=2.0)
+        rtt.sample(10.0)
+        self.assertEqual(rtt.rto, 2.0)
+
+    def test_backoff(self):
+        rtt = RTTEstimator(initial=1.0, max_rto=10.0)
+        for retry in range(1, 4):
+            timeout = rtt.timeout(retry)
+            self.assertLessEqual(timeout, 2 ** retry)
+            self.assertGreaterEqual(timeout, 0.75 * 2 ** retry)
+
+        # Backoff never goes past the largest RTO.
+        for i in range(20):
+            self.assertLessEqual(rtt.timeout(10), 10.0)
+            self.assertGreaterEqual(rtt.timeout(10), 7.5)
+
+
+class BatchedReceiveTestCase(unittest.TestCase):
+
+    def test_receive_batches(self):
+        app = App()
+        listener = ListenerUDP(app, listen_address="127.0.0.1",
+                               listen_port=0, batch_size=4, bufsize=64)
+        address = listener.sock.getsockname()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Queue up more datagrams than fit in one batch before listening,
+            # so they are drained in batches.
+            messages = [("message %d" % i).encode() for i in range(10)]
+            for message in messages:
+                sender.sendto(message, address)
+            listener.listen()
+
+            deadline = time.time() + 5.0
+            while len(app.messages) < 10 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual([data for data, source in app.messages],
+                             messages)
+            self.assertEqual(app.types, {memoryview})
+        finally:
+            listener.listening = False
+            sender.close()
+
+
+class BundleTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        packets = [b"first", b"", b"x" * 300]
+        bundle = bundle_packets(packets)
+        self.assertEqual(unbundle_packets(bundle), packets)
+        self.assertEqual(
+            [bytes(packet) for packet in
+             unbundle_packets(memoryview(bytearray(bundle)))], packets)
+
+    def test_truncated(self):
+        bundle = bundle_packets([b"first", b"second"])
+        with self.assertRaises(ValueError):
+            unbundle_packets(bundle[:-1])
+
+    def test_receive_bundle(self):
+        app = App()
+        listener = ListenerUDP(app, listen_address="127.0.0.1",
+                               listen_port=0)
+        try:
+            listener.receive_datagram(bundle_packets([b"first", b"second"]),
+                                      ("127.0.0.1", 1))
+            self.assertEqual(app.messages, [(b"first", ("127.0.0.1", 1)),
+                                            (b"second", ("127.0.0.1", 1))])
+
+            with self.assertLogs("neteria.core", "ERROR"):
+                listener.receive_datagram(bundle_packets([b"first"])[:-1],
+                                          ("127.0.0.1", 1))
+        finally:
+            listener.sock.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
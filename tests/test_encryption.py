@@ -0,0 +1,85 @@
+"""Tests for session key encryption."""
+
+import unittest
+
+from neteria.encryption import AESGCM, Encryption, Session
+
+
+@unittest.skipUnless(AESGCM, "cryptography is not installed")
+class SessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Session(direction=Session.CLIENT)
+        self.server = Session(self.client.key, Session.SERVER)
+
+    def test_round_trip(self):
+        message = self.client.encrypt(b"hello")
+        self.assertEqual(message[:1], Session.magic)
+        self.assertNotIn(b"hello", message)
+        self.assertEqual(self.server.decrypt(message), b"hello")
+        self.assertEqual(self.client.decrypt(self.server.encrypt(b"hi")),
+                         b"hi")
+
+    def test_key_exchange(self):
+        encryption = Encryption()
+        sealed = encryption.encrypt_key(self.server.key,
+                                        encryption.public_key)
+        key = encryption.decrypt_key(sealed)
+        self.assertEqual(key, self.server.key)
+        self.assertEqual(Session(key).decrypt(self.server.encrypt(b"hi")),
+                         b"hi")
+
+    def test_replay_rejected(self):
+        message = self.client.encrypt(b"hello")
+        self.server.decrypt(message)
+        with self.assertRaises(ValueError):
+            self.server.decrypt(message)
+
+    def test_reflection_rejected(self):
+        with self.assertRaises(ValueError):
+            self.client.decrypt(self.client.encrypt(b"hello"))
+
+    def test_tampering_rejected(self):
+        message = bytearray(self.client.encrypt(b"hello"))
+        message[-1] ^= 1
+        with self.assertRaises(Exception):
+            self.server.decrypt(bytes(message))
+        # A forged message doesn't use up its sequence number.
+        message[-1] ^= 1
+        self.assertEqual(self.server.decrypt(bytes(message)), b"hello")
+
+    def test_replay_window(self):
+        messages = [self.client.encrypt(str(i).encode())
+                    for i in range(Session.REPLAY_WINDOW + 3)]
+
+        # Messages can arrive out of order within the window.
+        self.assertEqual(self.server.decrypt(messages[1]), b"1")
+        self.assertEqual(self.server.decrypt(messages[0]), b"0")
+        with self.assertRaises(ValueError):
+            self.server.decrypt(messages[0])
+
+        # Messages older than the window are rejected.
+        self.server.decrypt(messages[-1])
+        with self.assertRaises(ValueError):
+            self.server.decrypt(messages[2])
+        self.assertEqual(self.server.decrypt(messages[-2]),
+                         str(Session.REPLAY_WINDOW + 1).encode())
+
+    def test_renew(self):
+        message = self.server.encrypt(b"hello")
+        self.assertEqual(self.client.decrypt(message), b"hello")
+        renewed = self.server.renew(message)
+        self.assertNotEqual(renewed, message)
+        self.assertEqual(self.client.decrypt(renewed), b"hello")
+        self.assertEqual(self.server.renew(b"plain"), b"plain")
+
+    def test_reseal(self):
+        other = Session(direction=Session.SERVER)
+        message = self.server.reseal(self.server.encrypt(b"hello"), other)
+        self.assertEqual(Session(other.key).decrypt(message), b"hello")
+        self.assertEqual(self.server.reseal(self.server.encrypt(b"hello")),
+                         b"hello")
+
+
+if __name__ == "__main__":
+    unittest.main()
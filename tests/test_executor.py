@@ -0,0 +1,120 @@
+"""Tests for the executor of LEGAL events."""
+
+import threading
+import time
+import unittest
+
+from neteria.executor import EventExecutor
+
+
+def square(key, value):
+    """Does the work of an event in a worker process."""
+    return value * value
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class EventExecutorTestCase(unittest.TestCase):
+
+    def test_order_per_key(self):
+        executor = EventExecutor(workers=4)
+        results = {"a": [], "b": [], "c": []}
+        lock = threading.Lock()
+
+        def execute(key, value):
+            # Yield so other workers get a chance to run out of order.
+            time.sleep(0.001)
+            with lock:
+                results[key].append(value)
+
+        for value in range(50):
+            for key in results:
+                executor.submit(key, execute, key, value)
+
+        self.assertTrue(wait_for(lambda: executor.stats()["executed"] == 150))
+        for key in results:
+            self.assertEqual(results[key], list(range(50)))
+        stats = executor.stats()
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertEqual(stats["queued_keys"], 0)
+        self.assertGreater(stats["max_queue_depth"], 0)
+
+    def test_one_key_at_a_time(self):
+        executor = EventExecutor(workers=4)
+        running = []
+        overlaps = []
+
+        def execute(value):
+            running.append(value)
+            if len(running) > 1:
+                overlaps.append(value)
+            time.sleep(0.005)
+            running.remove(value)
+
+        for value in range(10):
+            executor.submit("a", execute, value)
+        self.assertTrue(wait_for(lambda: executor.stats()["executed"] == 10))
+        self.assertEqual(overlaps, [])
+
+    def test_drop_when_full(self):
+        executor = EventExecutor(workers=1, max_queue=2, policy="drop")
+        release = threading.Event()
+        executor.submit("a", lambda: release.wait(5.0))
+        self.assertTrue(wait_for(lambda: executor.stats()["queue_depth"] == 1))
+        self.assertTrue(executor.submit("b", lambda: None))
+
+        with self.assertLogs("neteria.executor", "WARNING"):
+            self.assertFalse(executor.submit("c", lambda: None))
+        self.assertEqual(executor.stats()["dropped"], 1)
+
+        release.set()
+        self.assertTrue(wait_for(lambda: executor.stats()["executed"] == 2))
+
+    def test_errors_are_logged(self):
+        executor = EventExecutor(workers=1)
+
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertLogs("neteria.executor", "ERROR"):
+            executor.submit("a", fail)
+            self.assertTrue(wait_for(
+                lambda: executor.stats()["executed"] == 1))
+
+    def test_inline(self):
+        executor = EventExecutor(mode="inline")
+        results = []
+        self.assertTrue(executor.submit("a", results.append, 1))
+        self.assertEqual(results, [1])
+        self.assertEqual(executor.threads, [])
+        self.assertEqual(executor.stats()["executed"], 1)
+
+    def test_process(self):
+        executor = EventExecutor(mode="process", workers=2, function=square)
+        results = []
+        for value in range(5):
+            executor.submit("a", lambda key, value, result: results.append(
+                (value, result)), "a", value)
+        self.assertTrue(wait_for(lambda: len(results) == 5, 30.0))
+        self.assertEqual(results, [(value, value * value)
+                                   for value in range(5)])
+        executor.pool.shutdown()
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            EventExecutor(mode="fiber")
+        with self.assertRaises(ValueError):
+            EventExecutor(mode="process")
+        with self.assertRaises(ValueError):
+            EventExecutor(policy="wait")
+
+
+if __name__ == "__main__":
+    unittest.main()
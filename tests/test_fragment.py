@@ -0,0 +1,179 @@
+"""Tests for splitting messages into fragments and reassembling them."""
+
+import os
+import unittest
+
+from neteria.core import ScheduledCall
+from neteria.fragment import (FRAGMENT_ACK_MAGIC, HEADER_SIZE, Fragmenter,
+                              pack_bitmap, unpack_bitmap)
+
+
+ADDRESS = ("127.0.0.1", 40000)
+
+
+class FakeListener(object):
+    """Collects sent datagrams and scheduled calls instead of using the
+    network."""
+
+    def __init__(self):
+        self.sent = []
+        self.calls = []
+
+    def send_datagrams(self, datagrams):
+        self.sent.extend(datagrams)
+
+    def call_later(self, time_seconds, callback, arguments):
+        scheduled_call = ScheduledCall(time_seconds, callback, arguments)
+        self.calls.append(scheduled_call)
+        return scheduled_call
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for scheduled_call in calls:
+            if not scheduled_call.cancelled:
+                scheduled_call.callback(scheduled_call.args)
+
+
+class FragmenterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sender_listener = FakeListener()
+        self.receiver_listener = FakeListener()
+        self.sender = Fragmenter(self.sender_listener, mtu=100)
+        self.receiver = Fragmenter(self.receiver_listener, mtu=100)
+        self.message = os.urandom(1000)
+
+    def test_split(self):
+        fragments = self.sender.split(self.message, ADDRESS)
+        self.assertEqual(len(fragments), 13)
+        for fragment, address in fragments:
+            self.assertLessEqual(len(fragment), 100)
+            self.assertEqual(address, ADDRESS)
+        self.assertEqual(self.sender.stats["fragmented"], 1)
+
+    def test_reassemble_out_of_order(self):
+        fragments = self.sender.split(self.message, ADDRESS)
+        for fragment, address in reversed(fragments[1:]):
+            self.assertIsNone(self.receiver.receive(fragment, address))
+        message = self.receiver.receive(fragments[0][0], ADDRESS)
+        self.assertEqual(bytes(message), self.message)
+        self.assertEqual(self.receiver.stats["reassembled"], 1)
+        self.assertEqual(self.receiver.received_memory, 0)
+
+        # The sender forgets the message once it is acknowledged.
+        (ack, address), = self.receiver_listener.sent
+        self.assertEqual(ack[:1], FRAGMENT_ACK_MAGIC)
+        self.sender.acknowledge(ack, ADDRESS)
+        self.assertEqual(len(self.sender.sent), 0)
+        self.assertEqual(self.sender.sent_memory, 0)
+
+    def test_duplicate_fragments(self):
+        fragments = self.sender.split(self.message, ADDRESS)
+        for fragment, address in fragments[:-1]:
+            self.receiver.receive(fragment, address)
+            self.receiver.receive(fragment, address)
+        message = self.receiver.receive(fragments[-1][0], ADDRESS)
+        self.assertEqual(bytes(message), self.message)
+
+        # Late fragments of a delivered message are acknowledged again, but
+        # not delivered twice.
+        self.assertIsNone(self.receiver.receive(fragments[0][0], ADDRESS))
+        self.assertEqual(len(self.receiver_listener.sent), 2)
+
+    def test_missing_fragments_resent(self):
+        fragments = self.sender.split(self.message, ADDRESS)
+        for index, (fragment, address) in enumerate(fragments):
+            if index not in (2, 7):
+                self.receiver.receive(fragment, address)
+
+        # The first check only notes that fragments arrived. The next one
+        # asks for the missing fragments.
+        self.receiver_listener.run()
+        self.assertEqual(self.receiver_listener.sent, [])
+        self.receiver_listener.run()
+        (ack, address), = self.receiver_listener.sent
+        self.sender.acknowledge(ack, ADDRESS)
+        self.assertEqual(self.sender_listener.sent,
+                         [fragments[2], fragments[7]])
+        self.assertEqual(self.sender.stats["resent"], 2)
+
+        for fragment, address in self.sender_listener.sent:
+            message = self.receiver.receive(fragment, address)
+        self.assertEqual(bytes(message), self.message)
+
+    def test_split_again_sends_missing(self):
+        fragments = self.sender.split(self.message, ADDRESS)
+        bitmap = (1 << len(fragments)) - 1 - (1 << 4)
+        message_id = next(iter(self.sender.sent.values()))[0]
+        self.sender.acknowledge(self.sender.pack_ack(message_id, bitmap),
+                                ADDRESS)
+        self.assertEqual(self.sender.split(self.message, ADDRESS),
+                         [fragments[4]])
+
+        # Other addresses get the whole message.
+        other = ("127.0.0.1", 40001)
+        self.assertEqual(len(self.sender.split(self.message, other)),
+                         len(fragments))
+
+    def test_max_message_size(self):
+        sender = Fragmenter(self.sender_listener, mtu=100,
+                            max_message_size=500)
+        self.assertRaises(Exception, sender.split, self.message, ADDRESS)
+
+        receiver = Fragmenter(self.receiver_listener, mtu=100,
+                              max_message_size=500)
+        fragments = self.sender.split(self.message, ADDRESS)
+        self.assertIsNone(receiver.receive(fragments[0][0], ADDRESS))
+        self.assertEqual(receiver.stats["dropped"], 1)
+        self.assertEqual(receiver.received, {})
+
+    def test_memory_limit(self):
+        receiver = Fragmenter(self.receiver_listener, mtu=100,
+                              memory_limit=1500)
+        first = self.sender.split(self.message, ADDRESS)
+        second = self.sender.split(os.urandom(1000), ADDRESS)
+        receiver.receive(first[0][0], ADDRESS)
+        self.assertIsNone(receiver.receive(second[0][0], ADDRESS))
+        self.assertEqual(len(receiver.received), 1)
+        self.assertEqual(receiver.received_memory, 1000)
+
+    def test_timeout(self):
+        receiver = Fragmenter(self.receiver_listener, mtu=100, timeout=0.0)
+        fragments = self.sender.split(self.message, ADDRESS)
+        receiver.receive(fragments[0][0], ADDRESS)
+        self.receiver_listener.run()
+        self.assertEqual(receiver.received, {})
+        self.assertEqual(receiver.received_memory, 0)
+        self.assertEqual(receiver.stats["dropped"], 1)
+
+    def test_malformed(self):
+        fragments = self.sender.split(self.message, ADDRESS)
+        with self.assertLogs("neteria.fragment", "ERROR"):
+            self.assertIsNone(self.receiver.receive(fragments[0][0][:3],
+                                                    ADDRESS))
+        with self.assertLogs("neteria.fragment", "ERROR"):
+            self.assertIsNone(self.receiver.receive(fragments[0][0][:-1],
+                                                    ADDRESS))
+
+    def test_receive_views(self):
+        fragments = self.sender.split(self.message, ADDRESS)
+        for fragment, address in fragments:
+            message = self.receiver.receive(memoryview(fragment), address)
+        self.assertEqual(bytes(message), self.message)
+        (ack, address), = self.receiver_listener.sent
+        self.sender.acknowledge(bytearray(ack), address)
+        self.assertEqual(len(self.sender.sent), 0)
+
+    def test_bitmap(self):
+        self.assertEqual(pack_bitmap(0), b"")
+        self.assertEqual(pack_bitmap(0x1ff), b"\xff\x01")
+        for bits in (1, 255, 256, (1 << 700) - 5):
+            self.assertEqual(unpack_bitmap(pack_bitmap(bits)), bits)
+
+    def test_mtu_too_small(self):
+        self.assertRaises(ValueError, Fragmenter, self.sender_listener,
+                          mtu=HEADER_SIZE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""Tests for the spatial grid used for interest management."""
+
+import time
+import unittest
+
+from neteria.interest import SpatialGrid
+
+
+class SpatialGridTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = SpatialGrid(cell_size=10.0)
+
+    def test_query(self):
+        self.grid.update("a", (5, 5), radius=3)
+        self.grid.update("b", (25, 5), radius=3)
+        self.grid.update("c", (-15, -15))
+        self.assertEqual(self.grid.query((5, 5)), ["a"])
+        self.assertEqual(sorted(self.grid.query((15, 5), radius=8)),
+                         ["a", "b"])
+        self.assertEqual(self.grid.query((-15, -15), radius=0.5), ["c"])
+        self.assertEqual(self.grid.query((100, 100), radius=5), [])
+
+        # Circles in the same cells only match if they really overlap.
+        self.assertEqual(self.grid.query((9.9, 9.9), radius=1), [])
+        self.assertEqual(len(self.grid), 3)
+        self.assertIn("a", self.grid)
+        self.assertEqual(self.grid.get("a"), ((5, 5), 3))
+        self.assertIsNone(self.grid.get("d"))
+
+    def test_circle_across_cells(self):
+        self.grid.update("a", (10, 10), radius=5)
+        self.assertEqual(sorted(self.grid.cells),
+                         [(0, 0), (0, 1), (1, 0), (1, 1)])
+        for position in ((6, 10), (14, 10), (10, 6), (10, 14)):
+            self.assertEqual(self.grid.query(position), ["a"])
+
+    def test_move(self):
+        self.grid.update("a", (5, 5), radius=1)
+        cells = dict(self.grid.cells)
+        self.grid.update("a", (6, 6), radius=1)
+        self.assertEqual(self.grid.cells, cells)
+        self.assertEqual(self.grid.query((6, 6)), ["a"])
+
+        self.grid.update("a", (55, 55), radius=1)
+        self.assertEqual(self.grid.query((5, 5), radius=2), [])
+        self.assertEqual(self.grid.query((55, 55)), ["a"])
+        self.assertEqual(list(self.grid.cells), [(5, 5)])
+
+    def test_remove(self):
+        self.grid.update("a", (5, 5), radius=20)
+        self.assertTrue(self.grid.remove("a"))
+        self.assertFalse(self.grid.remove("a"))
+        self.assertEqual(self.grid.cells, {})
+        self.assertEqual(self.grid.query((5, 5)), [])
+
+    def test_large_query(self):
+        # Queries that cover more cells than there are circles look at every
+        # circle instead.
+        self.grid.update("a", (5, 5))
+        self.grid.update("b", (500, 500))
+        self.assertEqual(sorted(self.grid.query((0, 0), radius=1000)),
+                         ["a", "b"])
+
+    def test_dimensions(self):
+        self.grid.update("a", (5, 5, 5), radius=1)
+        self.assertEqual(self.grid.query((5, 5, 5.5)), ["a"])
+        self.assertEqual(self.grid.query((5, 5, 50)), [])
+
+    def test_cell_size(self):
+        self.assertRaises(ValueError, SpatialGrid, cell_size=0)
+
+    def test_large_circle(self):
+        grid = SpatialGrid(cell_size=100.0)
+        start = time.time()
+        grid.update("large", (0, 0), radius=50000)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(grid.cells, {})
+        self.assertEqual(grid.large, {"large"})
+
+        grid.update("small", (40000, 0), radius=10)
+        self.assertEqual(sorted(grid.query((40000, 0), radius=1)),
+                         ["large", "small"])
+        self.assertEqual(grid.query((0, 60000), radius=1), [])
+
+        # Shrinking the circle puts it in the cells it overlaps.
+        grid.update("large", (0, 0), radius=10)
+        self.assertEqual(grid.large, set())
+        self.assertEqual(grid.query((40000, 0), radius=1), ["small"])
+        self.assertEqual(grid.query((5, 5), radius=1), ["large"])
+
+        grid.update("large", (0, 0), radius=50000)
+        self.assertTrue(grid.remove("large"))
+        self.assertEqual(grid.large, set())
+        self.assertEqual(grid.query((0, 0), radius=1), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,893 @@
+"""Tests that run a server and a client against each other over the loopback
+interface."""
+
+import array
+import io
+import socket
+import threading
+import time
+import unittest
+
+from neteria.client import NeteriaClient
+from neteria.codec import BINARY
+from neteria.core import BUNDLE_MAGIC, serialize_data, unserialize_data
+from neteria.executor import EventExecutor
+from neteria.server import NeteriaServer
+from neteria.tools import _Middleware
+from neteria.window import ReceiveWindow
+
+
+class EvictionMiddleware(_Middleware):
+    """Records the clients that are evicted."""
+
+    def __init__(self):
+        _Middleware.__init__(self)
+        self.evicted = []
+
+    def client_evicted(self, cuuid, reason):
+        self.evicted.append((cuuid, reason))
+
+
+class CountingMiddleware(_Middleware):
+    """Counts how many times each event is executed."""
+
+    def __init__(self):
+        _Middleware.__init__(self)
+        self.executed = []
+
+    def event_execute(self, cuuid, euuid, event_data):
+        self.executed.append(euuid)
+
+
+class IllegalMiddleware(CountingMiddleware):
+    """Judges events with "illegal" set ILLEGAL."""
+
+    def event_legal(self, cuuid, euuid, event_data):
+        return not event_data.get("illegal")
+
+
+def wait_for(condition, timeout=5.0):
+    """Waits until a condition is true, or the timeout has passed.
+
+    Returns:
+      Whether the condition became true.
+
+    """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class LoopbackTestCase(unittest.TestCase):
+
+    def connect(self, middleware=None, server_options={}, client_options={}):
+        """Starts a server and a client registered with it."""
+        server = NeteriaServer(middleware or _Middleware(),
+                               server_address="127.0.0.1", server_port=0,
+                               timeout=0.3, **server_options)
+        server.listen()
+        port = server.listener.sock.getsockname()[1]
+
+        client = NeteriaClient(client_address="127.0.0.1", server_port=port,
+                               timeout=0.3, **client_options)
+        client.listen()
+        client.register(("127.0.0.1", port))
+        self.assertTrue(wait_for(lambda: client.registered))
+        return server, client
+
+    def add_client(self, server, **client_options):
+        """Registers another client with a server."""
+        port = server.listener.sock.getsockname()[1]
+        client = NeteriaClient(client_address="127.0.0.1", server_port=port,
+                               timeout=0.3, **client_options)
+        client.listen()
+        client.register(("127.0.0.1", port))
+        self.assertTrue(wait_for(lambda: client.registered))
+        return client
+
+    def test_notify(self):
+        server, client = self.connect()
+        server.notify(str(client.cuuid), {"x": 1})
+        server.notify(str(client.cuuid), {"x": 2})
+
+        self.assertTrue(wait_for(lambda: len(client.event_notifies) == 2))
+        self.assertEqual(sorted(client.event_notifies.keys()), [1, 2])
+        record = server.registry.get(str(client.cuuid))
+        self.assertTrue(wait_for(lambda: not len(record.windows["NOTIFY"])))
+
+    def test_notify_debug_ids(self):
+        # The server identifies its notify messages with uuid strings, which
+        # the client can't acknowledge by sequence number.
+        server, client = self.connect(server_options={"debug_ids": True})
+        server.notify(str(client.cuuid), {"x": 1})
+        server.notify(str(client.cuuid), {"x": 2})
+
+        self.assertTrue(wait_for(lambda: len(client.event_notifies) == 2))
+        self.assertEqual(sorted(client.event_notifies.values(),
+                                key=lambda data: data["x"]),
+                         [{"x": 1}, {"x": 2}])
+        record = server.registry.get(str(client.cuuid))
+        self.assertTrue(wait_for(lambda: not len(record.windows["NOTIFY"])))
+
+    def test_session_encryption(self):
+        server, client = self.connect(server_options={"encryption": True},
+                                      client_options={"encryption": True})
+        record = server.registry.get(str(client.cuuid))
+        self.assertIsNotNone(record.session)
+        self.assertEqual(client.session.key, record.session.key)
+
+        euuid = client.event({"x": 1})
+        server.notify(str(client.cuuid), {"x": 2})
+        self.assertTrue(wait_for(lambda: client.event_notifies and
+                                 not client.event_uuids))
+        self.assertNotIn(euuid, client.event_rollbacks)
+        self.assertEqual(list(client.event_notifies.values()), [{"x": 2}])
+
+    def test_idle_client_evicted(self):
+        middleware = EvictionMiddleware()
+        server, client = self.connect(middleware,
+                                      server_options={"idle_ttl": 0.3})
+        cuuid = str(client.cuuid)
+
+        # Events keep the client registered past its idle ttl.
+        for i in range(5):
+            client.event({"x": i})
+            time.sleep(0.1)
+        self.assertIn(cuuid, server.registry)
+
+        self.assertTrue(wait_for(lambda: middleware.evicted))
+        self.assertEqual(middleware.evicted, [(cuuid, "idle")])
+        self.assertNotIn(cuuid, server.registry)
+
+        # An evicted client is told to register again once it sends an event.
+        client.event({"x": 5})
+        self.assertTrue(wait_for(lambda: cuuid in server.registry))
+
+    def test_hard_ttl(self):
+        middleware = EvictionMiddleware()
+        server, client = self.connect(middleware,
+                                      server_options={"hard_ttl": 0.5})
+        cuuid = str(client.cuuid)
+        record = server.registry.get(cuuid)
+
+        # Registering again doesn't reset the hard ttl.
+        client.register(client.server)
+        self.assertTrue(wait_for(
+            lambda: server.registry.get(cuuid) is not record))
+        self.assertEqual(server.registry.get(cuuid).registered,
+                         record.registered)
+
+        self.assertTrue(wait_for(lambda: middleware.evicted))
+        self.assertEqual(middleware.evicted, [(cuuid, "expired")])
+
+    def test_duplicate_events_answered_from_cache(self):
+        middleware = CountingMiddleware()
+        server, client = self.connect(middleware, server_options={
+            "dedup_window": 2, "executor": EventExecutor(mode="inline")})
+        cuuid = str(client.cuuid)
+        record = server.registry.get(cuuid)
+
+        def event(euuid):
+            return server.event(cuuid, record.address, euuid, {"x": euuid},
+                                "", "normal")
+
+        response = event(100)
+        self.assertEqual(unserialize_data(response)["method"], "LEGAL")
+        self.assertEqual(event(100), response)
+        self.assertEqual(middleware.executed, [100])
+
+        # Only the most recent responses are kept. Older events are dropped
+        # instead of being executed again.
+        event(101)
+        event(102)
+        self.assertEqual(list(record.responses), [101, 102])
+        record.windows["EVENT"].clear()
+        self.assertIsNone(event(100))
+        self.assertEqual(middleware.executed, [100, 101, 102])
+
+        # The same goes for events in a batch.
+        self.assertIsNone(server.event_many(cuuid, record.address,
+                                            [[100, {"x": 100}]], "",
+                                            "normal"))
+        self.assertEqual(middleware.executed, [100, 101, 102])
+
+    def test_events_far_ahead_judged(self):
+        # Clients skip the ids of events they didn't send, so events far
+        # ahead of the others are still judged.
+        middleware = CountingMiddleware()
+        server, client = self.connect(middleware, server_options={
+            "executor": EventExecutor(mode="inline")})
+        cuuid = str(client.cuuid)
+        record = server.registry.get(cuuid)
+        euuid = 100000
+        response = server.event(cuuid, record.address, euuid, {"x": 1}, "",
+                                "normal")
+        self.assertEqual(unserialize_data(response)["method"], "LEGAL")
+        self.assertEqual(middleware.executed, [euuid])
+        record.windows["EVENT"].clear()
+        record.responses.clear()
+        self.assertIsNone(server.event(cuuid, record.address, euuid,
+                                       {"x": 1}, "", "normal"))
+        self.assertEqual(middleware.executed, [euuid])
+
+    def test_connection_ids(self):
+        server, client = self.connect(client_options={"codec": "binary"})
+        cuuid = str(client.cuuid)
+        record = server.registry.get(cuuid)
+        self.assertIsInstance(record.cid, int)
+        self.assertEqual(client.cid, record.cid)
+        self.assertEqual((client.id_key, client.id_value), ("cid", record.cid))
+
+        # Events are numbered in sequence, and the client identifies itself
+        # with its connection id alone.
+        self.assertEqual([client.event({"x": i}) for i in range(3)],
+                         [1, 2, 3])
+        self.assertTrue(wait_for(lambda: not client.event_uuids))
+        self.assertEqual(client.event_rollbacks, {})
+
+        # The connection id is kept when the client registers again, and
+        # other clients get their own.
+        client.register(client.server)
+        self.assertTrue(wait_for(
+            lambda: server.registry.get(cuuid) is not record))
+        self.assertEqual(server.registry.get(cuuid).cid, record.cid)
+        other = NeteriaClient(client_address="127.0.0.1",
+                              server_port=client.server[1], timeout=0.3)
+        other.listen()
+        other.register(client.server)
+        self.assertTrue(wait_for(lambda: other.registered))
+        self.assertNotEqual(other.cid, record.cid)
+
+    def test_wrong_connection_id(self):
+        middleware = CountingMiddleware()
+        server, client = self.connect(middleware, server_options={
+            "executor": EventExecutor(mode="inline")})
+        record = server.registry.get(str(client.cuuid))
+        packet = serialize_data({"method": "EVENT", "cid": record.cid + 1,
+                                 "euuid": 1, "event_data": {},
+                                 "timestamp": "", "priority": "normal"})
+        response = server.handle_message(packet, record.address)
+        self.assertEqual(unserialize_data(response)["method"], "BYE EVENT")
+        self.assertEqual(middleware.executed, [])
+
+    def test_debug_ids(self):
+        server, client = self.connect(client_options={"debug_ids": True})
+        self.assertEqual(client.id_key, "cuuid")
+        euuid = client.event({"x": 1})
+        self.assertIsInstance(euuid, str)
+        self.assertEqual(len(euuid), 36)
+        self.assertTrue(wait_for(lambda: not client.event_uuids))
+        self.assertEqual(client.event_rollbacks, {})
+
+    def test_selective_ack(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        record = server.registry.get(cuuid)
+        for euuid in range(100, 104):
+            server.track(record, "NOTIFY", euuid, b"packet")
+
+        message = {"method": "ACK", "cuuid": cuuid,
+                   "ack_notifies": [101, 0b10]}
+        server.handle_message_registered(message, record.address)
+        self.assertEqual([euuid for euuid in range(100, 104)
+                          if euuid in record.windows["NOTIFY"]], [102])
+
+        message["ack_notifies"] = ["102", None]
+        with self.assertLogs("neteria.server", "WARNING"):
+            server.handle_message_registered(message, record.address)
+        self.assertIn(102, record.windows["NOTIFY"])
+
+    def test_notify_many(self):
+        server, client = self.connect()
+        clients = [client,
+                   self.add_client(server, codec="binary"),
+                   self.add_client(server, codec="binary"),
+                   self.add_client(server, encryption=True)]
+
+        # The event data is only encoded once for each codec.
+        encoded = []
+        original = BINARY.encode_value
+        BINARY.encode_value = lambda value: (encoded.append(value) or
+                                             original(value))
+        try:
+            sent = server.notify_many([str(c.cuuid) for c in clients] +
+                                      ["unknown"], {"x": 1})
+        finally:
+            del BINARY.encode_value
+        self.assertEqual(sent, 4)
+        self.assertEqual(encoded, [{"x": 1}])
+
+        self.assertEqual(server.notify_all({"x": 2}), 4)
+        for c in clients:
+            self.assertTrue(wait_for(lambda: len(c.event_notifies) == 2))
+            self.assertEqual(sorted(c.event_notifies.items()),
+                             [(1, {"x": 1}), (2, {"x": 2})])
+
+    def test_multicast_group(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("", 0))
+        group = ("239.255.42.99", sock.getsockname()[1])
+        sock.close()
+        server, client = self.connect(
+            server_options={"multicast_group": group,
+                            "multicast_history": 2},
+            client_options={"multicast": True})
+        other = self.add_client(server)
+        self.assertTrue(server.registry.get(str(client.cuuid)).multicast)
+        self.assertFalse(server.registry.get(str(other.cuuid)).multicast)
+        self.assertEqual(client.group, group)
+
+        # Group members get one message sent to the group, and everyone else
+        # gets their own.
+        self.assertEqual(server.notify_all({"x": 1}), 2)
+        self.assertTrue(wait_for(lambda: other.event_notifies))
+        self.assertEqual(list(other.event_notifies.values()), [{"x": 1}])
+
+        # If the group messages are lost, the client asks for the ones it
+        # missed once it sees a newer one.
+        seq = server.notify_group({"x": 2})
+        client.handle_message(server.group_messages[seq], client.server)
+        self.assertTrue(wait_for(lambda: len(client.event_notifies) == 2))
+        self.assertEqual(sorted(client.event_notifies.items()),
+                         [(("group", 1), {"x": 1}),
+                          (("group", 2), {"x": 2})])
+
+        # Only the most recent group messages are kept to be resent.
+        server.notify_group({"x": 3})
+        self.assertEqual(list(server.group_messages), [2, 3])
+
+    def test_tick_bundles_messages(self):
+        server, client = self.connect(server_options={"tick": 0.05})
+        datagrams = []
+        send_datagrams = server.listener.send_datagrams
+        server.listener.send_datagrams = lambda batch: (
+            datagrams.extend(batch) or send_datagrams(batch))
+
+        for i in range(5):
+            server.notify(str(client.cuuid), {"x": i})
+        self.assertTrue(wait_for(lambda: len(client.event_notifies) == 5))
+        self.assertEqual(len(datagrams), 1)
+        self.assertEqual(datagrams[0][0][:1], BUNDLE_MAGIC)
+
+    def test_tick_sends_full_bundles_early(self):
+        server, client = self.connect(server_options={"tick": 60.0,
+                                                      "bundle_size": 200})
+        for i in range(5):
+            server.notify(str(client.cuuid), {"x": "y" * 50})
+
+        # Bundles that are full are sent without waiting for the tick.
+        self.assertTrue(wait_for(lambda: len(client.event_notifies) >= 2))
+        record = server.registry.get(str(client.cuuid))
+        self.assertLessEqual(record.outbox_size, 200)
+        server.flush()
+        self.assertTrue(wait_for(lambda: len(client.event_notifies) == 5))
+
+    def count_sent(self, client):
+        """Counts the datagrams a client sends to the server."""
+        sent = []
+        send_datagram = client.listener.send_datagram
+
+        def count(message, address, *args):
+            sent.append(message)
+            send_datagram(message, address, *args)
+
+        client.listener.send_datagram = count
+        return sent
+
+    def test_event_many(self):
+        middleware = IllegalMiddleware()
+        server, client = self.connect(middleware, server_options={
+            "executor": EventExecutor(mode="inline")})
+        sent = self.count_sent(client)
+
+        euuids = client.event_many([{"x": 1}, {"illegal": True}, {"x": 3}])
+        self.assertEqual(euuids, [1, 2, 3])
+        self.assertTrue(wait_for(lambda: not client.event_uuids))
+        self.assertEqual(list(client.event_rollbacks), [2])
+        self.assertEqual(middleware.executed, [1, 3])
+        self.assertEqual(unserialize_data(sent[0])["method"], "EVENTS")
+
+    def test_event_many_split(self):
+        server, client = self.connect(client_options={"mtu": 300})
+        sent = self.count_sent(client)
+        euuids = client.event_many([{"x": "y" * 100} for i in range(4)])
+        self.assertTrue(wait_for(lambda: not client.event_uuids))
+        self.assertEqual(client.event_rollbacks, {})
+        self.assertEqual(len(euuids), 4)
+        self.assertGreater(len(sent), 1)
+
+    def test_event_batching(self):
+        middleware = CountingMiddleware()
+        server, client = self.connect(middleware, server_options={
+            "executor": EventExecutor(mode="inline")},
+                                      client_options={"batch_delay": 0.05})
+        sent = self.count_sent(client)
+        for i in range(5):
+            client.event({"x": i})
+        client.event({"x": 5}, priority="high")
+        self.assertTrue(wait_for(lambda: not client.event_uuids))
+        self.assertEqual(sorted(middleware.executed), [1, 2, 3, 4, 5, 6])
+
+        # The events are sent in one packet for each priority.
+        batches = [unserialize_data(message) for message in sent]
+        batches = [batch for batch in batches if batch["method"] == "EVENTS"]
+        self.assertEqual(sorted(len(batch["events"]) for batch in batches),
+                         [1, 5])
+
+    def test_rtt_sampled_from_acks(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        client.event({"x": 1})
+        server.notify(cuuid, {"x": 2})
+        record = server.registry.get(cuuid)
+        self.assertTrue(wait_for(lambda: client.rtt.srtt is not None and
+                                 record.rtt.srtt is not None))
+
+        # Over the loopback interface the timeouts drop to the smallest RTO.
+        self.assertEqual(client.rtt.rto, client.rtt.min_rto)
+        self.assertEqual(server.stats()["clients"][cuuid],
+                         record.rtt.stats())
+        self.assertEqual(client.stats()["rto"], client.rtt.rto)
+
+    def test_lost_notifies_retransmitted(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        record = server.registry.get(cuuid)
+
+        # Drop everything the client receives until the notifies were sent.
+        handle_message = client.handle_message
+        client.handle_message = lambda data, address: None
+        for i in range(5):
+            server.notify(cuuid, {"x": i})
+
+        # A single timer retransmits all of the client's messages.
+        self.assertEqual(len(record.windows["NOTIFY"]), 5)
+        self.assertIsNotNone(record.retransmit_call)
+        timers = [call for call in server.listener.scheduled_calls
+                  if not call.cancelled and
+                  getattr(call.callback, "__name__", None) == "retransmit"]
+        self.assertEqual(len(timers), 1)
+
+        client.handle_message = handle_message
+        self.assertTrue(wait_for(lambda: len(client.event_notifies) == 5))
+        self.assertTrue(wait_for(lambda: not len(record.windows["NOTIFY"])))
+
+    def test_event_window_queue(self):
+        middleware = CountingMiddleware()
+        server, client = self.connect(middleware, server_options={
+            "executor": EventExecutor(mode="inline")},
+                                      client_options={"window_size": 2})
+
+        # Hold back the judgements until every event has been sent.
+        handle_message = client.handle_message
+        client.handle_message = lambda data, address: None
+        euuids = [client.event({"x": i}) for i in range(5)]
+        self.assertEqual(euuids, [1, 2, 3, 4, 5])
+        self.assertEqual(client.stats()["in_flight"], 2)
+        self.assertEqual(client.stats()["queued"], 3)
+
+        client.handle_message = handle_message
+        self.assertTrue(wait_for(lambda: not client.event_uuids))
+        self.assertEqual(middleware.executed, [1, 2, 3, 4, 5])
+        self.assertEqual(client.stats()["queued"], 0)
+        self.assertEqual(client.in_flight, 0)
+
+    def test_event_window_reject(self):
+        server, client = self.connect(client_options={
+            "window_size": 2, "window_policy": "reject"})
+        handle_message = client.handle_message
+        client.handle_message = lambda data, address: None
+        self.assertEqual(client.event({"x": 1}), 1)
+        self.assertEqual(client.event({"x": 2}), 2)
+        self.assertFalse(client.event({"x": 3}))
+        self.assertNotIn(3, client.event_uuids)
+
+        client.handle_message = handle_message
+        self.assertTrue(wait_for(lambda: not client.event_uuids))
+        self.assertEqual(client.event({"x": 4}), 4)
+
+    def test_event_window_block(self):
+        server, client = self.connect(client_options={
+            "window_size": 1, "window_policy": "block"})
+        handle_message = client.handle_message
+        client.handle_message = lambda data, address: None
+        client.event({"x": 1})
+
+        euuids = []
+        thread = threading.Thread(
+            target=lambda: euuids.append(client.event({"x": 2})))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+
+        client.handle_message = handle_message
+        thread.join(5.0)
+        self.assertEqual(euuids, [2])
+        self.assertTrue(wait_for(lambda: not client.event_uuids))
+
+    def test_notify_window_queue(self):
+        server, client = self.connect(server_options={"window_size": 2})
+        cuuid = str(client.cuuid)
+        record = server.registry.get(cuuid)
+
+        handle_message = client.handle_message
+        client.handle_message = lambda data, address: None
+        for i in range(5):
+            server.notify(cuuid, {"x": i})
+        self.assertEqual(len(record.windows["NOTIFY"]), 2)
+        self.assertEqual(server.stats()["queued"], 3)
+
+        client.handle_message = handle_message
+        self.assertTrue(wait_for(lambda: len(client.event_notifies) == 5))
+        self.assertEqual([client.event_notifies[euuid]["x"]
+                          for euuid in sorted(client.event_notifies)],
+                         [0, 1, 2, 3, 4])
+        self.assertTrue(wait_for(lambda: not len(record.windows["NOTIFY"])))
+        self.assertEqual(server.stats()["queued"], 0)
+
+    def test_notify_window_reject(self):
+        server, client = self.connect(server_options={
+            "window_size": 1, "window_policy": "reject"})
+        cuuid = str(client.cuuid)
+        handle_message = client.handle_message
+        client.handle_message = lambda data, address: None
+        self.assertIsNone(server.notify(cuuid, {"x": 1}))
+        self.assertFalse(server.notify(cuuid, {"x": 2}))
+
+        client.handle_message = handle_message
+        self.assertTrue(wait_for(lambda: client.event_notifies))
+        self.assertEqual(list(client.event_notifies.values()), [{"x": 1}])
+
+    def test_large_messages(self):
+        middleware = _Middleware()
+        server, client = self.connect(middleware, server_options={
+            "executor": EventExecutor(mode="inline")})
+        cuuid = str(client.cuuid)
+        level = {"tiles": "x" * 20000}
+        server.notify(cuuid, level)
+        self.assertTrue(wait_for(lambda: client.event_notifies))
+        self.assertEqual(list(client.event_notifies.values()), [level])
+
+        euuid = client.event(level)
+        self.assertTrue(wait_for(lambda: not client.event_uuids))
+        self.assertNotIn(euuid, client.event_rollbacks)
+        self.assertEqual(server.stats()["fragments"]["reassembled"], 1)
+        self.assertEqual(client.stats()["fragments"]["reassembled"], 1)
+
+    def test_streams(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        blob = bytes(range(256)) * 400
+        level = io.BytesIO()
+        received = []
+        sent = []
+        client.receive_stream(level, "level",
+                              lambda *args: received.append(args))
+        stream_id = server.send_stream(cuuid, io.BytesIO(blob), name="level",
+                                       callback=lambda *args:
+                                       sent.append(args))
+        self.assertTrue(wait_for(lambda: sent))
+        self.assertEqual(sent, [(stream_id, True)])
+        self.assertEqual(level.getvalue(), blob)
+        self.assertEqual(received, [(client.server, "level", len(blob))])
+
+        # Clients can send streams to the server too.
+        saves = {}
+
+        def sink(cuuid, name):
+            saves[(cuuid, name)] = io.BytesIO()
+            return saves[(cuuid, name)]
+
+        server.receive_stream(sink)
+        client.send_stream(memoryview(blob), name="save",
+                           callback=lambda *args: sent.append(args))
+        self.assertTrue(wait_for(lambda: len(sent) == 2))
+        self.assertEqual(saves[(cuuid, "save")].getvalue(), blob)
+        self.assertFalse(server.send_stream("unknown", b"blob"))
+
+    def test_array_payloads(self):
+        server, client = self.connect(client_options={"codec": "binary"})
+        positions = array.array("f", [1.5, 2.5, -3.0])
+        server.notify(str(client.cuuid), {"positions": positions})
+        self.assertTrue(wait_for(lambda: client.event_notifies))
+        received, = client.event_notifies.values()
+        self.assertIsInstance(received["positions"], memoryview)
+        self.assertEqual(received["positions"].tolist(), positions.tolist())
+
+    def test_replication(self):
+        server, client = self.connect()
+        other = self.add_client(server, codec="binary")
+        world = {"players": {"p1": {"x": 1.0, "y": 2.0}}}
+        server.add_state("world", world, quantize={"x": 0.5})
+
+        self.assertEqual(server.replicate(), 2)
+        self.assertTrue(wait_for(lambda: client.replica.seq == 1 and
+                                 other.replica.seq == 1))
+        self.assertEqual(client.replica.state, {"world": world})
+        self.assertEqual(other.replica.state, {"world": world})
+
+        # Once the clients have acknowledged the snapshot, they are only
+        # sent what changed.
+        client.event({"x": 1})
+        other.event({"x": 1})
+        self.assertTrue(wait_for(lambda: all(
+            record.state_baseline == 1
+            for record in server.registry.records())))
+        world["players"]["p1"]["y"] = 3.0
+        self.assertEqual(server.replicate(), 2)
+        self.assertTrue(wait_for(lambda: client.replica.seq == 2 and
+                                 other.replica.seq == 2))
+        self.assertEqual(client.replica.state, {"world": world})
+        self.assertEqual(server.stats()["replication"],
+                         {"snapshots": 2, "deltas": 1, "full": 1})
+
+        # Clients that are up to date aren't sent anything.
+        client.event({"x": 2})
+        other.event({"x": 2})
+        self.assertTrue(wait_for(lambda: all(
+            record.state_baseline == 2
+            for record in server.registry.records())))
+        self.assertEqual(server.replicate(), 0)
+
+    def test_notify_relevant(self):
+        server, near = self.connect()
+        far = self.add_client(server)
+        nowhere = self.add_client(server)
+        server.set_interest(str(near.cuuid), (0.0, 0.0), 50.0)
+        server.set_interest(str(far.cuuid), (1000.0, 0.0), 50.0)
+
+        self.assertEqual(server.notify_relevant((40.0, 0.0), 20.0, {"x": 1}),
+                         1)
+        self.assertEqual(server.notify_relevant(
+            (500.0, 0.0), 600.0, {"x": 2}, reliability="unreliable"), 2)
+        self.assertEqual(server.notify_relevant((0.0, 500.0), 10.0,
+                                                {"x": 3}), 0)
+        self.assertTrue(wait_for(lambda: len(near.event_notifies) == 2 and
+                                 far.event_notifies))
+        self.assertEqual(sorted(data["x"] for data in
+                                near.event_notifies.values()), [1, 2])
+        self.assertEqual(list(far.event_notifies.values()), [{"x": 2}])
+        time.sleep(0.1)
+        self.assertEqual(nowhere.event_notifies, {})
+        self.assertRaises(ValueError, server.notify_relevant, (0.0, 0.0),
+                          1.0, {}, reliability="maybe")
+
+    def test_notify_entity(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        server.set_interest(cuuid, (0.0, 0.0), 100.0)
+        server.set_entity("crate", (50.0, 50.0), 5.0)
+        server.set_entity("tower", (500.0, 0.0))
+        self.assertEqual(server.relevant_entities(cuuid), ["crate"])
+        self.assertEqual(server.relevant_entities("unknown"), [])
+
+        self.assertEqual(server.notify_entity("crate", {"open": True}), 1)
+        self.assertEqual(server.notify_entity("tower", {"hit": True}), 0)
+        self.assertTrue(wait_for(lambda: client.event_notifies))
+        self.assertEqual(list(client.event_notifies.values()),
+                         [{"open": True}])
+
+        server.remove_entity("crate")
+        self.assertFalse(server.notify_entity("crate", {"open": False}))
+        self.assertEqual(server.stats()["interest"],
+                         {"clients": 1, "entities": 1})
+
+    def test_unreliable_events(self):
+        middleware = IllegalMiddleware()
+        server, client = self.connect(middleware, server_options={
+            "executor": EventExecutor(mode="inline")})
+        sent = self.count_sent(client)
+
+        self.assertEqual(client.event({"x": 1}, reliability="unreliable"), 1)
+        self.assertEqual(client.event({"illegal": True},
+                                      reliability="unreliable"), 2)
+        self.assertTrue(wait_for(lambda: middleware.executed))
+        time.sleep(0.1)
+        self.assertEqual(middleware.executed, [1])
+
+        # Nothing is kept to be retransmitted or judged.
+        self.assertEqual(client.event_uuids, {})
+        self.assertEqual(client.event_rollbacks, {})
+        self.assertEqual([unserialize_data(message)["method"]
+                          for message in sent], ["UNRELIABLE EVENT"] * 2)
+        self.assertRaises(ValueError, client.event, {"x": 1},
+                          reliability="maybe")
+
+    def test_sequenced_events(self):
+        middleware = CountingMiddleware()
+        server, client = self.connect(middleware, server_options={
+            "executor": EventExecutor(mode="inline")})
+        cuuid = str(client.cuuid)
+        host = ("127.0.0.1", client.listener.sock.getsockname()[1])
+
+        client.event({"x": 1}, reliability="sequenced")
+        client.event({"x": 2}, reliability="sequenced")
+        self.assertTrue(wait_for(lambda: len(middleware.executed) == 2))
+
+        # Older and repeated sequence numbers are dropped.
+        server.event_unreliable(cuuid, host, 1, {"x": 1}, True)
+        server.event_unreliable(cuuid, host, 2, {"x": 2}, True)
+        server.event_unreliable(cuuid, host, 4, {"x": 4}, True)
+        server.event_unreliable(cuuid, host, 3, {"x": 3}, True)
+        self.assertEqual(middleware.executed, [1, 2, 4])
+
+        # Plain unreliable events are never dropped as stale.
+        server.event_unreliable(cuuid, host, 3, {"x": 3}, False)
+        self.assertEqual(middleware.executed, [1, 2, 4, 3])
+
+    def test_unreliable_event_from_other_host(self):
+        server, client = self.connect()
+        response = server.event_unreliable(str(client.cuuid),
+                                           ("10.0.0.1", 40000), 1, {"x": 1},
+                                           False)
+        self.assertEqual(unserialize_data(response)["method"], "BYE EVENT")
+
+    def test_unreliable_notifies(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        server.notify(cuuid, {"x": 1}, reliability="unreliable")
+        server.notify(cuuid, {"x": 2}, reliability="sequenced")
+        self.assertTrue(wait_for(lambda: len(client.event_notifies) == 2))
+        self.assertEqual(client.event_notifies,
+                         {("unreliable", 1): {"x": 1},
+                          ("unreliable", 2): {"x": 2}})
+        self.assertEqual(client.latest_notify, 2)
+
+        # Nothing waits for an acknowledgement.
+        record = server.registry.get(cuuid)
+        self.assertEqual(len(record.windows["NOTIFY"]), 0)
+
+    def test_stale_sequenced_notify_dropped(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        client.latest_notify = 10
+        server.notify(cuuid, {"x": 1}, reliability="sequenced")
+        server.notify(cuuid, {"x": 2}, reliability="unreliable")
+        self.assertTrue(wait_for(lambda: client.event_notifies))
+        time.sleep(0.1)
+        self.assertEqual(client.event_notifies, {("unreliable", 2): {"x": 2}})
+        self.assertEqual(client.latest_notify, 10)
+
+    def test_confirm_from_other_address(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        record = server.registry.get(cuuid)
+        server.track(record, "NOTIFY", 1, b"packet")
+
+        # Anyone who knows the client's uuid can send a confirmation, but only
+        # the client's own are accepted.
+        message = {"method": "OK NOTIFY", "cuuid": cuuid, "euuid": 1}
+        server.handle_message_registered(message, ("127.0.0.1", 1))
+        self.assertIn(1, record.windows["NOTIFY"])
+        server.handle_message_registered(message, record.address)
+        self.assertNotIn(1, record.windows["NOTIFY"])
+
+    def test_stream_cancel_from_other_address(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        sink = io.BytesIO()
+        client.receive_stream(sink)
+        results = []
+        blob = bytes(bytearray(range(256))) * 256
+        stream_id = server.send_stream(cuuid, blob, window_size=4,
+                                       callback=lambda *args: results.append(
+                                           args[-1]))
+
+        message = {"method": "STREAM CANCEL", "cuuid": cuuid,
+                   "stream": stream_id}
+        server.handle_message_registered(message, ("127.0.0.1", 1))
+        self.assertTrue(wait_for(lambda: results))
+        self.assertEqual(results, [True])
+        self.assertEqual(sink.getvalue(), blob)
+
+    def test_nack_from_other_address(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        sent = []
+        server.send_many = sent.extend
+        server.group_messages[1] = b"packet"
+
+        message = {"method": "NACK", "cuuid": cuuid, "missing": [1, 1, 1]}
+        server.handle_message_registered(message, ("127.0.0.1", 1))
+        self.assertEqual(sent, [])
+        record = server.registry.get(cuuid)
+        server.handle_message_registered(message, record.address)
+        self.assertEqual(sent, [(record, b"packet")])
+
+    def test_notify_from_other_address(self):
+        server, client = self.connect()
+        packet = serialize_data({"method": "NOTIFY", "euuid": 1,
+                                 "event_data": {"x": 1}})
+        client.handle_message(packet, ("127.0.0.1", 1))
+        self.assertEqual(client.event_notifies, {})
+        self.assertEqual(client.notify_window.cumulative, 0)
+
+    def test_unreliable_notify_from_other_address(self):
+        server, client = self.connect()
+        packet = serialize_data({"method": "UNRELIABLE NOTIFY",
+                                 "sequenced": True, "euuid": 2 ** 62,
+                                 "event_data": {"x": 1}})
+        client.handle_message(packet, ("127.0.0.1", 1))
+        self.assertEqual(client.event_notifies, {})
+        self.assertEqual(client.latest_notify, 0)
+
+        # Sequenced notifies from the server still arrive.
+        server.notify(str(client.cuuid), {"x": 2}, reliability="sequenced")
+        self.assertTrue(wait_for(lambda: client.event_notifies))
+        self.assertEqual(list(client.event_notifies.values()), [{"x": 2}])
+
+    def test_notify_far_ahead(self):
+        server, client = self.connect()
+        packet = serialize_data({"method": "NOTIFY", "euuid": 10 ** 8,
+                                 "event_data": {"x": 1}})
+        client.handle_message(packet, client.server)
+        self.assertEqual(client.event_notifies, {})
+        self.assertFalse(client.ack_pending)
+
+        # Later notifies are still received and acknowledged.
+        server.notify(str(client.cuuid), {"x": 2})
+        self.assertTrue(wait_for(lambda: client.event_notifies))
+        self.assertEqual(list(client.event_notifies.values()), [{"x": 2}])
+        record = server.registry.get(str(client.cuuid))
+        self.assertTrue(wait_for(lambda: not len(record.windows["NOTIFY"])))
+
+    def test_group_notify_checks(self):
+        server, client = self.connect()
+        client.group_window = ReceiveWindow()
+
+        # Group messages from anyone but the server are ignored, and so are
+        # ones too far ahead to keep track of.
+        packet = serialize_data({"method": "GROUP NOTIFY", "euuid": 1,
+                                 "event_data": {"x": 1}})
+        client.handle_message(packet, ("127.0.0.1", 1))
+        packet = serialize_data({"method": "GROUP NOTIFY", "euuid": 10 ** 8,
+                                 "event_data": {"x": 2}})
+        client.handle_message(packet, client.server)
+        self.assertEqual(client.event_notifies, {})
+        self.assertEqual(client.group_window.cumulative, 0)
+        self.assertIsNone(client.nack_call)
+
+        packet = serialize_data({"method": "GROUP NOTIFY", "euuid": 1,
+                                 "event_data": {"x": 3}})
+        client.handle_message(packet, client.server)
+        self.assertEqual(client.event_notifies, {("group", 1): {"x": 3}})
+
+    def test_is_registered(self):
+        server, client = self.connect()
+        cuuid = str(client.cuuid)
+        address = client.listener.sock.getsockname()
+        self.assertTrue(server.is_registered(cuuid, address))
+        self.assertFalse(server.is_registered(cuuid, ("127.0.0.1", 1)))
+        self.assertFalse(server.is_registered("unknown", address))
+
+    def test_register_again_from_other_address(self):
+        server, client = self.connect(server_options={"encryption": True},
+                                      client_options={"encryption": True})
+        cuuid = str(client.cuuid)
+        record = server.registry.get(cuuid)
+        packet = record.session.encrypt(b"secret")
+        server.track(record, "NOTIFY", 100, packet)
+        record.responses[100] = packet
+        message = {"method": "REGISTER", "cuuid": cuuid,
+                   "encryption": [client.encryption.n, client.encryption.e],
+                   "session": True}
+
+        # The client's own address gets its messages encrypted with the new
+        # session key.
+        server.register(dict(message), record.address)
+        record = server.registry.get(cuuid)
+        self.assertIn(100, record.windows["NOTIFY"])
+        self.assertNotEqual(record.responses[100], packet)
+
+        # Anyone else doesn't get them at all.
+        server.register(dict(message), ("127.0.0.1", 1))
+        record = server.registry.get(cuuid)
+        self.assertNotIn(100, record.windows["NOTIFY"])
+        self.assertEqual(len(record.responses), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Tests for the registry of clients."""
+
+import unittest
+
+from datetime import datetime
+
+from neteria.registry import ClientRecord, Registry
+
+
+def record(cuuid, port):
+    return ClientRecord(cuuid, "127.0.0.1", port, datetime.now())
+
+
+class RegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_lookups(self):
+        a = record("a", 1000)
+        b = record("b", 1001)
+        self.registry.add(a)
+        self.registry.add(b)
+
+        self.assertIs(self.registry.get("a"), a)
+        self.assertIs(self.registry["b"], b)
+        self.assertIs(self.registry.get_by_address(("127.0.0.1", 1001)), b)
+        self.assertIsNone(self.registry.get("c"))
+        self.assertIsNone(self.registry.get_by_address(("127.0.0.1", 1002)))
+        self.assertIn("a", self.registry)
+        self.assertEqual(len(self.registry), 2)
+        self.assertEqual(sorted(self.registry), ["a", "b"])
+
+    def test_replace(self):
+        old = record("a", 1000)
+        new = record("a", 1001)
+        self.registry.add(old)
+        self.registry.add(new)
+
+        self.assertIs(self.registry.get("a"), new)
+        self.assertIsNone(self.registry.get_by_address(("127.0.0.1", 1000)))
+        self.assertIs(self.registry.get_by_address(("127.0.0.1", 1001)), new)
+        self.assertEqual(len(self.registry), 1)
+
+    def test_replace_keeps_other_client_at_address(self):
+        a = record("a", 1000)
+        b = record("b", 1000)
+        self.registry.add(a)
+        self.registry.add(b)
+        self.registry.remove("a")
+        self.assertIs(self.registry.get_by_address(("127.0.0.1", 1000)), b)
+
+    def test_remove(self):
+        a = record("a", 1000)
+        self.registry.add(a)
+        self.assertIs(self.registry.remove("a"), a)
+        self.assertIsNone(self.registry.remove("a"))
+        self.assertIsNone(self.registry.get_by_address(("127.0.0.1", 1000)))
+        self.assertEqual(len(self.registry), 0)
+
+    def test_snapshot_iteration(self):
+        self.registry.add(record("a", 1000))
+        records = self.registry.records()
+        self.registry.add(record("b", 1001))
+        self.assertEqual([r.cuuid for r in records], ["a"])
+
+    def test_record_as_dictionary(self):
+        a = record("a", 1000)
+        self.assertEqual(a["host"], "127.0.0.1")
+        self.assertEqual(a.address, ("127.0.0.1", 1000))
+        a["authenticated"] = True
+        self.assertTrue(a.authenticated)
+        self.assertIn("host", a)
+        self.assertNotIn("session", a)
+        with self.assertRaises(KeyError):
+            a["missing"]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+"""Tests for replicating states with deltas."""
+
+import array
+import unittest
+
+from neteria.replication import Mirror, Replicator, dequantize, quantize
+
+
+class Player(object):
+    """A state object whose public attributes are replicated."""
+
+    def __init__(self):
+        self.x = 1.0
+        self._secret = "hidden"
+
+
+class ReplicatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.world = {"players": {"p1": {"x": 1.0, "y": 2.0},
+                                  "p2": {"x": 3.0, "y": 4.0}},
+                      "time": 0}
+        self.replicator = Replicator(history=4)
+        self.replicator.add("world", self.world)
+        self.mirror = Mirror()
+
+    def sync(self, baseline):
+        """Applies the delta since a baseline to the mirror."""
+        delta = self.replicator.delta(baseline)
+        message = dict(delta, method="STATE")
+        self.assertTrue(self.mirror.apply(message))
+        return delta
+
+    def test_snapshots_numbered_on_change(self):
+        self.assertEqual(self.replicator.snapshot(), 1)
+        self.assertEqual(self.replicator.snapshot(), 1)
+        self.world["time"] = 1
+        self.assertEqual(self.replicator.snapshot(), 2)
+        self.assertIsNone(self.replicator.delta(2))
+        self.assertEqual(self.replicator.stats["snapshots"], 2)
+
+    def test_full_state(self):
+        self.replicator.snapshot()
+        delta = self.sync(0)
+        self.assertEqual(delta["base"], 0)
+        self.assertEqual(self.mirror.state, {"world": self.world})
+        self.assertEqual(self.mirror.seq, 1)
+
+    def test_delta(self):
+        self.replicator.snapshot()
+        self.sync(0)
+        self.world["players"]["p1"]["x"] = 5.0
+        self.world["time"] = 1
+        self.replicator.snapshot()
+
+        delta = self.sync(1)
+        self.assertEqual(delta, {"seq": 2, "base": 1,
+                                 "set": {"world": {"players": {"p1": {
+                                     "x": 5.0}}, "time": 1}}})
+        self.assertEqual(self.mirror.state, {"world": self.world})
+        self.assertIs(self.replicator.delta(1), delta)
+
+    def test_delta_over_several_snapshots(self):
+        self.replicator.snapshot()
+        self.sync(0)
+        for time in range(1, 4):
+            self.world["time"] = time
+            self.replicator.snapshot()
+        self.world["players"]["p2"]["y"] = 0.0
+        self.replicator.snapshot()
+
+        delta = self.sync(1)
+        self.assertEqual(delta["base"], 1)
+        self.assertEqual(self.mirror.state, {"world": self.world})
+
+    def test_old_baseline_gets_full_state(self):
+        self.replicator.snapshot()
+        for time in range(1, 6):
+            self.world["time"] = time
+            self.replicator.snapshot()
+        self.assertEqual(self.replicator.delta(1)["base"], 0)
+        self.assertEqual(self.replicator.delta(2)["base"], 2)
+
+    def test_removed(self):
+        self.replicator.snapshot()
+        self.sync(0)
+        del self.world["players"]["p2"]
+        self.replicator.snapshot()
+        delta = self.sync(1)
+        self.assertEqual(sorted(delta["removed"]),
+                         [["world", "players", "p2", "x"],
+                          ["world", "players", "p2", "y"]])
+        self.assertEqual(self.mirror.state, {"world": self.world})
+
+        # Removing the last leaf of a dictionary removes it too, while empty
+        # dictionaries that are still in the state are kept.
+        self.world["players"]["p1"] = {}
+        self.replicator.snapshot()
+        self.sync(2)
+        self.assertEqual(self.mirror.state["world"]["players"], {"p1": {}})
+
+    def test_remove_state(self):
+        self.replicator.add("score", {"red": 1})
+        self.replicator.snapshot()
+        self.sync(0)
+        self.replicator.remove("score")
+        self.replicator.snapshot()
+        self.sync(1)
+        self.assertEqual(list(self.mirror.state), ["world"])
+
+    def test_quantize(self):
+        replicator = Replicator()
+        position = {"x": 1.234, "y": 2.0, "name": "p1"}
+        replicator.add("position", position, quantize={"x": 0.01})
+        replicator.snapshot()
+        delta = replicator.delta(0)
+        self.assertEqual(delta["set"]["position"]["x"], 123)
+        self.assertEqual(delta["quantize"], {"position": {"x": 0.01}})
+
+        mirror = Mirror()
+        mirror.apply(dict(delta))
+        self.assertAlmostEqual(mirror.state["position"]["x"], 1.23)
+        self.assertEqual(mirror.state["position"]["name"], "p1")
+
+        # Changes smaller than the precision aren't sent.
+        position["x"] = 1.2341
+        self.assertEqual(replicator.snapshot(), 1)
+        position["x"] = 1.3
+        replicator.snapshot()
+        delta = replicator.delta(1)
+        self.assertNotIn("quantize", delta)
+        mirror.apply(dict(delta))
+        self.assertAlmostEqual(mirror.state["position"]["x"], 1.3)
+
+    def test_quantize_helpers(self):
+        self.assertEqual(quantize([1.0, 2.5, True, "a"], 0.5),
+                         [2, 5, True, "a"])
+        self.assertEqual(quantize(float("inf"), 0.5), float("inf"))
+        self.assertEqual(dequantize([2, 5], 0.5), [1.0, 2.5])
+
+    def test_snapshot_copies_values(self):
+        self.world["path"] = [1, 2]
+        self.world["samples"] = array.array("d", [1.0])
+        self.replicator.snapshot()
+        self.world["path"].append(3)
+        self.world["samples"][0] = 2.0
+        self.assertEqual(self.replicator.snapshot(), 2)
+        self.assertEqual(self.replicator.delta(1)["set"]["world"],
+                         {"path": [1, 2, 3],
+                          "samples": array.array("d", [2.0])})
+
+    def test_objects_and_functions(self):
+        replicator = Replicator()
+        player = Player()
+        replicator.add("player", player)
+        replicator.add("clock", lambda: {"tick": 7})
+        replicator.snapshot()
+        self.assertEqual(replicator.delta(0)["set"],
+                         {"player": {"x": 1.0}, "clock": {"tick": 7}})
+
+    def test_mirror_rejects_stale_and_unknown_bases(self):
+        self.replicator.snapshot()
+        self.sync(0)
+        self.world["time"] = 1
+        self.replicator.snapshot()
+        self.world["time"] = 2
+        self.replicator.snapshot()
+
+        # A delta against a snapshot we don't have can't be applied.
+        self.assertFalse(self.mirror.apply({"seq": 3, "base": 2,
+                                            "set": {}}))
+        self.sync(1)
+        self.assertFalse(self.mirror.apply({"seq": 2, "base": 1,
+                                            "set": {}}))
+        self.assertEqual(self.mirror.seq, 3)
+
+        # After a reset only a whole state is applied.
+        self.mirror.reset()
+        self.assertFalse(self.mirror.apply({"seq": 4, "base": 3,
+                                            "set": {}}))
+        self.sync(0)
+        self.assertEqual(self.mirror.state, {"world": self.world})
+
+
+if __name__ == "__main__":
+    unittest.main()
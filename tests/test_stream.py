@@ -0,0 +1,215 @@
+"""Tests for sending and receiving streams."""
+
+import io
+import unittest
+
+from neteria import stream
+from neteria.core import RTTEstimator, ScheduledCall
+from neteria.stream import Streams
+
+
+class FakeClock(object):
+    """Collects scheduled calls so a test can run them when it wants to."""
+
+    def __init__(self):
+        self.calls = []
+
+    def call_later(self, time_seconds, callback, arguments):
+        scheduled_call = ScheduledCall(time_seconds, callback, arguments)
+        self.calls.append(scheduled_call)
+        return scheduled_call
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for scheduled_call in calls:
+            if not scheduled_call.cancelled:
+                scheduled_call.callback(scheduled_call.args)
+
+
+class StreamsReceiverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.clock = FakeClock()
+        self.streams = Streams(lambda peer, message: self.sent.append(
+            (peer, message)), self.clock.call_later, max_receivers=2,
+                               receiver_timeout=10.0)
+        self.streams.listen(io.BytesIO())
+
+    def chunk(self, peer, stream_id, seq):
+        self.streams.handle(peer, {"method": "STREAM", "stream": stream_id,
+                                   "euuid": seq, "data": b"x"})
+
+    def test_max_receivers(self):
+        self.chunk("a", 1, 2)
+        self.chunk("a", 3, 2)
+        self.chunk("a", 5, 2)
+        self.assertEqual(sorted(self.streams.receivers),
+                         [("a", 1), ("a", 3)])
+        self.assertIn(("a", {"method": "STREAM CANCEL", "stream": 5}),
+                      self.sent)
+
+        # Other peers have their own limit.
+        self.chunk("b", 1, 2)
+        self.assertIn(("b", 1), self.streams.receivers)
+
+        # A cancelled stream makes room for another one.
+        self.streams.handle("a", {"method": "STREAM CANCEL", "stream": 1})
+        self.chunk("a", 5, 2)
+        self.assertIn(("a", 5), self.streams.receivers)
+
+    def test_idle_receivers_expire(self):
+        now = [100.0]
+        original = stream.monotonic
+        stream.monotonic = lambda: now[0]
+        try:
+            self.chunk("a", 1, 2)
+            self.chunk("a", 3, 2)
+            now[0] += 5.0
+            self.chunk("a", 3, 3)
+
+            # Only the stream that has been idle for too long is dropped.
+            now[0] += 6.0
+            self.clock.run()
+            self.assertEqual(list(self.streams.receivers), [("a", 3)])
+            self.assertEqual(self.streams.receiving, {"a": 1})
+
+            now[0] += 10.0
+            self.clock.run()
+            self.assertEqual(self.streams.receivers, {})
+            self.assertEqual(self.streams.receiving, {})
+        finally:
+            stream.monotonic = original
+
+    def test_close_drops_receivers(self):
+        self.chunk("a", 1, 2)
+        self.chunk("b", 1, 2)
+        expire_a, expire_b = self.clock.calls
+        self.streams.close("a")
+        self.assertEqual(list(self.streams.receivers), [("b", 1)])
+        self.assertEqual(self.streams.receiving, {"b": 1})
+        self.assertTrue(expire_a.cancelled)
+        self.assertFalse(expire_b.cancelled)
+
+
+class StreamsTransferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.queue = []
+        self.server = Streams(lambda peer, message: self.queue.append(
+            (self.client, "server", message)), self.clock.call_later)
+        self.client = Streams(lambda peer, message: self.queue.append(
+            (self.server, "client", message)), self.clock.call_later,
+                              odd=False)
+        self.sent = []
+        self.received = []
+        self.blob = bytes(range(256)) * 40
+
+    def pump(self, drop=lambda message: False):
+        """Delivers the queued messages and runs the scheduled calls until
+        nothing is left to do."""
+        for i in range(100):
+            while self.queue:
+                streams, peer, message = self.queue.pop(0)
+                if not drop(message):
+                    streams.handle(peer, message)
+            if not self.server.senders and not self.client.senders:
+                return
+            self.clock.run()
+
+    def send(self, source, **options):
+        options.setdefault("chunk_size", 1000)
+        options.setdefault("window_size", 4)
+        return self.server.open(
+            "client", source, RTTEstimator(), callback=lambda *args:
+            self.sent.append(args), **options)
+
+    def test_transfer(self):
+        sink = io.BytesIO()
+        self.client.listen(sink, "level", lambda *args:
+                           self.received.append(args))
+        stream_id = self.send(io.BytesIO(self.blob), name="level")
+        self.assertEqual(self.server.stats(), {"sending": 1, "receiving": 0})
+        self.pump()
+
+        self.assertEqual(sink.getvalue(), self.blob)
+        self.assertEqual(self.sent, [(stream_id, True)])
+        self.assertEqual(self.received, [("server", "level", len(self.blob))])
+        self.assertEqual(self.server.senders, {})
+        self.assertEqual(self.client.receivers, {})
+
+    def test_memoryview_source(self):
+        sink = io.BytesIO()
+        self.client.listen(sink)
+        self.send(memoryview(self.blob), text=True)
+        self.pump()
+        self.assertEqual(sink.getvalue(), self.blob)
+
+    def test_stream_ids(self):
+        self.client.listen(io.BytesIO())
+        self.server.listen(io.BytesIO())
+        self.assertEqual(self.send(b"x"), 1)
+        self.assertEqual(self.send(b"y"), 3)
+        self.assertEqual(self.client.open("server", b"z", RTTEstimator()), 2)
+
+    def test_lost_chunk_resent(self):
+        sink = io.BytesIO()
+        self.client.listen(sink)
+        lost = []
+
+        def drop(message):
+            if message.get("euuid") == 2 and not lost:
+                lost.append(message)
+                return True
+            return False
+
+        sent = []
+        send = self.server.send
+        self.server.send = lambda peer, message: (sent.append(message),
+                                                  send(peer, message))
+        self.send(self.blob, window_size=8)
+        self.pump(drop)
+
+        self.assertEqual(len(lost), 1)
+        self.assertEqual(sink.getvalue(), self.blob)
+        chunks = [message["euuid"] for message in sent
+                  if message["method"] == "STREAM"]
+        self.assertEqual(chunks.count(2), 2)
+        self.assertEqual(sorted(set(chunks)), list(range(1, 12)))
+
+    def test_out_of_order(self):
+        sink = io.BytesIO()
+        self.client.listen(sink)
+        self.send(self.blob, window_size=16)
+        self.queue.reverse()
+        self.pump()
+        self.assertEqual(sink.getvalue(), self.blob)
+
+    def test_sink_by_name(self):
+        level = io.BytesIO()
+        other = []
+
+        def sink(peer, name):
+            other.append((peer, name))
+            return io.BytesIO()
+
+        self.client.listen(level, "level")
+        self.client.listen(sink)
+        self.send(b"level data", name="level")
+        self.send(b"save data", name="save")
+        self.pump()
+        self.assertEqual(level.getvalue(), b"level data")
+        self.assertEqual(other, [("server", "save")])
+
+    def test_no_sink(self):
+        stream_id = self.send(self.blob, name="level")
+        self.pump()
+        self.assertEqual(self.sent, [(stream_id, False)])
+        self.assertEqual(self.server.senders, {})
+        self.assertEqual(self.client.receivers, {})
+        self.assertEqual(self.client.receiving, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
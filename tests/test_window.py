@@ -0,0 +1,213 @@
+"""Tests for the send and receive windows."""
+
+import unittest
+
+from neteria.window import ACK_BITS, MAX_AHEAD, ReceiveWindow, SendWindow
+
+
+class AckTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.window = SendWindow()
+        for seq in range(1, 11):
+            self.window.add(seq, b"packet %d" % seq, float(seq), 100.0)
+
+    def test_cumulative(self):
+        samples = self.window.ack(4, 0)
+        self.assertEqual(samples, [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(len(self.window), 6)
+        self.assertNotIn(4, self.window)
+        self.assertIn(5, self.window)
+
+    def test_selective(self):
+        # Messages 3 and 5 were received, but 1, 2 and 4 are missing.
+        self.window.ack(0, 0b10100)
+        self.assertEqual(sorted(seq for seq in range(1, 11)
+                                if seq in self.window),
+                         [1, 2, 4, 6, 7, 8, 9, 10])
+
+    def test_ack_past_window(self):
+        self.window.ack(100, 0)
+        self.assertEqual(len(self.window), 0)
+        self.window.add(11, b"packet", 0.0, 1.0)
+        self.assertIn(11, self.window)
+
+    def test_duplicate_ack(self):
+        self.assertEqual(len(self.window.ack(2, 1)), 3)
+        self.assertEqual(self.window.ack(2, 1), [])
+        self.assertEqual(len(self.window), 7)
+
+    def test_retransmitted_messages_not_sampled(self):
+        self.assertIsNotNone(self.window.resend(1, 0.0, _Rtt()))
+        self.assertEqual(self.window.ack(2, 0), [2.0])
+
+    def test_other_ids(self):
+        window = SendWindow()
+        window.add("45e2e9c6-6c4a-11e4-a5c7-080027ad5e2c", b"debug", 0.0, 1.0)
+        window.add(5, b"packet", 1.0, 1.0)
+        window.ack(5, 0)
+        self.assertEqual(len(window), 1)
+        self.assertIsNotNone(window.remove(
+            "45e2e9c6-6c4a-11e4-a5c7-080027ad5e2c"))
+
+
+class SendWindowTestCase(unittest.TestCase):
+
+    def test_grows(self):
+        window = SendWindow(capacity=4)
+        for seq in range(1, 21):
+            window.add(seq, b"packet %d" % seq, 0.0, 1.0)
+        self.assertEqual(len(window), 20)
+        self.assertEqual(len(window.packets), 32)
+        self.assertEqual(window.other, {})
+        self.assertEqual(window.remove(7), (0.0, 0))
+        self.assertEqual([seq for seq in range(1, 21) if seq in window],
+                         [seq for seq in range(1, 21) if seq != 7])
+        self.assertIsNone(window.remove(7))
+
+    def test_start_moves_past_removed(self):
+        window = SendWindow(capacity=4)
+        for seq in range(1, 4):
+            window.add(seq, b"packet", 0.0, 1.0)
+        window.remove(2)
+        self.assertEqual(window.low, 1)
+        window.remove(1)
+        self.assertEqual(window.low, 3)
+
+        # The ring buffer slots are reused as the window moves on.
+        window.add(4, b"packet", 0.0, 1.0)
+        window.add(5, b"packet", 0.0, 1.0)
+        window.add(6, b"packet", 0.0, 1.0)
+        self.assertEqual(len(window.packets), 4)
+        self.assertEqual(len(window), 4)
+
+    def test_max_span(self):
+        window = SendWindow(capacity=4, max_span=8)
+        window.add(1, b"first", 0.0, 1.0)
+        window.add(20, b"far", 0.0, 1.0)
+        self.assertEqual(len(window.packets), 4)
+        self.assertIn(20, window.other)
+        self.assertIn(20, window)
+        self.assertEqual(len(window), 2)
+        self.assertEqual(window.ack(20, 0), [0.0, 0.0])
+        self.assertEqual(len(window), 0)
+
+    def test_poll(self):
+        window = SendWindow()
+        window.add(1, b"one", 0.0, 1.0)
+        window.add(2, b"two", 0.0, 3.0)
+        window.add("debug", b"debug", 0.0, 2.0)
+
+        self.assertEqual(window.poll(0.5, _Rtt(), 2), ([], [], 1.0))
+        self.assertEqual(window.poll(1.0, _Rtt(), 2), ([b"one"], [], 2.0))
+        self.assertEqual(window.poll(2.0, _Rtt(), 2),
+                         ([b"one", b"debug"], [], 3.0))
+        self.assertEqual(window.poll(3.0, _Rtt(), 2),
+                         ([b"two", b"debug"], [1], 4.0))
+        self.assertNotIn(1, window)
+        self.assertEqual(window.poll(4.0, _Rtt(), 2),
+                         ([b"two"], ["debug"], 5.0))
+        self.assertEqual(window.poll(5.0, _Rtt(), 2), ([], [2], None))
+        self.assertEqual(len(window), 0)
+
+    def test_resend(self):
+        window = SendWindow()
+        window.add(1, b"one", 0.0, 10.0)
+        self.assertEqual(window.resend(1, 0.0, _Rtt()), b"one")
+        self.assertIsNone(window.resend(1, 0.0, _Rtt()))
+        self.assertIsNone(window.resend(2, 0.0, _Rtt()))
+        self.assertEqual(window.poll(0.5, _Rtt(), 5), ([], [], 1.0))
+
+    def test_replace(self):
+        window = SendWindow()
+        window.add(1, b"one", 0.0, 1.0)
+        window.add("debug", b"debug", 0.0, 1.0)
+        window.replace(bytes.upper)
+        self.assertEqual(sorted(window.poll(1.0, _Rtt(), 5)[0]),
+                         [b"DEBUG", b"ONE"])
+
+    def test_clear(self):
+        window = SendWindow()
+        window.add(1, b"one", 0.0, 1.0)
+        window.add("debug", b"debug", 0.0, 1.0)
+        window.clear()
+        self.assertEqual(len(window), 0)
+        self.assertNotIn(1, window)
+        self.assertIsNone(window.poll(1.0, _Rtt(), 5)[2])
+        window.add(2, b"two", 0.0, 1.0)
+        self.assertIn(2, window)
+
+
+class _Rtt(object):
+    """An RTT estimator with a fixed timeout."""
+
+    def timeout(self, retry=0):
+        return 1.0
+
+
+class ReceiveWindowTestCase(unittest.TestCase):
+
+    def test_in_order(self):
+        window = ReceiveWindow()
+        for seq in range(1, 4):
+            self.assertTrue(window.receive(seq))
+        self.assertEqual((window.cumulative, window.bits), (3, 0))
+        self.assertFalse(window.receive(2))
+
+    def test_out_of_order(self):
+        window = ReceiveWindow()
+        self.assertTrue(window.receive(3))
+        self.assertTrue(window.receive(5))
+        self.assertEqual((window.cumulative, window.bits), (0, 0b10100))
+        self.assertEqual(window.missing(), [1, 2, 4])
+        self.assertFalse(window.receive(5))
+
+        # The gap is filled in.
+        window.receive(1)
+        window.receive(2)
+        self.assertEqual((window.cumulative, window.bits), (3, 0b10))
+        window.receive(4)
+        self.assertEqual((window.cumulative, window.bits), (5, 0))
+
+    def test_skip(self):
+        window = ReceiveWindow(10)
+        window.receive(13)
+        window.skip()
+        self.assertEqual((window.cumulative, window.bits), (13, 0))
+        self.assertEqual(window.missing(), [])
+
+    def test_receive_far_ahead(self):
+        window = ReceiveWindow()
+        self.assertIsNone(window.receive(10 ** 8))
+        self.assertIsNone(window.receive(MAX_AHEAD + 1))
+        self.assertEqual((window.cumulative, window.bits), (0, 0))
+
+        # Messages after it are still received.
+        self.assertTrue(window.receive(1))
+        self.assertEqual(window.cumulative, 1)
+
+    def test_receive_bitmap_bounded(self):
+        window = ReceiveWindow()
+        self.assertTrue(window.receive(MAX_AHEAD))
+        self.assertLessEqual(window.bits.bit_length(), ACK_BITS)
+        self.assertEqual(window.cumulative, MAX_AHEAD - ACK_BITS)
+
+    def test_catch_up(self):
+        window = ReceiveWindow()
+        window.receive(2)
+        seq = 5 * MAX_AHEAD
+        self.assertIsNone(window.receive(seq))
+        window.catch_up(seq)
+        self.assertTrue(window.receive(seq))
+        self.assertFalse(window.receive(seq))
+        self.assertFalse(window.receive(2))
+        self.assertLessEqual(window.bits.bit_length(), ACK_BITS)
+
+        # Messages that are close enough don't move the window.
+        cumulative = window.cumulative
+        window.catch_up(seq + 1)
+        self.assertEqual(window.cumulative, cumulative)
+
+
+if __name__ == "__main__":
+    unittest.main()